@@ -0,0 +1,409 @@
+#!/usr/bin/env python
+"""
+CARLA-free kinematic stand-in for the subset of the `carla` API used by these
+scripts, for load-testing the transport, Scheduler and twin logic without a
+simulator or GPU. Select it with the CARLA_STANDIN environment variable:
+
+    CARLA_STANDIN=1 python Single_Server/Physical_world.py -n 2000
+
+Vehicles live in flat NumPy arrays. Autopilot vehicles drive along circles
+around the map origin through their spawn point; other vehicles keep the
+transform the client set and integrate their target velocity. One tick is a
+handful of vectorized array updates regardless of the fleet size.
+
+World.tick() is paced to wall-clock time like a real server; set
+CARLA_STANDIN_REALTIME to a speed-up factor (0 = as fast as possible).
+"""
+import fnmatch, math, os, time
+import numpy as np
+
+REALTIME = float(os.environ.get('CARLA_STANDIN_REALTIME', '1'))
+MAP_NAME = 'Town_standin'
+RING_RADII = np.arange(40.0, 640.0, 12.0)       # 50 concentric circular roads
+SPAWNS_PER_RING = 120
+SPAWN_CLEARANCE = 2.0                            # m; try_spawn_actor fails closer than this
+AUTOPILOT_SPEED = (6.0, 14.0)                    # m/s, one speed per road so lanes never overtake
+
+# ───────── Geometry ─────────
+
+class Vector3D(object):
+    def __init__(self, x=0.0, y=0.0, z=0.0):
+        self.x, self.y, self.z = float(x), float(y), float(z)
+
+    def __add__(self, o): return type(self)(self.x + o.x, self.y + o.y, self.z + o.z)
+    def __sub__(self, o): return type(self)(self.x - o.x, self.y - o.y, self.z - o.z)
+    def length(self): return math.sqrt(self.x ** 2 + self.y ** 2 + self.z ** 2)
+    def __repr__(self): return f"{type(self).__name__}(x={self.x:.2f}, y={self.y:.2f}, z={self.z:.2f})"
+
+class Location(Vector3D):
+    def distance(self, o): return (self - o).length()
+
+class Rotation(object):
+    def __init__(self, pitch=0.0, yaw=0.0, roll=0.0):
+        self.pitch, self.yaw, self.roll = float(pitch), float(yaw), float(roll)
+
+    def __repr__(self): return f"Rotation(pitch={self.pitch:.2f}, yaw={self.yaw:.2f}, roll={self.roll:.2f})"
+
+class Transform(object):
+    def __init__(self, location=None, rotation=None):
+        self.location = location if location is not None else Location()
+        self.rotation = rotation if rotation is not None else Rotation()
+
+    def __repr__(self): return f"Transform({self.location}, {self.rotation})"
+
+class VehicleControl(object):
+    def __init__(self, throttle=0.0, steer=0.0, brake=0.0, hand_brake=False, reverse=False, manual_gear_shift=False, gear=0):
+        self.throttle, self.steer, self.brake = throttle, steer, brake
+        self.hand_brake, self.reverse, self.manual_gear_shift, self.gear = hand_brake, reverse, manual_gear_shift, gear
+
+class WorldSettings(object):
+    def __init__(self, synchronous_mode=False, no_rendering_mode=False, fixed_delta_seconds=None):
+        self.synchronous_mode = synchronous_mode
+        self.no_rendering_mode = no_rendering_mode
+        self.fixed_delta_seconds = fixed_delta_seconds
+
+class command(object):
+    class DestroyActor(object):
+        def __init__(self, actor_id):
+            self.actor_id = actor_id.id if isinstance(actor_id, Actor) else actor_id
+
+    class ApplyTransform(object):
+        def __init__(self, actor_id, transform):
+            self.actor_id = actor_id.id if isinstance(actor_id, Actor) else actor_id
+            self.transform = transform
+
+# ───────── Blueprints ─────────
+
+class ActorAttribute(object):
+    def __init__(self, value, recommended_values=()):
+        self.value, self.recommended_values = value, list(recommended_values)
+
+    def __str__(self): return str(self.value)
+    def __int__(self): return int(self.value)
+
+class ActorBlueprint(object):
+    def __init__(self, id, **attributes):
+        self.id = id
+        self._attrs = {k: ActorAttribute(v[0], v) if isinstance(v, list) else ActorAttribute(v) for k, v in attributes.items()}
+
+    def has_attribute(self, name): return name in self._attrs
+    def get_attribute(self, name): return self._attrs[name]
+
+    def set_attribute(self, name, value):
+        attr = self._attrs.get(name)
+        self._attrs[name] = ActorAttribute(value, attr.recommended_values if attr else ())
+
+    @property
+    def tags(self): return self.id.split('.')
+
+class BlueprintLibrary(object):
+    def __init__(self, blueprints):
+        self._bps = list(blueprints)
+        self._by_id = {bp.id: bp for bp in self._bps}
+
+    def filter(self, pattern):
+        return [bp for bp in self._bps if fnmatch.fnmatch(bp.id, pattern)]
+
+    def find(self, id):
+        bp = self._by_id.get(id)
+        if bp is None and id.startswith(('vehicle.', 'walker.')):
+            # any model name the physical side reports is accepted
+            bp = self._by_id.setdefault(id, ActorBlueprint(id, color=list(_COLORS), generation='2'))
+        # blueprints are mutable per spawn in CARLA, so hand out a copy
+        return None if bp is None else ActorBlueprint(bp.id, **{k: a.recommended_values or a.value for k, a in bp._attrs.items()})
+
+    def __iter__(self): return iter(self._bps)
+    def __len__(self): return len(self._bps)
+
+_COLORS = ['255,255,255', '0,0,0', '200,20,20', '20,60,200', '120,120,120']
+_LIBRARY = BlueprintLibrary(
+    [ActorBlueprint(f'vehicle.{m}', color=list(_COLORS), generation=g, role_name='autopilot')
+     for m, g in (('tesla.model3', '2'), ('audi.a2', '1'), ('mercedes.coupe_2020', '2'), ('nissan.patrol', '1'),
+                  ('toyota.prius', '1'), ('lincoln.mkz_2020', '2'), ('mini.cooper_s', '1'), ('ford.mustang', '2'))] +
+    [ActorBlueprint(f'walker.pedestrian.{i:04d}', generation='2', role_name='pedestrian') for i in range(1, 9)] +
+    [ActorBlueprint('sensor.other.collision', role_name='front')])
+
+# ───────── Map ─────────
+
+class Waypoint(object):
+    def __init__(self, transform, road_id, lane_id, s):
+        self.transform, self.road_id, self.lane_id, self.s = transform, road_id, lane_id, s
+        self.id = road_id * 100000 + int(s * 10)
+
+class Map(object):
+    """Concentric circular one-lane roads around the origin."""
+
+    def __init__(self, name=MAP_NAME):
+        self.name = name
+
+    def get_spawn_points(self):
+        ang = np.linspace(0, 2 * np.pi, SPAWNS_PER_RING, endpoint=False)
+        return [Transform(Location(r * math.cos(a), r * math.sin(a), 0.5), Rotation(yaw=math.degrees(a) + 90.0))
+                for a in ang for r in RING_RADII]
+
+    def generate_waypoints(self, distance):
+        out = []
+        for road, r in enumerate(RING_RADII):
+            n = max(1, int(2 * math.pi * r / distance))
+            for i in range(n):
+                a = 2 * math.pi * i / n
+                out.append(Waypoint(Transform(Location(r * math.cos(a), r * math.sin(a), 0.0),
+                                              Rotation(yaw=math.degrees(a) + 90.0)), road, -1, a * r))
+        return out
+
+    def get_waypoint(self, location, project_to_road=True):
+        r = math.hypot(location.x, location.y)
+        road = int(np.argmin(np.abs(RING_RADII - r)))
+        R, a = RING_RADII[road], math.atan2(location.y, location.x) % (2 * math.pi)
+        return Waypoint(Transform(Location(R * math.cos(a), R * math.sin(a), 0.0), Rotation(yaw=math.degrees(a) + 90.0)),
+                        road, -1, a * R)
+
+    def to_opendrive(self):
+        return f'<OpenDRIVE><header name="{self.name}" rings="{len(RING_RADII)}" r0="{RING_RADII[0]}" dr="{RING_RADII[1] - RING_RADII[0]}"/></OpenDRIVE>'
+
+# ───────── Actors ─────────
+
+class Actor(object):
+    """Handle onto one row of the world's state arrays."""
+
+    def __init__(self, world, actor_id, slot, blueprint, parent=None):
+        self._world, self.id, self._slot = world, actor_id, slot
+        self.type_id = blueprint.id
+        self.attributes = {k: str(a.value) for k, a in blueprint._attrs.items()}
+        self.parent = parent
+        self.is_alive = True
+
+    def get_world(self): return self._world
+
+    def get_transform(self):
+        w, i = self._world, self._slot
+        x, y, z = w._pos[i]; p, yaw, r = w._rot[i]
+        return Transform(Location(x, y, z), Rotation(p, yaw, r))
+
+    def get_location(self): return self.get_transform().location
+    def get_velocity(self): return Vector3D(*self._world._vel[self._slot])
+
+    def set_transform(self, tf):
+        w, i = self._world, self._slot
+        w._pos[i] = (tf.location.x, tf.location.y, tf.location.z)
+        w._rot[i] = (tf.rotation.pitch, tf.rotation.yaw, tf.rotation.roll)
+        if w._autopilot[i]: w._retarget(np.array([i]))
+
+    def set_location(self, loc):
+        tf = self.get_transform(); tf.location = loc; self.set_transform(tf)
+
+    def set_target_velocity(self, v):
+        self._world._vel[self._slot] = (v.x, v.y, v.z)
+
+    def set_autopilot(self, enabled=True, tm_port=8000):
+        w, i = self._world, self._slot
+        w._autopilot[i] = bool(enabled)
+        if enabled: w._retarget(np.array([i]))
+
+    def apply_control(self, control): self._control = control
+    def set_simulate_physics(self, enabled=True): pass
+
+    def destroy(self):
+        if self.is_alive: self._world._remove(self)
+        return True
+
+class Sensor(Actor):
+    def listen(self, callback): self._callback = callback
+    def stop(self): self._callback = None
+    @property
+    def is_listening(self): return getattr(self, '_callback', None) is not None
+
+class Spectator(object):
+    """The free camera: only a transform, above the map origin until moved."""
+    def __init__(self): self._tf = Transform(Location(0.0, 0.0, 50.0), Rotation(-90.0, 0.0, 0.0))
+    def get_transform(self): return self._tf
+    def get_location(self): return self._tf.location
+    def set_transform(self, tf): self._tf = tf
+
+class ActorList(object):
+    def __init__(self, actors):
+        self._actors = actors       # id -> Actor (a live view of the world registry)
+
+    def filter(self, pattern):
+        return ActorList({i: a for i, a in self._actors.items() if fnmatch.fnmatch(a.type_id, pattern)})
+
+    def find(self, actor_id): return self._actors.get(actor_id)
+    def __iter__(self): return iter(list(self._actors.values()))
+    def __len__(self): return len(self._actors)
+
+# ───────── World ─────────
+
+class _Timestamp(object):
+    def __init__(self, frame, elapsed, delta):
+        self.frame, self.elapsed_seconds, self.delta_seconds = frame, elapsed, delta
+        self.platform_timestamp = time.time()
+
+class WorldSnapshot(object):
+    def __init__(self, frame, elapsed, delta):
+        self.frame, self.timestamp = frame, _Timestamp(frame, elapsed, delta)
+
+class World(object):
+
+    def __init__(self, capacity=1024, seed=0):
+        self._settings = WorldSettings()
+        self._map = Map()
+        self._rng = np.random.default_rng(seed)
+        self._actors, self._next_id, self._free = {}, 100, []
+        self._alloc(capacity)
+        self._frame, self._elapsed = 0, 0.0
+        self._wall0 = None
+        self._tick_callbacks = []
+        self._spectator = Spectator()
+
+    def _alloc(self, capacity):
+        old = getattr(self, '_pos', None)
+        n = 0 if old is None else len(old)
+        grow = lambda a, shape, dt=np.float64: np.concatenate([a, np.zeros(shape, dt)]) if a is not None else np.zeros(shape, dt)
+        extra = capacity - n
+        self._pos = grow(old, (extra, 3))
+        self._rot = grow(getattr(self, '_rot', None), (extra, 3))
+        self._vel = grow(getattr(self, '_vel', None), (extra, 3))
+        self._speed = grow(getattr(self, '_speed', None), (extra,))
+        self._radius = grow(getattr(self, '_radius', None), (extra,))
+        self._alive = grow(getattr(self, '_alive', None), (extra,), bool)
+        self._autopilot = grow(getattr(self, '_autopilot', None), (extra,), bool)
+        self._free.extend(range(capacity - 1, n - 1, -1))
+
+    # ---- settings / map / blueprints ----
+    def get_settings(self):
+        s = self._settings
+        return WorldSettings(s.synchronous_mode, s.no_rendering_mode, s.fixed_delta_seconds)
+
+    def apply_settings(self, settings):
+        self._settings = WorldSettings(settings.synchronous_mode, settings.no_rendering_mode, settings.fixed_delta_seconds)
+        return self._frame
+
+    def get_map(self): return self._map
+    def get_spectator(self): return self._spectator
+    def get_blueprint_library(self): return _LIBRARY
+    def on_tick(self, callback): self._tick_callbacks.append(callback); return len(self._tick_callbacks)
+
+    def get_random_location_from_navigation(self):
+        r, a = self._rng.choice(RING_RADII) + self._rng.uniform(4, 6), self._rng.uniform(0, 2 * np.pi)
+        return Location(r * math.cos(a), r * math.sin(a), 1.0)
+
+    def ground_projection(self, location, search_distance=5):
+        return Waypoint(Transform(Location(location.x, location.y, 0.0)), -1, -1, 0.0)
+
+    # ---- actors ----
+    def get_actors(self, actor_ids=None):
+        if actor_ids is None: return ActorList(self._actors)
+        return ActorList({i: self._actors[i] for i in actor_ids if i in self._actors})
+
+    def get_actor(self, actor_id): return self._actors.get(actor_id)
+
+    def try_spawn_actor(self, blueprint, transform, attach_to=None):
+        if blueprint is None: return None
+        loc = transform.location
+        if attach_to is None and not blueprint.id.startswith('sensor.'):
+            d = self._pos[self._alive] - (loc.x, loc.y, loc.z)
+            if len(d) and np.min(np.einsum('ij,ij->i', d, d)) < SPAWN_CLEARANCE ** 2:
+                return None
+        if not self._free: self._alloc(2 * len(self._pos))
+        slot = self._free.pop()
+        cls = Sensor if blueprint.id.startswith('sensor.') else Actor
+        actor = cls(self, self._next_id, slot, blueprint, parent=attach_to)
+        self._next_id += 1
+        self._alive[slot], self._autopilot[slot] = attach_to is None, False
+        self._pos[slot] = (loc.x, loc.y, loc.z)
+        self._rot[slot] = (transform.rotation.pitch, transform.rotation.yaw, transform.rotation.roll)
+        self._vel[slot] = 0.0
+        self._actors[actor.id] = actor
+        return actor
+
+    def spawn_actor(self, blueprint, transform, attach_to=None):
+        actor = self.try_spawn_actor(blueprint, transform, attach_to)
+        if actor is None: raise RuntimeError('Spawn failed because of collision at spawn position')
+        return actor
+
+    def _remove(self, actor):
+        actor.is_alive = False
+        self._actors.pop(actor.id, None)
+        self._alive[actor._slot] = self._autopilot[actor._slot] = False
+        self._free.append(actor._slot)
+
+    def _retarget(self, idx):
+        """Put autopilot vehicles on the circle through their current position."""
+        r = np.maximum(np.hypot(self._pos[idx, 0], self._pos[idx, 1]), 1.0)
+        lo, hi = AUTOPILOT_SPEED
+        self._radius[idx] = r
+        self._speed[idx] = lo + (hi - lo) * ((r * 0.618034) % 1.0)
+
+    # ---- simulation ----
+    def tick(self, seconds=10.0):
+        dt = self._settings.fixed_delta_seconds or 0.05
+        self._step(dt)
+        if REALTIME > 0:
+            # pace to wall-clock like a server rendering at fixed_delta_seconds
+            now = time.monotonic()
+            if self._wall0 is None: self._wall0 = now - self._elapsed / REALTIME
+            ahead = self._wall0 + self._elapsed / REALTIME - now
+            if ahead > 0: time.sleep(ahead)
+        return self._frame
+
+    def wait_for_tick(self, seconds=10.0):
+        self.tick(seconds)
+        return self.get_snapshot()
+
+    def _step(self, dt):
+        ap = np.flatnonzero(self._autopilot)
+        if len(ap):
+            pos, r, v = self._pos[ap], self._radius[ap], self._speed[ap]
+            theta = np.arctan2(pos[:, 1], pos[:, 0]) + v * dt / r
+            c, s = np.cos(theta), np.sin(theta)
+            self._pos[ap, 0], self._pos[ap, 1] = r * c, r * s
+            self._rot[ap, 1] = np.degrees(theta) + 90.0
+            self._vel[ap, 0], self._vel[ap, 1], self._vel[ap, 2] = -v * s, v * c, 0.0
+        free = np.flatnonzero(self._alive & ~self._autopilot)
+        if len(free):
+            self._pos[free] += self._vel[free] * dt
+        self._frame += 1
+        self._elapsed += dt
+        if self._tick_callbacks:
+            snap = self.get_snapshot()
+            for cb in self._tick_callbacks: cb(snap)
+
+    def get_snapshot(self):
+        return WorldSnapshot(self._frame, self._elapsed, self._settings.fixed_delta_seconds or 0.05)
+
+# ───────── Client / Traffic Manager ─────────
+
+class TrafficManager(object):
+    def __init__(self, port): self._port = port
+    def get_port(self): return self._port
+    def __getattr__(self, name):
+        # set_synchronous_mode, set_global_distance_to_leading_vehicle, ... have no effect here
+        return lambda *args, **kwargs: None
+
+_WORLDS = {}
+
+class Client(object):
+    """One in-process world per (host, port), so physical and twin stand-ins stay separate."""
+
+    def __init__(self, host='127.0.0.1', port=2000, worker_threads=0):
+        self._key = (host, port)
+        _WORLDS.setdefault(self._key, World())
+
+    def set_timeout(self, seconds): pass
+    def get_world(self): return _WORLDS[self._key]
+    def get_trafficmanager(self, port=8000): return TrafficManager(port)
+    def get_server_version(self): return 'standin'
+    def get_client_version(self): return 'standin'
+
+    def apply_batch(self, commands):
+        world = self.get_world()
+        for cmd in commands:
+            actor = world.get_actor(cmd.actor_id)
+            if actor is None: continue
+            if isinstance(cmd, command.DestroyActor): actor.destroy()
+            elif isinstance(cmd, command.ApplyTransform): actor.set_transform(cmd.transform)
+
+    def apply_batch_sync(self, commands, do_tick=False):
+        self.apply_batch(commands)
+        if do_tick: self.get_world().tick()
+        return []
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+"""
+NTP-style clock offset and drift estimation between a twin and its relay.
+
+The twin sends {'cmd': 'clock_ping', 't0'} to the relay; the relay answers
+{'cmd': 'clock_pong', 't0', 't1', 't2'} with its receive and send times, and the
+twin notes the arrival time t3:
+
+    offset = ((t1 - t0) + (t2 - t3)) / 2        (relay clock - twin clock)
+    delay  = (t3 - t0) - (t2 - t1)              (round trip without relay time)
+
+Only the lowest-delay samples of a sliding window are kept (they are the least
+distorted by queueing) and a line offset(t) = a + b * t is fitted through them,
+b being the drift. Each sample is within half its round trip of the true
+offset whatever the split between the two directions, so the error bound is
+half the largest round trip in the fit plus the fit residual. offset() stays 0
+until the estimate is further from 0 than that bound, i.e. until correcting is
+known to be better than not correcting.
+
+Both ends must stamp a ping or pong the moment it leaves or reaches the socket:
+a pong that waits behind state frames on the way out, or in the twin's frame
+loop on the way in, makes the two directions unequal and biases the offset. In
+Single_Server the pings therefore travel as JSON datagrams on a socket of their
+own, between a ClockResponder thread on the Scheduler (CLOCK_PORT) and a
+ClockPinger thread on the twin:
+
+    ClockResponder(('0.0.0.0', CLOCK_PORT))            # relay
+    ClockPinger(clock, (relay_host, CLOCK_PORT))       # twin
+"""
+import collections, json, math, socket, threading, time
+
+from Trace import now
+
+WINDOW = 64            # samples kept
+BEST_FRACTION = 0.25   # share of lowest-delay samples used for the fit
+MIN_SAMPLES = 3
+PING_INTERVAL = 1.0    # seconds
+CLOCK_PORT = 8997      # UDP port of the Scheduler's clock responder
+
+def make_ping():
+    return {'cmd': 'clock_ping', 't0': now()}
+
+def make_pong(ping, t1):
+    """Relay side: answer a ping received at t1."""
+    return {'cmd': 'clock_pong', 't0': ping['t0'], 't1': t1, 't2': now()}
+
+class ClockSync(object):
+
+    def __init__(self, window=WINDOW):
+        self.samples = collections.deque(maxlen=window)   # (t_local, offset, delay)
+        self._line = (0.0, 0.0, 0.0)                       # (a, b, t_ref), replaced whole by a pinger thread
+        self.error_bound = math.inf
+
+    @property
+    def ready(self):
+        return len(self.samples) >= MIN_SAMPLES
+
+    def on_pong(self, pong, t3=None):
+        t3 = now() if t3 is None else t3
+        t0, t1, t2 = pong['t0'], pong['t1'], pong['t2']
+        offset = ((t1 - t0) + (t2 - t3)) / 2
+        delay = (t3 - t0) - (t2 - t1)
+        self.samples.append(((t0 + t3) / 2, offset, delay))
+        self._fit()
+
+    def _fit(self):
+        best = sorted(self.samples, key=lambda s: s[2])
+        best = best[:max(MIN_SAMPLES, int(len(best) * BEST_FRACTION))]
+        ts = [s[0] for s in best]; offs = [s[1] for s in best]
+        t_ref = sum(ts) / len(ts)
+        a = sum(offs) / len(offs)
+        var_t = sum((t - t_ref) ** 2 for t in ts)
+        b = self._line[1]
+        if len(best) >= MIN_SAMPLES and var_t > 0:
+            b = sum((t - t_ref) * (o - a) for t, o in zip(ts, offs)) / var_t
+        rms = math.sqrt(sum((o - a - b * (t - t_ref)) ** 2 for t, o in zip(ts, offs)) / len(offs))
+        self.error_bound = max(0.0, max(s[2] for s in best)) / 2 + rms
+        self._line = (a, b, t_ref)
+
+    def estimate(self, t_local=None):
+        """Fitted relay clock - local clock at local time t_local, whether or not it is applied."""
+        a, b, t_ref = self._line
+        t_local = now() if t_local is None else t_local
+        return a + b * (t_local - t_ref)
+
+    def offset(self, t_local=None):
+        """Relay clock - local clock at local time t_local: the estimate once it is ready and
+        further from 0 than its error bound, 0 until then."""
+        if not self.ready: return 0.0
+        est = self.estimate(t_local)
+        return est if abs(est) > self.error_bound else 0.0
+
+    def to_local(self, t_remote, t_local=None):
+        """Map a relay-clock timestamp onto the local clock."""
+        return t_remote - self.offset(t_local)
+
+    def confidence(self):
+        est = self.estimate()
+        return {'offset_s': est, 'drift_ppm': self._line[1] * 1e6, 'error_bound_s': self.error_bound,
+                'samples': len(self.samples), 'ready': self.ready, 'applied': self.offset() != 0.0}
+
+class ClockResponder(object):
+    """Relay side: answers pings on a datagram socket of its own, stamping t1 as a ping arrives."""
+
+    def __init__(self, addr):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(addr)
+        self.pings = 0
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                data, peer = self.sock.recvfrom(2048)
+                t1 = now()
+                ping = json.loads(data)
+                if not (isinstance(ping, dict) and ping.get('cmd') == 'clock_ping'): continue
+                self.sock.sendto(json.dumps(make_pong(ping, t1)).encode(), peer)
+                self.pings += 1
+            except ValueError:
+                continue
+            except OSError:
+                return
+
+    def close(self):
+        self.sock.close()
+
+class ClockPinger(object):
+    """Twin side: pings a ClockResponder every interval and feeds each pong to clock, stamping t3 as it arrives.
+    addr may be set later, e.g. once the first datagram names the relay."""
+
+    def __init__(self, clock, addr=None, interval=PING_INTERVAL):
+        self.clock, self.addr, self.interval = clock, addr, interval
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.running = True
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while self.running:
+            deadline = now() + self.interval
+            try:
+                if self.addr is not None:
+                    self.sock.sendto(json.dumps(make_ping()).encode(), self.addr)
+                while now() < deadline:
+                    self.sock.settimeout(max(deadline - now(), 1e-3))
+                    try:
+                        data = self.sock.recv(2048)
+                    except socket.timeout:
+                        break
+                    t3 = now()
+                    pong = json.loads(data)
+                    if isinstance(pong, dict) and pong.get('cmd') == 'clock_pong': self.clock.on_pong(pong, t3)
+            except ValueError:
+                continue
+            except OSError:
+                if not self.running: return
+                time.sleep(self.interval)   # no route or port closed yet; try again next interval
+
+    def close(self):
+        self.running = False
+        self.sock.close()
@@ -1,9 +1,16 @@
 import socket
 import json
+import codecs
 import threading
-import paho.mqtt.client as mqtt
-import random
+import Pubsub
 import time  # simulate transmission delay
+from Udp_transport import UdpReceiver
+import Trace
+from Clock_sync import make_pong
+from Link_shaper import LinkShaper
+from Latency_hist import dump_histograms
+from Geo_tiles import TileTopics
+import Impairment
 
 # MQTT configuration
 MQTT_BROKER = "your mqtt.broker address"  
@@ -12,54 +19,164 @@ MQTT_USERNAME = "your mqtt username"
 MQTT_PASSWORD = "your mqtt password" 
 MQTT_CLIENT_ID = "carla_sender" 
 MQTT_TOPIC_PREFIX = "carla/publish" 
+CLOCK_TOPIC = "carla/clock"  # twins ping on {CLOCK_TOPIC}/ping/{id}, pongs go to {CLOCK_TOPIC}/pong/{id}
 
 # packet drop probability setting
 DROP_PACKET_PROBABILITY = 0.0
 
 # delay setting in seconds
 TRANSMISSION_DELAY = 0.15  # manageable delay for testing
-
-# initialize MQTT client
-mqtt_client = mqtt.Client(client_id=MQTT_CLIENT_ID)  
-mqtt_client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)  
-
-# configure TLS for secure connection
-mqtt_client.tls_set()  
-mqtt_client.connect(MQTT_BROKER, MQTT_PORT, 60)
-print(f"Connected to MQTTS broker at {MQTT_BROKER}:{MQTT_PORT}")
+# the delay is slept in the connection's thread, so one TCP connection carries at most
+# 1 / TRANSMISSION_DELAY messages per second; a faster sender's messages queue in the socket
+
+# bursty loss / time-varying delay instead of the two settings above, e.g. 'ge:0.01,0.2'
+# (Gilbert-Elliott) or 'trace:drive_test.csv' (timestamp, rtt, loss replay); see Impairment.py
+IMPAIRMENT = None
+impairment = None
+
+# also accept vehicle updates as UDP datagrams on the same port number
+UDP_INGRESS = True
+
+# link shaping: bytes/s towards the broker (None = unlimited) and service between
+# the spawn / collision / state classes ('strict' or 'wfq')
+LINK_RATE = None
+SHAPER_POLICY = 'strict'
+shaper = None
+
+# geo-tiled topics: {MQTT_TOPIC_PREFIX}/tile/<ix>/<iy>/<car_id> for tiles of TILE_SIZE metres
+# (None = the old {MQTT_TOPIC_PREFIX}/<car_id>), so twins can subscribe to a region only (Geo_tiles.py)
+TILE_SIZE = 200.0
+tile_topics = None
+
+# a car's model and color ride along again when it enters a tile and every SPAWN_REFRESH seconds,
+# so a twin that only subscribes to that region (or joined late) can still spawn it
+SPAWN_REFRESH = 2.0
+spawn_info = {}   # car_id -> {'model', 'color'} from its model packet
+car_tiles = {}    # car_id -> (tile, time its spawn info was last attached)
+
+# MQTT clients, connected by connect_broker() (CARLA_PUBSUB=local or inproc runs without a broker);
+# clock pings and pongs get a connection of their own so they never queue behind vehicle publishes
+mqtt_client = None
+clock_client = None
+
+
+def on_clock_ping(client, userdata, message):
+    """answer twin clock pings so twins can estimate this host's clock offset"""
+    t1 = Trace.now()
+    twin_id = message.topic.split('/')[-1]
+    pong = make_pong(json.loads(message.payload.decode('utf-8')), t1)
+    client.publish(f"{CLOCK_TOPIC}/pong/{twin_id}", json.dumps(pong))
+
+
+def connect_broker():
+    """connect to the pub/sub broker (TLS for a real MQTT broker) and answer clock pings"""
+    global mqtt_client, clock_client
+    mqtt_client = Pubsub.create_client(MQTT_CLIENT_ID)
+    Pubsub.connect(mqtt_client, MQTT_BROKER, MQTT_PORT, MQTT_USERNAME, MQTT_PASSWORD)
+    mqtt_client.loop_start()
+    clock_client = Pubsub.create_client(f"{MQTT_CLIENT_ID}_clock")
+    Pubsub.connect(clock_client, MQTT_BROKER, MQTT_PORT, MQTT_USERNAME, MQTT_PASSWORD)
+    clock_client.message_callback_add(f"{CLOCK_TOPIC}/ping/+", on_clock_ping)
+    clock_client.subscribe(f"{CLOCK_TOPIC}/ping/+")
+    clock_client.loop_start()
+
+
+def attach_spawn_info(vehicle_data, car_id, tile):
+    """add the cached model and color to a state message when the car changed tile or the refresh is due"""
+    now = time.monotonic()
+    if "model" in vehicle_data:
+        spawn_info[car_id] = {k: vehicle_data[k] for k in ("model", "color") if k in vehicle_data}
+        car_tiles[car_id] = (tile, now)
+        return
+    info = spawn_info.get(car_id)
+    if info is None:
+        return
+    last_tile, last = car_tiles.get(car_id, (None, 0.0))
+    if tile != last_tile or now - last >= SPAWN_REFRESH:
+        vehicle_data.update(info)
+        car_tiles[car_id] = (tile, now)
+
+
+def forward_vehicle_data(vehicle_data, addr):
+    """apply the configured impairments to one vehicle message and publish it to MQTT"""
+    Trace.stamp_message(vehicle_data, 'relay_in')
+    lost, delay = impairment.step()
+    # check if vehicle_data contains "model"
+    if "model" not in vehicle_data:
+        # simulate packet drop
+        if lost:
+            print(f"Dropped packet from {addr}: {vehicle_data}")
+            return  # drop current packet
+
+    # simulate delay
+    if delay > 0:
+        print(f"Simulating delay of {delay} seconds for {vehicle_data}")
+        time.sleep(delay)  # delay transmission
+
+    # mqtt topic based on vehicle ID, scoped by the tile the vehicle is in
+    car_id = vehicle_data.get("car_id", "unknown")  
+    if tile_topics is not None and "location" in vehicle_data:
+        location = vehicle_data["location"]
+        mqtt_topic, tile = tile_topics.topic(location["x"], location["y"], car_id)
+        attach_spawn_info(vehicle_data, car_id, tile)
+    else:
+        mqtt_topic = f"{MQTT_TOPIC_PREFIX}/{car_id}"
+
+    if shaper is not None:
+        # queue behind other messages on the shaped link; publish() runs when it gets its turn
+        if "model" in vehicle_data: cls = 'spawn'
+        elif vehicle_data.get("collision"): cls = 'collision'
+        else: cls = 'state'
+        if not shaper.enqueue(cls, len(json.dumps(vehicle_data)), (mqtt_topic, vehicle_data, addr)):
+            print(f"Shaper queue full, dropped {cls} message from {addr}")
+        return
+    publish(mqtt_topic, vehicle_data, addr)
+
+
+def publish(mqtt_topic, vehicle_data, addr):
+    # publish to MQTT
+    Trace.stamp_message(vehicle_data, 'relay_out')
+    mqtt_message = json.dumps(vehicle_data)  # ensure it's JSON format
+    mqtt_client.publish(mqtt_topic, mqtt_message)
+    print(f"Data from {addr} published to MQTT topic {mqtt_topic}: {vehicle_data}")
+
+
+def split_messages(buf, decoder=json.JSONDecoder()):
+    """complete JSON messages at the start of buf and the unparsed rest; messages may be
+    newline-delimited (Fleet_loadgen) or back to back (one per send() in Physical_Auto)"""
+    messages = []
+    while True:
+        buf = buf.lstrip()
+        if not buf:
+            return messages, buf
+        try:
+            message, end = decoder.raw_decode(buf)
+        except ValueError:
+            if '\n' not in buf:
+                return messages, buf  # wait for the rest of the message
+            bad, buf = buf.split('\n', 1)
+            print(f"Skipped malformed message: {bad[:80]!r}")
+            continue
+        messages.append(message)
+        buf = buf[end:]
 
 
 def handle_client(conn, addr):
     print(f"Connected to {addr}")
+    text = codecs.getincrementaldecoder('utf-8')()
+    buf = ''
     try:
         while True:
-            data = conn.recv(1024) 
+            data = conn.recv(65536)
             if not data:
                 break
 
-            # analyze received data (assuming JSON format)
-            vehicle_data = json.loads(data.decode('utf-8'))
-
-            # check if vehicle_data contains "model"
-            if "model" not in vehicle_data:
-                # simulate packet drop
-                if random.random() < DROP_PACKET_PROBABILITY:
-                    print(f"Dropped packet from {addr}: {vehicle_data}")
-                    continue  # drop current packet
-
-            # simulate delay
-            if TRANSMISSION_DELAY > 0:
-                print(f"Simulating delay of {TRANSMISSION_DELAY} seconds for {vehicle_data}")
-                time.sleep(TRANSMISSION_DELAY)  # delay transmission
-
-            # mqtt topic based on vehicle ID
-            car_id = vehicle_data.get("car_id", "unknown")  
-            mqtt_topic = f"{MQTT_TOPIC_PREFIX}/{car_id}"
-
-            # publish to MQTT
-            mqtt_message = json.dumps(vehicle_data)  # ensure it's JSON format
-            mqtt_client.publish(mqtt_topic, mqtt_message)
-            print(f"Data from {addr} published to MQTT topic {mqtt_topic}: {vehicle_data}")
+            # one read may hold several messages or part of one, so buffer and split
+            messages, buf = split_messages(buf + text.decode(data))
+            for vehicle_data in messages:
+                forward_vehicle_data(vehicle_data, addr)
+        if buf:
+            print(f"Incomplete message from {addr} discarded: {buf[:80]!r}")
     except Exception as e:
         print(f"Connection error with {addr}: {e}")
     finally:
@@ -67,12 +184,42 @@ def handle_client(conn, addr):
         conn.close()
 
 
+def handle_datagrams(host, port):
+    """receive sequenced vehicle datagrams; late ones are discarded instead of queueing behind newer ones"""
+    receiver = UdpReceiver((host, port))
+    print(f"UDP ingress running on {host}:{port}")
+    while True:
+        addr, seq, t_send, payload = receiver.recv()
+        vehicle_data = json.loads(payload.decode('utf-8'))
+        # delay each datagram independently, a slow one must not hold back the next
+        if impairment.may_delay:
+            threading.Thread(target=forward_vehicle_data, args=(vehicle_data, addr), daemon=True).start()
+        else:
+            forward_vehicle_data(vehicle_data, addr)
+        if seq % 100 == 0:
+            print(f"UDP ingress stats: {receiver.stats}")
+
+
 def start_server(host='127.0.0.1', port=5005):
     """start the TCP server to receive vehicle data"""
+    global shaper, impairment, tile_topics
+    if mqtt_client is None:
+        connect_broker()
+    if TILE_SIZE:
+        tile_topics = TileTopics(MQTT_TOPIC_PREFIX, TILE_SIZE)
+        print(f"Publishing on {MQTT_TOPIC_PREFIX}/tile/<ix>/<iy>/<car_id> ({TILE_SIZE:g} m tiles)")
+    impairment = Impairment.from_spec(IMPAIRMENT, DROP_PACKET_PROBABILITY, TRANSMISSION_DELAY)
+    if IMPAIRMENT:
+        print(f"Impairment: {impairment.describe()}")
+    if LINK_RATE:
+        shaper = LinkShaper(LINK_RATE, lambda item: publish(*item), policy=SHAPER_POLICY)
+        print(f"Shaping the broker link to {LINK_RATE:.0f} bytes/s ({SHAPER_POLICY})")
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.bind((host, port))
     server_socket.listen(10) 
     print(f"Server running on {host}:{port}")
+    if UDP_INGRESS:
+        threading.Thread(target=handle_datagrams, args=(host, port), daemon=True).start()
 
     try:
         while True:
@@ -83,6 +230,12 @@ def start_server(host='127.0.0.1', port=5005):
         print("Server shutting down...")
     finally:
         server_socket.close()
+        if shaper is not None:
+            summary = shaper.summary()
+            dump_histograms('bridge_shaper.json', {c: shaper.delay[c] for c in shaper.delay}, shaper=summary)
+            print(f"Shaper: {summary}")
+        if IMPAIRMENT:
+            print(f"Impairment: {impairment.describe()}")
 
 
 if __name__ == "__main__":
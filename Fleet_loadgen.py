@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+"""
+Synthetic fleet load generator for the ComDef_Syn_by_MQTT bridge.
+
+Mimics N Physical_Auto.py instances without CARLA or pygame: every simulated
+vehicle is an asyncio task that sends its 'model' packet on a short-lived TCP
+connection (as extract_vehicle_info does) and then streams state updates with
+the World.send_vehicle_updates schema on its own connection (or as datagrams
+with --transport udp), following a synthetic trajectory. TCP messages end in a
+newline, so the bridge can split messages that arrive in one read. The bridge
+sleeps TRANSMISSION_DELAY after each message in the connection's thread, so a
+TCP vehicle faster than 1 / TRANSMISSION_DELAY Hz (6.7 Hz at the default
+0.15 s) queues behind itself and its latency grows for the whole run.
+
+A subscriber stand-in in the same process listens on carla/publish/# at the
+broker, so delivered rate, delivery ratio and per-hop latency (the capture and
+send stamps share this host's clock) are measured without a twin:
+
+    python ComDef_Syn_by_MQTT.py &
+    python Fleet_loadgen.py -n 500 --rate 10 --duration 60 --broker broker.example --tls
+
+or fully offline, with the Pubsub local broker in place of MQTT:
+
+    python Pubsub.py &
+    CARLA_PUBSUB=local python ComDef_Syn_by_MQTT.py &
+    CARLA_PUBSUB=local python Fleet_loadgen.py -n 500 --rate 10
+
+With --roi x_min,y_min,x_max,y_max the subscriber only takes the geo-tiled
+topics of that region (Geo_tiles.py), like a twin with a region of interest;
+the report then shows what such a receiver pays compared to the fleet's rate.
+"""
+import argparse, asyncio, json, math, random, threading, time
+
+import Pubsub
+from Udp_transport import UdpSender
+from Geo_tiles import RoiSubscription, ROI_MARGIN
+from ComDef_Syn_by_MQTT import TRANSMISSION_DELAY
+import Trace
+
+BRIDGE = ('127.0.0.1', 5005)
+TOPIC = 'carla/publish/#'
+MODELS = ['vehicle.tesla.model3', 'vehicle.audi.a2', 'vehicle.lincoln.mkz_2020', 'vehicle.mini.cooper_s']
+COLORS = ['255,255,255', '0,0,0', '200,20,20', '20,60,200']
+MODEL_SETTLE = 0.2     # seconds between the model packet and the first update, like send_to_carla2
+
+# ───────── Trajectories ─────────
+
+def circle(i, t, speed):
+    r = 30.0 + 4.0 * (i % 50)
+    a = speed * t / r + i
+    return (r * math.cos(a), r * math.sin(a), 0.5), math.degrees(a) + 90.0, (-speed * math.sin(a), speed * math.cos(a), 0.0)
+
+def line(i, t, speed):
+    y = 4.0 * i
+    return (speed * t, y, 0.5), 0.0, (speed, 0.0, 0.0)
+
+_walk = {}   # vehicle -> (x, y, yaw, t)
+
+def random_walk(i, t, speed):
+    x, y, yaw, t_prev = _walk.get(i, (0.0, 4.0 * i, 0.0, t))
+    yaw += random.uniform(-5, 5)
+    dt = t - t_prev
+    x += speed * dt * math.cos(math.radians(yaw)); y += speed * dt * math.sin(math.radians(yaw))
+    _walk[i] = (x, y, yaw, t)
+    return (x, y, 0.5), yaw, (speed * math.cos(math.radians(yaw)), speed * math.sin(math.radians(yaw)), 0.0)
+
+TRAJECTORIES = {'circle': circle, 'line': line, 'random': random_walk}
+
+# ───────── Messages ─────────
+
+def state_message(car_id, pos, yaw, vel, model=None):
+    """Same fields as Physical_Auto's vehicle_info / vehicle_state."""
+    msg = {'car_id': car_id}
+    if model:
+        msg['model'], msg['color'] = model, random.choice(COLORS)
+    msg.update({
+        'location': {'x': pos[0], 'y': pos[1], 'z': pos[2]},
+        'rotation': {'pitch': 0.0, 'yaw': yaw, 'roll': 0.0},
+        'velocity': {'x': vel[0], 'y': vel[1], 'z': vel[2]},
+        'collision': 0.0,
+        'trace': {'capture': Trace.now()},
+    })
+    return json.dumps(Trace.stamp_message(msg, 'send')).encode('utf-8')
+
+# ───────── Fleet ─────────
+
+class Fleet(object):
+
+    def __init__(self, n, rate, duration, trajectory='circle', transport='tcp', ramp=1.0, prefix='loadgen'):
+        self.n, self.period, self.duration = n, 1.0 / rate, duration
+        self.trajectory = TRAJECTORIES[trajectory]
+        self.transport, self.ramp, self.prefix = transport, ramp, prefix
+        self.sent = 0
+        self.errors = 0
+        self.late = 0          # updates sent more than one period behind schedule
+        self.disconnects = 0   # update streams the bridge closed before the end of the run
+
+    async def vehicle(self, i):
+        car_id = f"{self.prefix}_{i}"
+        speed = random.uniform(5.0, 15.0)
+        await asyncio.sleep(self.ramp * i / self.n)
+        t0 = time.monotonic()
+        try:
+            # model packet on its own connection, then the update stream
+            _, w = await asyncio.open_connection(*BRIDGE)
+            pos, yaw, vel = self.trajectory(i, 0.0, speed)
+            w.write(state_message(car_id, pos, yaw, (0.0, 0.0, 0.0), model=random.choice(MODELS)) + b'\n')
+            await w.drain(); w.close()
+            self.sent += 1
+            await asyncio.sleep(MODEL_SETTLE)
+            if self.transport == 'udp':
+                sock = UdpSender(BRIDGE)
+                send = lambda blob: sock.send(blob)
+            else:
+                r, w = await asyncio.open_connection(*BRIDGE)
+                send = lambda blob: w.write(blob + b'\n')
+            k = 0
+            while True:
+                k += 1
+                due = t0 + MODEL_SETTLE + k * self.period
+                now = time.monotonic()
+                if now - t0 > self.duration: break
+                if due > now: await asyncio.sleep(due - now)
+                elif now - due > self.period: self.late += 1
+                if self.transport != 'udp' and r.at_eof():
+                    # the bridge never writes back, so EOF means it closed the stream
+                    self.disconnects += 1
+                    print(f"[Loadgen] {car_id}: bridge closed the connection after {k - 1} updates")
+                    break
+                pos, yaw, vel = self.trajectory(i, time.monotonic() - t0, speed)
+                send(state_message(car_id, pos, yaw, vel))
+                if self.transport != 'udp': await w.drain()
+                self.sent += 1
+            if self.transport == 'udp': sock.close()
+            else: w.close()
+        except OSError as e:
+            self.errors += 1
+            print(f"[Loadgen] {car_id}: {e}")
+
+    async def run(self):
+        await asyncio.gather(*(self.vehicle(i) for i in range(self.n)))
+
+# ───────── Subscriber stand-in ─────────
+
+class Subscriber(object):
+    """Counts what the bridge delivers and records per-hop latency, in place of a twin."""
+
+    def __init__(self, trace_path='latency_trace_loadgen.json'):
+        self.trace = Trace.TraceCollector(trace_path)
+        self.lock = threading.Lock()
+        self.received = 0
+        self.cars = set()
+        self.first = self.last = None
+        self.roi = None
+
+    def on_message(self, client, userdata, message):
+        t_recv = Trace.now()
+        try:
+            msg = json.loads(message.payload.decode('utf-8'))
+        except ValueError:
+            return
+        with self.lock:
+            self.received += 1
+            self.cars.add(message.topic.rsplit('/', 1)[-1])
+            if self.first is None: self.first = t_recv
+            self.last = t_recv
+            if 'trace' in msg:
+                msg['trace']['receive'] = msg['trace']['apply'] = t_recv
+                self.trace.record(msg['trace'])
+
+def connect_subscriber(sub, args):
+    client = Pubsub.create_client(f"loadgen_sub_{random.randint(0, 1 << 16)}")
+    client.on_message = sub.on_message
+    Pubsub.connect(client, args.broker, args.port, args.username, args.password, args.tls)
+    if args.roi:
+        sub.roi = RoiSubscription(client, TOPIC[:-2], [float(v) for v in args.roi.split(',')], args.roi_margin)
+    else:
+        client.subscribe(TOPIC)
+    client.loop_start()
+    return client
+
+# ───────── Entry Point ─────────
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--vehicles', type=int, default=100)
+    parser.add_argument('--rate', type=float, default=5.0, help='state updates per second per vehicle')
+    parser.add_argument('--duration', type=float, default=30.0)
+    parser.add_argument('--trajectory', choices=sorted(TRAJECTORIES), default='circle')
+    parser.add_argument('--transport', choices=['tcp', 'udp'], default='tcp')
+    parser.add_argument('--ramp', type=float, default=1.0, help='seconds over which vehicles start')
+    parser.add_argument('--bridge', default='127.0.0.1:5005')
+    parser.add_argument('--broker', default='localhost')
+    parser.add_argument('--port', type=int, default=1883)
+    parser.add_argument('--tls', action='store_true')
+    parser.add_argument('--username'); parser.add_argument('--password')
+    parser.add_argument('--roi', metavar='X0,Y0,X1,Y1', help='subscribe to the tiles of this region only')
+    parser.add_argument('--roi-margin', type=float, default=ROI_MARGIN)
+    parser.add_argument('--drain', type=float, default=2.0, help='seconds to keep receiving after the last send')
+    parser.add_argument('--out', default='loadgen_report.json')
+    args = parser.parse_args()
+
+    host, port = args.bridge.rsplit(':', 1)
+    BRIDGE = (host, int(port))
+    sub = Subscriber()
+    client = connect_subscriber(sub, args)
+    fleet = Fleet(args.vehicles, args.rate, args.duration, args.trajectory, args.transport, args.ramp)
+    if args.transport == 'tcp' and TRANSMISSION_DELAY and args.rate * TRANSMISSION_DELAY > 1.0:
+        print(f"[Loadgen] warning: a bridge with TRANSMISSION_DELAY = {TRANSMISSION_DELAY:g} s relays at most "
+              f"{1.0 / TRANSMISSION_DELAY:.1f} updates/s per TCP connection; --rate {args.rate:g} will queue")
+
+    print(f"[Loadgen] {args.vehicles} vehicles x {args.rate:g} Hz -> {args.bridge} ({args.transport}), "
+          f"subscribed to {sub.roi.summary() if sub.roi else TOPIC} at {args.broker}:{args.port}")
+    t_start = time.monotonic()
+    try:
+        asyncio.run(fleet.run())
+        time.sleep(args.drain)
+    except KeyboardInterrupt:
+        print("[Loadgen] interrupted")
+    finally:
+        client.loop_stop(); client.disconnect()
+        elapsed = time.monotonic() - t_start
+        with sub.lock:
+            window = (sub.last - sub.first) if sub.received > 1 else None
+            report = {
+                'vehicles': args.vehicles, 'rate': args.rate, 'transport': args.transport, 'duration': elapsed,
+                'sent': fleet.sent, 'send_rate': fleet.sent / elapsed, 'late': fleet.late, 'errors': fleet.errors,
+                'disconnects': fleet.disconnects,
+                'received': sub.received, 'cars_seen': len(sub.cars),
+                'delivered_rate': (sub.received - 1) / window if window else None,
+                'delivery_ratio': sub.received / fleet.sent if fleet.sent else None,
+                'latency_ms': sub.trace.summary(),
+            }
+            if sub.roi is not None:
+                report['roi'] = sub.roi.summary()
+            sub.trace.dump()
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=1)
+        e2e = report['latency_ms']['end_to_end']
+        print(f"[Loadgen] sent {fleet.sent} ({report['send_rate']:.0f}/s), received {sub.received} "
+              f"({report['delivered_rate'] or 0:.0f}/s, ratio {report['delivery_ratio'] or 0:.3f}), "
+              f"e2e p50 {e2e.get('p50')} ms p99 {e2e.get('p99')} ms -> {args.out}")
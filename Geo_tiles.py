@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""
+Geo-tiled topics for the MQTT path.
+
+The bridge publishes every vehicle message on the topic of the map tile its
+location falls in:
+
+    <prefix>/tile/<ix>/<iy>/<car_id>        ix = floor(x / TILE_SIZE), iy = floor(y / TILE_SIZE)
+
+The car id stays the last topic level, so `carla/#` subscribers and code that
+takes the car id from the end of the topic keep working. The lookup is two
+floor divisions and a dict hit for the cached tile prefix.
+
+A receiver that only needs part of the map keeps a RoiSubscription: one
+`<prefix>/tile/<ix>/<iy>/+` filter per tile overlapping its region of interest
+grown by a margin. When the region moves, only the tiles it enters and leaves
+are (un)subscribed, so the broker stops delivering everything else:
+
+    roi = RoiSubscription(client, 'carla/publish', (0, 0, 400, 400))
+    roi.centre(x, y, 300)       # e.g. follow one car
+"""
+import threading
+
+TILE_SIZE = 200.0     # metres
+ROI_MARGIN = 50.0     # metres added around a region of interest, so cars just outside it are already spawned
+
+class TileTopics(object):
+    """Tile-scoped topic of a location, with the per-tile prefix cached."""
+
+    def __init__(self, prefix, size=TILE_SIZE):
+        self.prefix, self.size = prefix, size
+        self._bases = {}    # tile -> '<prefix>/tile/<ix>/<iy>/'
+
+    def tile(self, x, y):
+        return int(x // self.size), int(y // self.size)
+
+    def topic(self, x, y, car_id):
+        """(topic, tile) for a car at (x, y)."""
+        key = (int(x // self.size), int(y // self.size))
+        base = self._bases.get(key)
+        if base is None:
+            base = self._bases[key] = f"{self.prefix}/tile/{key[0]}/{key[1]}/"
+        return base + car_id, key
+
+def roi_tiles(roi, margin=ROI_MARGIN, size=TILE_SIZE):
+    """Tiles overlapping roi = (x_min, y_min, x_max, y_max) grown by margin."""
+    x0, y0, x1, y1 = roi
+    return {(ix, iy) for ix in range(int((x0 - margin) // size), int((x1 + margin) // size) + 1)
+            for iy in range(int((y0 - margin) // size), int((y1 + margin) // size) + 1)}
+
+class RoiSubscription(object):
+    """Keeps a pub/sub client subscribed to exactly the tiles of a moving region of interest."""
+
+    def __init__(self, client, prefix, roi=None, margin=ROI_MARGIN, size=TILE_SIZE):
+        self.client, self.prefix, self.margin, self.size = client, prefix, margin, size
+        self.tiles = set()
+        self.roi = None
+        self.moves = 0
+        self.lock = threading.Lock()
+        if roi is not None:
+            self.move(roi)
+
+    def filter(self, tile):
+        return f"{self.prefix}/tile/{tile[0]}/{tile[1]}/+"
+
+    def move(self, roi):
+        """Subscribe to the tiles the region enters and drop those it leaves; returns (added, removed)."""
+        tiles = roi_tiles(roi, self.margin, self.size)
+        with self.lock:
+            self.roi = tuple(roi)
+            if tiles == self.tiles: return 0, 0
+            added, removed = tiles - self.tiles, self.tiles - tiles
+            for tile in added: self.client.subscribe(self.filter(tile))
+            for tile in removed: self.client.unsubscribe(self.filter(tile))
+            self.tiles = tiles
+            self.moves += 1
+        return len(added), len(removed)
+
+    def centre(self, x, y, radius):
+        return self.move((x - radius, y - radius, x + radius, y + radius))
+
+    def summary(self):
+        return {'roi': self.roi, 'margin': self.margin, 'tile_size': self.size, 'tiles': len(self.tiles), 'moves': self.moves}
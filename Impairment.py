@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+"""
+Pluggable loss / latency models for the bridge and the Scheduler.
+
+Every model has step(now) -> (drop, delay): called once per message in arrival
+order, it decides whether the message is lost and how many seconds it is held
+back. Models are chosen with a spec string:
+
+    fixed:<p>[,<delay>]              i.i.d. loss with probability p, constant delay (the old behaviour)
+    ge:<p_gb>,<p_bg>[,<loss_bad>[,<loss_good>]][@<delay>]
+                                     Gilbert-Elliott two-state loss: per message the channel moves
+                                     good -> bad with p_gb and bad -> good with p_bg, and loses the
+                                     message with loss_good / loss_bad (default 0 / 1)
+    trace:<file.csv>[,once]          replay of a recorded trace with rows "timestamp, rtt, loss"
+                                     (seconds, milliseconds, 0/1 flag or loss probability)
+
+A trace is converted once into a binary file next to it (<file>.imp, three
+float64 per row) that is memory-mapped, so multi-hour traces cost no memory.
+The replay clock starts with the first message; a cursor only moves forward
+(wrapping at the end unless 'once'), so a step is O(1) amortized. The one-way
+delay of a trace row is rtt / 2.
+"""
+import mmap, os, random, struct, threading, time
+import numpy as np
+
+ROW = struct.Struct('<3d')     # timestamp (s), rtt (ms), loss
+
+class FixedImpairment(object):
+    """i.i.d. loss and a constant delay."""
+
+    def __init__(self, drop_probability=0.0, delay=0.0, seed=None):
+        self.p, self.delay = float(drop_probability), float(delay)
+        self.may_delay = self.delay > 0
+        self.rng = random.Random(seed)
+
+    def step(self, now=None):
+        return self.p > 0 and self.rng.random() < self.p, self.delay
+
+    def describe(self):
+        return {'model': 'fixed', 'drop_probability': self.p, 'delay': self.delay}
+
+class GilbertElliott(object):
+    """Two-state Markov loss channel: long loss bursts in the bad state, few losses in the good one."""
+
+    def __init__(self, p_gb, p_bg, loss_bad=1.0, loss_good=0.0, delay=0.0, seed=None):
+        self.p_gb, self.p_bg, self.loss_bad, self.loss_good = float(p_gb), float(p_bg), float(loss_bad), float(loss_good)
+        self.delay = float(delay)
+        self.may_delay = self.delay > 0
+        self.rng = random.Random(seed)
+        self.bad = False
+        self.lock = threading.Lock()
+        self.counts = {'good': 0, 'bad': 0}
+
+    def step(self, now=None):
+        with self.lock:
+            r = self.rng.random()
+            self.bad = r >= self.p_bg if self.bad else r < self.p_gb
+            self.counts['bad' if self.bad else 'good'] += 1
+            return self.rng.random() < (self.loss_bad if self.bad else self.loss_good), self.delay
+
+    def describe(self):
+        # stationary share of bad-state messages and the resulting mean loss
+        pi_bad = self.p_gb / (self.p_gb + self.p_bg) if self.p_gb + self.p_bg > 0 else 0.0
+        return {'model': 'gilbert_elliott', 'p_gb': self.p_gb, 'p_bg': self.p_bg, 'loss_bad': self.loss_bad,
+                'loss_good': self.loss_good, 'delay': self.delay, 'mean_loss': pi_bad * self.loss_bad +
+                (1 - pi_bad) * self.loss_good, 'mean_burst': 1 / self.p_bg if self.p_bg else None, 'states': dict(self.counts)}
+
+def compile_trace(csv_path, out_path=None):
+    """Streams a "timestamp, rtt, loss" CSV into the binary row file; lines that are not numeric are skipped."""
+    out_path = out_path or csv_path + '.imp'
+    rows = 0
+    with open(csv_path) as src, open(out_path + '.tmp', 'wb') as dst:
+        for line in src:
+            fields = line.replace(';', ',').split(',')
+            try:
+                ts, rtt = float(fields[0]), float(fields[1])
+                loss = float(fields[2]) if len(fields) > 2 and fields[2].strip() else 0.0
+            except (ValueError, IndexError):
+                continue    # header or comment
+            dst.write(ROW.pack(ts, rtt, loss))
+            rows += 1
+    if not rows:
+        os.remove(out_path + '.tmp')
+        raise ValueError(f"no 'timestamp, rtt, loss' rows in {csv_path}")
+    os.replace(out_path + '.tmp', out_path)
+    return out_path
+
+class TraceImpairment(object):
+    """Loss and delay replayed from a recorded trace on a memory-mapped row file."""
+
+    def __init__(self, path, loop=True, seed=None):
+        rows = path if path.endswith('.imp') else path + '.imp'
+        if not path.endswith('.imp') and (not os.path.exists(rows) or os.path.getmtime(rows) < os.path.getmtime(path)):
+            compile_trace(path, rows)
+        self.path, self.loop = path, loop
+        self.may_delay = True
+        with open(rows, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.n = len(self.mm) // ROW.size
+        self.t_first = ROW.unpack_from(self.mm, 0)[0]
+        self.span = ROW.unpack_from(self.mm, (self.n - 1) * ROW.size)[0] - self.t_first
+        self.t_next = self._ts(1)
+        self.cursor, self.t0, self.wraps = 0, None, 0
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def _ts(self, i):
+        return ROW.unpack_from(self.mm, i * ROW.size)[0] if i < self.n else float('inf')
+
+    def step(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            if self.t0 is None: self.t0 = now
+            elapsed = now - self.t0
+            if self.loop and self.span > 0 and elapsed >= (self.wraps + 1) * self.span:
+                self.wraps = int(elapsed // self.span)
+                self.cursor, self.t_next = 0, self._ts(1)
+            t = self.t_first + elapsed - self.wraps * self.span
+            while self.t_next <= t:
+                self.cursor += 1
+                self.t_next = self._ts(self.cursor + 1)
+            _, rtt, loss = ROW.unpack_from(self.mm, self.cursor * ROW.size)
+        drop = loss >= 1.0 or (loss > 0 and self.rng.random() < loss)
+        return drop, rtt / 2e3
+
+    def describe(self):
+        rows = np.frombuffer(self.mm, '<f8').reshape(-1, 3)
+        return {'model': 'trace', 'path': self.path, 'rows': self.n, 'span_s': self.span, 'loop': self.loop,
+                'mean_loss': float(rows[:, 2].mean()), 'mean_delay': float(rows[:, 1].mean()) / 2e3}
+
+def from_spec(spec, drop_probability=0.0, delay=0.0, seed=None):
+    """Impairment model for a spec string; no spec keeps the i.i.d. loss and constant delay given."""
+    if not spec:
+        return FixedImpairment(drop_probability, delay, seed)
+    kind, _, arg = spec.partition(':')
+    if kind == 'fixed':
+        p, _, d = arg.partition(',')
+        return FixedImpairment(float(p or 0), float(d or 0), seed)
+    if kind == 'ge':
+        arg, _, d = arg.partition('@')
+        params = [float(x) for x in arg.split(',')]
+        if not 2 <= len(params) <= 4:
+            raise ValueError(f"ge needs p_gb,p_bg[,loss_bad[,loss_good]], got {arg!r}")
+        return GilbertElliott(*params, delay=float(d) if d else delay, seed=seed)
+    if kind == 'trace':
+        path, _, mode = arg.partition(',')
+        return TraceImpairment(path, loop=mode != 'once', seed=seed)
+    raise ValueError(f"unknown impairment model {spec!r}")
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+"""
+Lane-coordinate compression of vehicle poses.
+
+Vehicles mostly drive along lane centrelines, so a pose near a lane is sent as
+
+    (lane, s, offset, height, speed)    lane index, metres along it, metres left
+                                        of the centreline, metres above the lane
+                                        surface, signed speed along the lane
+
+packed into 18 bytes instead of world loc, rot and vel. The receiver rebuilds
+loc and the lane direction (yaw and pitch, roll 0), plus a velocity along that
+direction. The encoder decodes what it sends: a pose that would come back more
+than MAX_XY_ERR away, or heading more than MAX_YAW_ERR off, is sent raw, and so
+is every pose farther than MAX_OFFSET from a lane (off-road for the codec).
+
+The LaneIndex holds the centrelines as polylines sampled every LANE_SPACING
+metres from world.get_map().generate_waypoints(). Lanes are oriented the way
+traffic drives. A grid of CELL_SIZE cells lists every segment within MAX_OFFSET
+of each cell, so one frame is projected onto its candidate segments in a few
+numpy passes. The waypoints come from the Map_index cache and the lane index,
+grid included, is cached next to it in CACHE_DIR under <town>_<OpenDRIVE hash>.
+The sender puts that key in its init packet and the twin loads the same index.
+
+    codec = LaneCodec(LaneIndex.for_map(world.get_map()))
+    frame = codec.encode(entities)      # sender
+    codec.decode(frame)                 # twin, in place
+"""
+import os, pickle
+import numpy as np
+from Map_index import CACHE_DIR, MapIndex, map_key
+
+LANE_SPACING = 2.0      # metres between centreline samples
+CELL_SIZE = 10.0        # metres per grid cell of the segment index
+MAX_OFFSET = 2.0        # metres from the centreline beyond which a pose is sent raw
+MAX_XY_ERR = 0.02       # metres of horizontal reconstruction error beyond which a pose is sent raw
+MAX_YAW_ERR = 5.0       # degrees between heading and lane direction beyond which a pose is sent raw
+MAX_HEIGHT = 1.0        # metres between the pose and the lane surface beyond which a pose is sent raw (bridges, ramps)
+MAX_Z_ERR = 0.01        # metres of vertical reconstruction error beyond which a pose is sent raw
+SAMPLE_EVERY = 50       # frames between compression-ratio samples (pickles the raw frame as well)
+LANE_DTYPE = np.dtype([('lane', '<u4'), ('s', '<f4'), ('offset', '<f4'), ('height', '<f2'), ('speed', '<f4')])
+POSE_FIELDS = ('loc', 'rot', 'vel')
+_ROW = 1 << 32          # cell key = cx * _ROW + cy
+
+class LaneIndex(object):
+
+    def __init__(self, key, pts, lane_first, spacing=LANE_SPACING, grid=None):
+        self.key, self.spacing = key, spacing
+        self.pts = np.asarray(pts, dtype=np.float64)            # centreline samples, lane after lane
+        self.lane_first = np.asarray(lane_first, dtype=np.int64)    # lane -> first sample, plus the end
+        lane_of = np.repeat(np.arange(len(self.lane_first) - 1), np.diff(self.lane_first))
+        d = np.diff(self.pts, axis=0)
+        length = np.hypot(d[:, 0], d[:, 1])
+        same = lane_of[1:] == lane_of[:-1]
+        cum = np.concatenate([[0.0], np.cumsum(np.where(same, length, 0.0))])
+        self.cum = cum - cum[self.lane_first[:-1]][lane_of]         # metres along the own lane
+        lane_len = self.cum[self.lane_first[1:] - 1]
+        self.base = np.concatenate([[0.0], np.cumsum(lane_len + 1.0)])[:-1]
+        self.gcum = self.cum + self.base[lane_of]                   # increasing over all samples: one searchsorted
+        self.lane_of = lane_of
+        # a segment runs from sample i to i + 1 of the same lane; gaps in a lane are no segments
+        self.seg = np.flatnonzero(same & (length > 1e-6) & (length <= 3 * spacing))
+        self.seg_a, self.seg_d, self.seg_len = self.pts[self.seg], d[self.seg], length[self.seg]
+        self.seg_yaw = np.degrees(np.arctan2(self.seg_d[:, 1], self.seg_d[:, 0]))
+        if grid is None: self._build_grid()
+        else: self.cell_keys, self.cell_segs, self.cell_start = grid
+
+    def _build_grid(self):
+        a, b = self.seg_a[:, :2], self.seg_a[:, :2] + self.seg_d[:, :2]
+        lo = np.floor((np.minimum(a, b) - MAX_OFFSET) / CELL_SIZE).astype(np.int64).tolist()
+        hi = np.floor((np.maximum(a, b) + MAX_OFFSET) / CELL_SIZE).astype(np.int64).tolist()
+        keys, segs = [], []
+        for k, ((x0, y0), (x1, y1)) in enumerate(zip(lo, hi)):
+            for cx in range(x0, x1 + 1):
+                for cy in range(y0, y1 + 1):
+                    keys.append(cx * _ROW + cy); segs.append(k)
+        # CSR layout: the segments of cell_keys[j] are cell_segs[cell_start[j]:cell_start[j + 1]]
+        keys, segs = np.array(keys, dtype=np.int64), np.array(segs, dtype=np.int64)
+        order = np.argsort(keys, kind='stable')
+        self.cell_keys, first = np.unique(keys[order], return_index=True)
+        self.cell_segs = segs[order]
+        self.cell_start = np.append(first, len(keys))
+
+    @classmethod
+    def build(cls, carla_map, spacing=LANE_SPACING):
+        """Index the lanes of a CARLA map from its MapIndex waypoints (for_map() caches it)."""
+        mi = MapIndex.for_map(carla_map, spacing)
+        ids = mi.wp_ids
+        order = np.lexsort((mi.wp_s, ids[:, 2], ids[:, 1], ids[:, 0]))
+        ids, xyz, yaw = ids[order], mi.waypoints.points[order], mi.wp_yaw[order]
+        first = np.append(np.flatnonzero(np.r_[True, (ids[1:] != ids[:-1]).any(axis=1)]), len(ids))
+        pts = []
+        for a, b in zip(first[:-1].tolist(), first[1:].tolist()):
+            lane = xyz[a:b]
+            if b - a > 1:
+                d = lane[1] - lane[0]
+                # samples come in s order; a lane driven against s is reversed so its segments point the way traffic goes
+                if np.cos(np.arctan2(d[1], d[0]) - np.radians(yaw[a])) < 0: lane = lane[::-1]
+            pts.append(lane)
+        return cls(mi.key, np.concatenate(pts) if pts else np.zeros((0, 3)), first, spacing)
+
+    @staticmethod
+    def path(key, spacing=LANE_SPACING, cache_dir=CACHE_DIR):
+        return os.path.join(cache_dir, f"lanes_{key}_{spacing:g}m.npz")
+
+    @classmethod
+    def load(cls, key, spacing=LANE_SPACING, cache_dir=CACHE_DIR):
+        """The cached index of a map key, or None."""
+        path = cls.path(key, spacing, cache_dir)
+        if not os.path.exists(path): return None
+        with np.load(path) as f:
+            grid = (f['cell_keys'], f['cell_segs'], f['cell_start']) if 'cell_keys' in f else None
+            return cls(key, f['pts'], f['lane_first'], spacing, grid)
+
+    def save(self, cache_dir=CACHE_DIR):
+        os.makedirs(cache_dir, exist_ok=True)
+        path = self.path(self.key, self.spacing, cache_dir)
+        tmp = path[:-4] + f'.{os.getpid()}.tmp.npz'
+        np.savez(tmp, pts=self.pts, lane_first=self.lane_first,
+                 cell_keys=self.cell_keys, cell_segs=self.cell_segs, cell_start=self.cell_start)
+        os.replace(tmp, path)       # a sender and a twin indexing the same town at once both end up with one file
+
+    @classmethod
+    def for_map(cls, carla_map, spacing=LANE_SPACING, cache_dir=CACHE_DIR):
+        """The index of carla_map, from the disk cache when this town was indexed before."""
+        index = cls.load(map_key(carla_map), spacing, cache_dir)
+        if index is None:
+            index = cls.build(carla_map, spacing)
+            index.save(cache_dir)
+        return index
+
+    def project(self, xyz, yaw):
+        """Nearest same-direction segment of each pose: (segment or -1, t along it, offset)."""
+        n = len(xyz)
+        cell = np.floor(xyz[:, :2] / CELL_SIZE).astype(np.int64)
+        key = cell[:, 0] * _ROW + cell[:, 1]
+        j = np.minimum(np.searchsorted(self.cell_keys, key), len(self.cell_keys) - 1)
+        found = self.cell_keys[j] == key
+        start = self.cell_start[j]
+        counts = np.where(found, self.cell_start[j + 1] - start, 0)
+        who = np.repeat(np.arange(n), counts)
+        first = np.cumsum(counts) - counts
+        seg = self.cell_segs[np.arange(counts.sum()) - np.repeat(first - start, counts)]
+        a, d, L = self.seg_a[seg], self.seg_d[seg], self.seg_len[seg]
+        rel = xyz[who, :2] - a[:, :2]
+        t = np.clip((rel * d[:, :2]).sum(axis=1) / L ** 2, 0.0, 1.0)
+        off = (rel[:, 1] * d[:, 0] - rel[:, 0] * d[:, 1]) / L
+        dist2 = ((rel - t[:, None] * d[:, :2]) ** 2).sum(axis=1)
+        dyaw = np.abs((yaw[who] - self.seg_yaw[seg] + 180.0) % 360.0 - 180.0)
+        cost = dist2 + np.where(dyaw > 90.0, 1e12, 0.0)     # a lane driven the other way never matches
+        has = counts > 0
+        low = np.minimum.reduceat(cost, first[has]) if len(cost) else cost
+        lowest = np.full(n, np.inf); lowest[has] = low
+        best = np.flatnonzero(cost == lowest[who])
+        best = best[np.r_[True, who[best[1:]] != who[best[:-1]]]] if len(best) else best     # first minimum per pose
+        best = best[cost[best] < 1e12]
+        out_seg = np.full(n, -1, dtype=np.int64); out_t = np.zeros(n); out_off = np.zeros(n)
+        out_seg[who[best]], out_t[who[best]], out_off[who[best]] = seg[best], t[best], off[best]
+        return out_seg, out_t, out_off
+
+    def pose(self, lane, s, offset, height, speed):
+        """World loc, rot (pitch, yaw, roll) and vel rows of lane coordinates."""
+        lo, hi = self.lane_first[lane], self.lane_first[lane + 1] - 2
+        i = np.clip(np.searchsorted(self.gcum, self.base[lane] + s, 'right') - 1, lo, hi)
+        a = self.pts[i]; d = self.pts[i + 1] - a
+        L = np.maximum(np.hypot(d[:, 0], d[:, 1]), 1e-6)
+        loc = a + ((s - self.cum[i]) / L)[:, None] * d
+        loc[:, 0] -= offset * d[:, 1] / L
+        loc[:, 1] += offset * d[:, 0] / L
+        loc[:, 2] += height
+        yaw, pitch = np.arctan2(d[:, 1], d[:, 0]), np.arctan2(d[:, 2], L)
+        rot = np.column_stack([np.degrees(pitch), np.degrees(yaw), np.zeros(len(lane))])
+        vel = speed[:, None] * np.column_stack([np.cos(yaw) * np.cos(pitch), np.sin(yaw) * np.cos(pitch), np.sin(pitch)])
+        return loc, rot, vel
+
+    def summary(self):
+        return dict(key=self.key, lanes=len(self.lane_first) - 1, segments=len(self.seg), cells=len(self.cell_keys))
+
+class LaneCodec(object):
+
+    def __init__(self, index):
+        self.index = index
+        self.stats = dict(frames=0, vehicles=0, coded=0, decoded=0, bytes_raw=0, bytes_coded=0)
+        self.err = dict(pos_sum=0.0, pos_max=0.0, yaw_max=0.0, speed_max=0.0)
+
+    def encode(self, entities):
+        """The frame with every vehicle near a lane in lane coordinates; the others get 'lane': None."""
+        idx = [j for j, e in enumerate(entities) if e['type'] == 'vehicle']
+        self.stats['frames'] += 1; self.stats['vehicles'] += len(idx)
+        if not idx: return entities
+        veh = [entities[j] for j in idx]
+        loc = np.array([e['loc'] for e in veh], dtype=np.float64)
+        rot = np.array([e['rot'] for e in veh], dtype=np.float64)
+        vel = np.array([e.get('vel', (0.0, 0.0, 0.0)) for e in veh], dtype=np.float64)
+        ix = self.index
+        seg, t, off = ix.project(loc, rot[:, 1])
+        k = np.maximum(seg, 0)
+        i = ix.seg[k]
+        rec = np.zeros(len(veh), dtype=LANE_DTYPE)
+        rec['lane'] = ix.lane_of[i]
+        rec['s'] = ix.cum[i] + t * ix.seg_len[k]
+        rec['offset'] = off
+        rec['speed'] = (vel[:, :2] * ix.seg_d[k, :2]).sum(axis=1) / ix.seg_len[k]
+        height = loc[:, 2] - (ix.pts[i, 2] + t * ix.seg_d[k, 2])
+        rec['height'] = np.clip(height, -MAX_HEIGHT, MAX_HEIGHT)
+        # decode what would be sent (float32 included) and keep only the poses that come back close enough
+        p, r, v = self._pose(rec)
+        xy = np.hypot(p[:, 0] - loc[:, 0], p[:, 1] - loc[:, 1])
+        dz = np.abs(p[:, 2] - loc[:, 2])
+        dyaw = np.abs((r[:, 1] - rot[:, 1] + 180.0) % 360.0 - 180.0)
+        ok = ((seg >= 0) & (np.abs(off) <= MAX_OFFSET) & (np.abs(height) <= MAX_HEIGHT)
+              & (xy <= MAX_XY_ERR) & (dz <= MAX_Z_ERR) & (dyaw <= MAX_YAW_ERR))
+        self._measure(np.hypot(xy, dz)[ok], dyaw[ok], np.linalg.norm(v - vel, axis=1)[ok])
+        out = list(entities)
+        blob, size = rec.tobytes(), LANE_DTYPE.itemsize
+        for n, (j, e, coded) in enumerate(zip(idx, veh, ok.tolist())):
+            if coded:
+                c = e.copy()
+                for f in POSE_FIELDS: c.pop(f, None)
+                c['lane'] = blob[n * size:(n + 1) * size]
+                out[j] = c
+            else:
+                out[j] = dict(e, lane=None)     # None overrides a stale lane when states are merged field by field
+        self.stats['coded'] += int(ok.sum())
+        if self.stats['frames'] % SAMPLE_EVERY == 1:
+            self.stats['bytes_raw'] += len(pickle.dumps(entities))
+            self.stats['bytes_coded'] += len(pickle.dumps(out))
+        return out
+
+    def _pose(self, rec):
+        return self.index.pose(rec['lane'].astype(np.int64), rec['s'].astype(np.float64), rec['offset'].astype(np.float64),
+                               rec['height'].astype(np.float64), rec['speed'].astype(np.float64))
+
+    def _measure(self, pos, yaw, spd):
+        """Reconstruction error of the coded poses, as the twin will decode them."""
+        if not len(pos): return
+        e = self.err
+        e['pos_sum'] += float(pos.sum())
+        e['pos_max'] = max(e['pos_max'], float(pos.max()))
+        e['yaw_max'] = max(e['yaw_max'], float(yaw.max()))
+        e['speed_max'] = max(e['speed_max'], float(spd.max()))
+
+    def decode(self, entities):
+        """Restore loc, rot and vel of the lane-coded entities, in place."""
+        coded = [e for e in entities if e.get('lane') is not None]
+        for e in entities:
+            if 'lane' in e and e['lane'] is None: del e['lane']
+        if not coded: return entities
+        rec = np.frombuffer(b''.join(e['lane'] for e in coded), dtype=LANE_DTYPE)
+        loc, rot, vel = self._pose(rec)
+        for e, l, r, v in zip(coded, loc.tolist(), rot.tolist(), vel.tolist()):
+            del e['lane']
+            e['loc'], e['rot'], e['vel'] = tuple(l), tuple(r), tuple(v)
+        self.stats['decoded'] += len(coded)
+        return entities
+
+    def summary(self):
+        s, e = self.stats, self.err
+        return dict(s, coded_pct=round(100.0 * s['coded'] / s['vehicles'], 1) if s['vehicles'] else 0.0,
+                    ratio=round(s['bytes_raw'] / s['bytes_coded'], 3) if s['bytes_coded'] else None,
+                    pos_err_mean_m=round(e['pos_sum'] / s['coded'], 5) if s['coded'] else None,
+                    pos_err_max_m=round(e['pos_max'], 5), yaw_err_max_deg=round(e['yaw_max'], 3),
+                    vel_err_max_ms=round(e['speed_max'], 4))
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+HDR-style latency histogram.
+
+Latencies are recorded as integer microseconds into log-linear buckets: exact
+below 128 us, then 64 sub-buckets per power of two (< 1.6 % relative error).
+Recording is one bucket computation and one list increment, so it is cheap
+enough to run on every frame; histograms from several runs or threads merge by
+adding counts.
+"""
+import json, math
+
+SUB_BITS = 7
+_HALF = 1 << (SUB_BITS - 1)
+BUCKETS = (1 << SUB_BITS) + 40 * _HALF      # covers up to ~2^46 us
+
+def _bucket(us):
+    if us < (1 << SUB_BITS): return us
+    e = us.bit_length() - SUB_BITS
+    return (1 << SUB_BITS) + (e - 1) * _HALF + (us >> e) - _HALF
+
+def _lower(idx):
+    """Smallest value (us) that falls into bucket idx."""
+    if idx < (1 << SUB_BITS): return idx
+    e, m = divmod(idx - (1 << SUB_BITS), _HALF)
+    return (m + _HALF) << (e + 1)
+
+class LatencyHistogram(object):
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * BUCKETS
+        self.n, self.total, self.max, self.negative = 0, 0.0, 0.0, 0
+
+    def record(self, seconds):
+        """Add one latency sample (seconds); negative samples (clock skew) are only counted."""
+        if seconds < 0:
+            self.negative += 1
+            return
+        self.counts[min(_bucket(int(seconds * 1e6)), BUCKETS - 1)] += 1
+        self.n += 1
+        self.total += seconds
+        if seconds > self.max: self.max = seconds
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.n += other.n; self.total += other.total; self.negative += other.negative
+        self.max = max(self.max, other.max)
+        return self
+
+    def percentile(self, q):
+        """Latency (seconds) at quantile q in [0, 1], at bucket resolution."""
+        if not self.n: return None
+        rank, seen = math.ceil(q * self.n), 0
+        for idx, c in enumerate(self.counts):
+            seen += c
+            if c and seen >= rank:
+                return _lower(idx) / 1e6
+        return self.max
+
+    def summary(self, unit=1e3):
+        """p50/p90/p99/p999/max/mean, in milliseconds by default."""
+        out = {'count': self.n, 'negative': self.negative}
+        if self.n:
+            for name, q in (('p50', .5), ('p90', .9), ('p99', .99), ('p999', .999)):
+                out[name] = self.percentile(q) * unit
+            out['max'] = self.max * unit
+            out['mean'] = self.total / self.n * unit
+        return out
+
+    def to_dict(self):
+        nz = {i: c for i, c in enumerate(self.counts) if c}
+        return {'counts': nz, 'n': self.n, 'total': self.total, 'max': self.max, 'negative': self.negative}
+
+    @classmethod
+    def from_dict(cls, d):
+        h = cls()
+        for i, c in d['counts'].items(): h.counts[int(i)] = c
+        h.n, h.total, h.max, h.negative = d['n'], d['total'], d['max'], d.get('negative', 0)
+        return h
+
+def dump_histograms(path, hists, **extra):
+    """Write {name: histogram} plus extra fields as JSON (summaries and raw buckets)."""
+    out = dict(extra)
+    out['summary'] = {k: h.summary() for k, h in hists.items()}
+    out['histograms'] = {k: h.to_dict() for k, h in hists.items()}
+    with open(path, 'w') as f:
+        json.dump(out, f, indent=1)
+
+def load_histograms(path):
+    with open(path) as f:
+        d = json.load(f)
+    return {k: LatencyHistogram.from_dict(v) for k, v in d.get('histograms', {}).items()}, d
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""
+Token-bucket link shaping with priority classes.
+
+Messages are queued per class and leave through one token bucket of RATE
+bytes/s (BURST bytes deep), so a busy link queues messages behind each other
+instead of only delaying or dropping them independently. Classes, in priority
+order:
+
+    spawn       model / init packets (a twin cannot show an actor it never spawned)
+    collision   state updates that report a collision
+    state       ordinary state updates
+
+Service between classes is either 'strict' (always the highest non-empty
+class) or 'wfq' (deficit round robin with per-class weights). Queues are
+bounded; a full queue drops the arriving message (tail drop). Per class the
+shaper counts enqueued / sent / dropped messages and bytes and records the
+queueing delay in a LatencyHistogram.
+"""
+import collections, threading, time
+
+from Latency_hist import LatencyHistogram
+
+CLASSES = ('spawn', 'collision', 'state')
+WEIGHTS = {'spawn': 4, 'collision': 2, 'state': 1}
+QUEUE_LIMIT = 256      # messages per class
+BURST = 0.05           # seconds of RATE the bucket holds when no burst size is given
+QUANTUM = 1500         # bytes per weight unit and round (deficit round robin)
+
+class LinkShaper(object):
+
+    def __init__(self, rate, send, burst=None, policy='strict', queue_limit=QUEUE_LIMIT, weights=WEIGHTS):
+        if policy not in ('strict', 'wfq'):
+            raise ValueError(f"unknown shaping policy {policy!r}")
+        self.rate = float(rate)
+        self.burst = float(burst) if burst else self.rate * BURST
+        self.send, self.policy, self.queue_limit = send, policy, queue_limit
+        self.quantum = {c: weights.get(c, 1) * QUANTUM for c in CLASSES}
+        self.queues = {c: collections.deque() for c in CLASSES}
+        self.deficit = dict.fromkeys(CLASSES, 0.0)
+        self._rr = 0
+        self.tokens, self._t = self.burst, time.monotonic()
+        self.cond = threading.Condition()
+        self.delay = {c: LatencyHistogram() for c in CLASSES}
+        self.stats = {c: dict(enqueued=0, sent=0, dropped=0, bytes=0, max_depth=0, errors=0) for c in CLASSES}
+        self.running = True
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def enqueue(self, cls, size, item):
+        """Queue one message of `size` bytes; False if its class queue is full (message dropped)."""
+        st = self.stats[cls]
+        with self.cond:
+            q = self.queues[cls]
+            if len(q) >= self.queue_limit:
+                st['dropped'] += 1
+                return False
+            q.append((time.monotonic(), size, item))
+            st['enqueued'] += 1
+            st['max_depth'] = max(st['max_depth'], len(q))
+            self.cond.notify()
+        return True
+
+    def depth(self):
+        return {c: len(q) for c, q in self.queues.items()}
+
+    def _pick(self):
+        """Class to serve next, or None if all queues are empty."""
+        if self.policy == 'strict':
+            return next((c for c in CLASSES if self.queues[c]), None)
+        if not any(self.queues.values()): return None
+        while True:
+            c = CLASSES[self._rr]
+            q = self.queues[c]
+            if not q:
+                self.deficit[c] = 0.0
+            elif self.deficit[c] >= q[0][1]:
+                return c
+            else:
+                self.deficit[c] += self.quantum[c]
+            self._rr = (self._rr + 1) % len(CLASSES)
+
+    def _serve(self):
+        while self.running:
+            with self.cond:
+                cls = self._pick()
+                if cls is None:
+                    self.cond.wait(0.5); continue
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self._t) * self.rate)
+                self._t = now
+                t_in, size, item = self.queues[cls][0]
+                short = min(size, self.burst) - self.tokens
+                if short > 0:
+                    # wake up early if a higher class arrives meanwhile
+                    self.cond.wait(short / self.rate); continue
+                self.queues[cls].popleft()
+                self.tokens -= size
+                if self.policy == 'wfq': self.deficit[cls] -= size
+            self.delay[cls].record(time.monotonic() - t_in)
+            st = self.stats[cls]
+            try:
+                self.send(item)
+                st['sent'] += 1; st['bytes'] += size
+            except Exception as e:
+                st['errors'] += 1
+                print(f"[Shaper] send failed ({cls}): {e}")
+
+    def close(self):
+        self.running = False
+        with self.cond: self.cond.notify()
+
+    def summary(self):
+        return {'rate_Bps': self.rate, 'burst_B': self.burst, 'policy': self.policy,
+                'classes': {c: dict(self.stats[c], depth=len(self.queues[c]), queue_delay_ms=self.delay[c].summary())
+                            for c in CLASSES}}
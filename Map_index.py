@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+"""
+Spatial index over a town's waypoints and spawn points, cached on disk.
+
+MapIndex.for_map(world.get_map()) samples the lane centrelines every
+WAYPOINT_SPACING metres and reads the spawn points once per town. Both go into
+a PointGrid and are saved to CACHE_DIR under <town>_<OpenDRIVE hash>, so a
+repeat run on the same town loads a few arrays instead of asking the server
+for thousands of waypoints. An edited town hashes differently and is indexed
+again.
+
+A PointGrid buckets points into CELL_SIZE cells (CSR layout: one sorted key
+array, one offset array) and answers batches of queries in numpy:
+
+    within(q, r)     indices of the points within r metres of each query point
+    knn(q, k)        the k nearest points of each query point, nearest first
+    beyond(p, r)     indices of the points farther than r metres from one point
+
+    index = MapIndex.for_map(world.get_map())
+    far = index.spawns.beyond(loc, 200.0)            # destinations at least 200 m away
+    road, section, lane, s, dist = index.nearest_lane(xyz)
+"""
+import hashlib, os
+import numpy as np
+
+WAYPOINT_SPACING = 2.0  # metres between lane centreline samples
+CELL_SIZE = 20.0        # metres per grid cell
+CACHE_DIR = os.environ.get('CARLA_MAP_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'carla_twin'))
+_ROW = 1 << 32          # cell key = cx * _ROW + cy
+
+def map_key(carla_map):
+    """'<town>_<hash of its OpenDRIVE>', so an edited town gets a new index."""
+    digest = hashlib.sha1(carla_map.to_opendrive().encode()).hexdigest()[:12]
+    return f"{carla_map.name.split('/')[-1]}_{digest}"
+
+def _xyz(loc):
+    return (loc.x, loc.y, loc.z) if hasattr(loc, 'x') else tuple(loc)
+
+class PointGrid(object):
+    """Points bucketed by grid cell: the points of cell_keys[j] are order[cell_start[j]:cell_start[j + 1]]."""
+
+    def __init__(self, points, cell=CELL_SIZE):
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        self.cell = cell
+        keys = self._keys(self.points)
+        self.order = np.argsort(keys, kind='stable')
+        self.cell_keys, first = np.unique(keys[self.order], return_index=True)
+        self.cell_start = np.append(first, len(keys))
+
+    def __len__(self):
+        return len(self.points)
+
+    def _keys(self, pts):
+        c = np.floor(pts[:, :2] / self.cell).astype(np.int64)
+        return c[:, 0] * _ROW + c[:, 1]
+
+    def pairs(self, q, r):
+        """(query, point, distance) of every point within r of the query points, grouped by query."""
+        q = np.asarray(q, dtype=np.float64).reshape(-1, 3)
+        if not len(self.points) or not len(q):
+            return np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0)
+        m = int(np.ceil(r / self.cell))
+        span = np.arange(-m, m + 1)
+        off = (span[:, None] * _ROW + span[None, :]).ravel()
+        keys = (self._keys(q)[:, None] + off[None, :]).ravel()
+        j = np.minimum(np.searchsorted(self.cell_keys, keys), len(self.cell_keys) - 1)
+        start = self.cell_start[j]
+        counts = np.where(self.cell_keys[j] == keys, self.cell_start[j + 1] - start, 0)
+        first = np.cumsum(counts) - counts
+        idx = self.order[np.arange(counts.sum()) - np.repeat(first - start, counts)]
+        who = np.repeat(np.arange(len(keys)) // len(off), counts)
+        d = np.linalg.norm(self.points[idx] - q[who], axis=1)
+        keep = d <= r
+        return who[keep], idx[keep], d[keep]
+
+    def within(self, q, r):
+        """Per query point, the indices of the points within r metres (3D distance)."""
+        q = np.asarray(q, dtype=np.float64).reshape(-1, 3)
+        who, idx, _ = self.pairs(q, r)
+        return np.split(idx, np.searchsorted(who, np.arange(1, len(q))))
+
+    def knn(self, q, k=1):
+        """(indices, distances), each (n, k), nearest first; -1 / inf where the grid has fewer than k points."""
+        q = np.asarray(q, dtype=np.float64).reshape(-1, 3)
+        n, want = len(q), min(k, len(self.points))
+        idx, dist = np.full((n, k), -1, dtype=np.int64), np.full((n, k), np.inf)
+        todo, r = np.arange(n), self.cell
+        while len(todo) and want:
+            # every point within r is found, so a query with want of them has its k nearest among them
+            who, pi, d = self.pairs(q[todo], r)
+            order = np.lexsort((d, who))
+            who, pi, d = who[order], pi[order], d[order]
+            counts = np.bincount(who, minlength=len(todo))
+            rank = np.arange(len(who)) - (np.cumsum(counts) - counts)[who]
+            done = counts >= want
+            sel = done[who] & (rank < want)
+            idx[todo[who[sel]], rank[sel]] = pi[sel]
+            dist[todo[who[sel]], rank[sel]] = d[sel]
+            todo, r = todo[~done], r * 2
+        return idx, dist
+
+    def beyond(self, p, r):
+        """Indices of the points farther than r metres from the point p."""
+        return np.flatnonzero(np.linalg.norm(self.points - np.asarray(_xyz(p), dtype=np.float64), axis=1) > r)
+
+class MapIndex(object):
+
+    def __init__(self, key, wp_xyz, wp_yaw, wp_ids, wp_s, spawn_xyz, spawn_yaw, spacing=WAYPOINT_SPACING):
+        self.key, self.spacing = key, spacing
+        self.waypoints = PointGrid(wp_xyz)
+        self.wp_yaw = np.asarray(wp_yaw, dtype=np.float64)
+        self.wp_ids = np.asarray(wp_ids, dtype=np.int64).reshape(-1, 3)     # road, section, lane
+        self.wp_s = np.asarray(wp_s, dtype=np.float64)
+        self.spawns = PointGrid(spawn_xyz)
+        self.spawn_yaw = np.asarray(spawn_yaw, dtype=np.float64)
+
+    @classmethod
+    def build(cls, carla_map, spacing=WAYPOINT_SPACING):
+        """Query the server for the waypoints and spawn points of carla_map (slow on large towns)."""
+        wps = carla_map.generate_waypoints(spacing)
+        sps = carla_map.get_spawn_points()
+        return cls(map_key(carla_map),
+                   [_xyz(w.transform.location) for w in wps], [w.transform.rotation.yaw for w in wps],
+                   [(w.road_id, getattr(w, 'section_id', 0), w.lane_id) for w in wps], [w.s for w in wps],
+                   [_xyz(p.location) for p in sps], [p.rotation.yaw for p in sps], spacing)
+
+    @staticmethod
+    def path(key, spacing=WAYPOINT_SPACING, cache_dir=CACHE_DIR):
+        return os.path.join(cache_dir, f"map_{key}_{spacing:g}m.npz")
+
+    @classmethod
+    def load(cls, key, spacing=WAYPOINT_SPACING, cache_dir=CACHE_DIR):
+        """The cached index of a map key, or None."""
+        path = cls.path(key, spacing, cache_dir)
+        if not os.path.exists(path): return None
+        with np.load(path) as f:
+            return cls(key, f['wp_xyz'], f['wp_yaw'], f['wp_ids'], f['wp_s'], f['spawn_xyz'], f['spawn_yaw'], spacing)
+
+    def save(self, cache_dir=CACHE_DIR):
+        os.makedirs(cache_dir, exist_ok=True)
+        path = self.path(self.key, self.spacing, cache_dir)
+        tmp = path[:-4] + f'.{os.getpid()}.tmp.npz'
+        np.savez(tmp, wp_xyz=self.waypoints.points, wp_yaw=self.wp_yaw, wp_ids=self.wp_ids, wp_s=self.wp_s,
+                 spawn_xyz=self.spawns.points, spawn_yaw=self.spawn_yaw)
+        os.replace(tmp, path)       # processes indexing the same town at once both end up with one file
+
+    @classmethod
+    def for_map(cls, carla_map, spacing=WAYPOINT_SPACING, cache_dir=CACHE_DIR):
+        """The index of carla_map, from the disk cache when this town was indexed before."""
+        index = cls.load(map_key(carla_map), spacing, cache_dir)
+        if index is None:
+            index = cls.build(carla_map, spacing)
+            index.save(cache_dir)
+        return index
+
+    def nearest_lane(self, xyz):
+        """Road, section and lane id, s and distance of the waypoint nearest to each point."""
+        idx, dist = self.waypoints.knn(xyz, 1)
+        i = np.maximum(idx[:, 0], 0)
+        road, section, lane = self.wp_ids[i].T
+        return road, section, lane, self.wp_s[i], dist[:, 0]
+
+    def summary(self):
+        return dict(key=self.key, waypoints=len(self.waypoints), spawn_points=len(self.spawns),
+                    cells=len(self.waypoints.cell_keys))
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""
+Live metrics for the relays, as Prometheus text or JSON.
+
+A MetricsRegistry holds callbacks, not values: the relay keeps incrementing
+its own plain counters and LatencyHistograms, and they are only read when the
+endpoint is scraped or a snapshot is dumped. The hot path takes no extra lock
+and does no extra work. Reads are not atomic across metrics, which is fine
+for monitoring.
+
+    registry = MetricsRegistry('scheduler')
+    registry.counter('frames_in', 'frames received', lambda: frame_stats['frames'])
+    registry.gauge('queue_depth', 'messages queued per class', shaper.depth, label='class')
+    registry.summary('relay_latency_seconds', 'relay_in -> relay_out', lambda: relay_latency)
+    serve(registry, 9108)      # GET /metrics (Prometheus text), GET /metrics.json
+
+A callback returns a number, or a {label value: number} dict that becomes one
+sample per label value. Summaries return a LatencyHistogram, or a dict of
+them, and are exported as p50 / p90 / p99 / p999 quantiles with _sum and
+_count.
+"""
+import json, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+def _labels(label, value, extra=''):
+    if label is None: return f"{{{extra}}}" if extra else ''
+    value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+    return f'{{{label}="{value}"' + (f',{extra}' if extra else '') + '}'
+
+class MetricsRegistry(object):
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.metrics = []       # (kind, name, help, callback, label)
+        self.peers = {}         # role -> 'host:port' of the connected peers
+        self.started = time.time()
+
+    def _add(self, kind, name, help, fn, label):
+        self.metrics.append((kind, f"{self.namespace}_{name}", help, fn, label))
+
+    def counter(self, name, help, fn, label=None):
+        self._add('counter', name, help, fn, label)
+
+    def gauge(self, name, help, fn, label=None):
+        self._add('gauge', name, help, fn, label)
+
+    def summary(self, name, help, fn, label=None):
+        self._add('summary', name, help, fn, label)
+
+    def _read(self, fn):
+        try:
+            return fn()
+        except Exception:
+            return None     # a metric whose source is gone (e.g. shaper closed) is left out
+
+    def render_prometheus(self):
+        lines = [f"# TYPE {self.namespace}_uptime_seconds gauge",
+                 f"{self.namespace}_uptime_seconds {time.time() - self.started:.3f}"]
+        if self.peers:
+            lines.append(f"# TYPE {self.namespace}_peer_info gauge")
+            for role, address in list(self.peers.items()):
+                tags = _labels('role', role, 'address="%s"' % address)
+                lines.append(f"{self.namespace}_peer_info{tags} 1")
+        for kind, name, help, fn, label in self.metrics:
+            value = self._read(fn)
+            if value is None: continue
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            samples = value.items() if isinstance(value, dict) else [(None, value)]
+            for lv, v in samples:
+                if kind != 'summary':
+                    lines.append(f"{name}{_labels(label, lv)} {v}")
+                    continue
+                for q in QUANTILES:
+                    p = v.percentile(q)
+                    if p is not None:
+                        tags = _labels(label, lv, 'quantile="%g"' % q)
+                        lines.append(f"{name}{tags} {p:.6f}")
+                lines.append(f"{name}_sum{_labels(label, lv)} {v.total:.6f}")
+                lines.append(f"{name}_count{_labels(label, lv)} {v.n}")
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """All metrics as a JSON-ready dict; summaries in milliseconds like the other dumps."""
+        out = {'time': time.time(), 'uptime_s': time.time() - self.started}
+        out['peers'] = dict(self.peers)
+        for kind, name, _, fn, _ in self.metrics:
+            value = self._read(fn)
+            if value is None: continue
+            key = name[len(self.namespace) + 1:]
+            if kind == 'summary':
+                value = {k: h.summary() for k, h in value.items()} if isinstance(value, dict) else value.summary()
+                key = key.replace('_seconds', '_ms')
+            out[key] = value
+        return out
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.snapshot(), f, indent=1)
+
+# ───────── HTTP endpoint ─────────
+
+def serve(registry, port, host='127.0.0.1'):
+    """Serve /metrics and /metrics.json from a daemon thread; returns the server."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.startswith('/metrics.json'):
+                body, ctype = json.dumps(registry.snapshot()).encode('utf-8'), 'application/json'
+            elif self.path.startswith('/metrics'):
+                body, ctype = registry.render_prometheus().encode('utf-8'), 'text/plain; version=0.0.4'
+            else:
+                self.send_error(404); return
+            self.send_response(200)
+            self.send_header('Content-Type', ctype)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass    # scrapes every few seconds would flood the relay's console
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
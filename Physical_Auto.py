@@ -26,7 +26,12 @@ import re
 import sys
 import weakref
 import time
-import paho.mqtt.client as mqtt
+import Pubsub
+from Udp_transport import UdpSender
+from Lod import LodPolicy, LOD_BANDS
+from Map_index import MapIndex
+from Quantize import Quantizer, QUANT_SPEC
+import Trace
 
 try:
     import pygame
@@ -89,13 +94,8 @@ MQTT_USERNAME = "your mqtt username"
 MQTT_PASSWORD = "your mqtt password"
 MQTT_CLIENT_ID = "carla_sender"
 
-# initialize MQTT client
-mqtt_client = mqtt.Client(client_id=MQTT_CLIENT_ID)  
-mqtt_client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)  
-
-mqtt_client.tls_set()  
-mqtt_client.connect(MQTT_BROKER, MQTT_PORT, 60)
-print(f"Connected to MQTTS broker at {MQTT_BROKER}:{MQTT_PORT}")
+# MQTT client, connected in main() once the car id is known
+mqtt_client = None
 
 # Define the MQTT event callbacks
 def on_connect(client, userdata, flags, rc):
@@ -135,6 +135,16 @@ def on_message(client, userdata, msg):
     except Exception as e:
         print(f"Unexpected error: {e}")
 
+def connect_mqtt(client_id):
+    """Connect to the pub/sub broker and listen for DT control commands in the background."""
+    global mqtt_client
+    mqtt_client = Pubsub.create_client(client_id)
+    mqtt_client.on_connect = on_connect
+    mqtt_client.on_message = on_message
+    Pubsub.connect(mqtt_client, MQTT_BROKER, MQTT_PORT, MQTT_USERNAME, MQTT_PASSWORD)
+    # # Start the MQTT loop in the background
+    mqtt_client.loop_start()
+
 
 # CARLA built-in functions
 def find_weather_presets():
@@ -144,9 +154,6 @@ def find_weather_presets():
     presets = [x for x in dir(carla.WeatherParameters) if re.match('[A-Z].+', x)]
     return [(getattr(carla.WeatherParameters, x), name(x)) for x in presets]
 
-def calculate_distance(loc1, loc2):
-            return math.sqrt((loc1.x - loc2.x)**2 + (loc1.y - loc2.y)**2 + (loc1.z - loc2.z)**2)
-
 def get_actor_display_name(actor, truncate=250):
     """Method to get actor display name"""
     name = ' '.join(actor.type_id.replace('_', '.').title().split('.')[1:])
@@ -220,10 +227,15 @@ class World(object):
         # initialize carla2 connection parameters
         self.carla2_host = '127.0.0.1'  # Replace with the IP address of carla2 if different
         self.carla2_port = 5005  # Replace with the port number used by carla2
+        self.carla2_transport = args.transport  # 'tcp' or 'udp' for state updates; the model packet always uses TCP
         self.update_interval = 0.2 # set update interval in seconds
         self.vehicle_info_thread = None
         self.stop_sending = threading.Event()  # event to stop the sending thread
         self.vehicle_socket = None
+        # distance-based level of detail: fewer updates far from the points of interest (Lod.py)
+        self.lod = LodPolicy(args.lod, [[float(v) for v in p.split(',')] for p in args.lod_focus]) if args.lod else None
+        # state numbers rounded to the decimals their error bounds allow (Quantize.py)
+        self.quant = Quantizer(args.quantize) if args.quantize else None
 
         # start sending vehicle updates thread
         self.start_sending_vehicle_updates()
@@ -306,6 +318,7 @@ class World(object):
             detect_coll = 0.0
         print("extract_vehicle_info function called.")
         if self.player is not None:
+            capture = Trace.now()
             blueprint = self.player.type_id
             color = self.player.attributes.get('color', 'Unknown')
             transform = self.player.get_transform()
@@ -333,7 +346,8 @@ class World(object):
                     'y':0.0,
                     'z':0.0
                 },
-                'collision': detect_coll
+                'collision': detect_coll,
+                'trace': {'capture': capture}
             }
             log_to_file(vehicle_info)
             print(f"Player vehicle exists: {self.player.type_id}")
@@ -353,7 +367,7 @@ class World(object):
                 s.connect((self.carla2_host, self.carla2_port))
                 print(f"Connected to {self.carla2_host}:{self.carla2_port}")
 
-                message = json.dumps(vehicle_info)
+                message = json.dumps(Trace.stamp_message(vehicle_info, 'send'))
                 s.sendall(message.encode('utf-8'))
                 # print("Vehicle information sent to CARLA2 successfully.")
                 self.stop_sending.wait(self.update_interval)
@@ -370,9 +384,19 @@ class World(object):
         """stop sending vehicle state updates to CARLA2."""
         print("Stopping vehicle updates...")
         self.stop_sending.set()
+        if self.lod is not None:
+            print(f"LOD: {self.lod.summary()}")
         if self.vehicle_socket:
             self.vehicle_socket.close()
 
+    def lod_due(self, vehicle_state):
+        """whether this update is due at the car's distance to the points of interest; collisions always are"""
+        location = vehicle_state['location']
+        due = self.lod.select([{'id': 0, 'loc': (location['x'], location['y'])}])
+        if due and 'lod' in due[0]:
+            vehicle_state['lod'] = due[0]['lod']
+        return bool(due) or vehicle_state['collision'] > 0
+
     def send_vehicle_updates(self):
         """send vehicle state updates to CARLA2 at regular intervals."""
         global mqtt_topic
@@ -387,6 +411,7 @@ class World(object):
                 else:
                     detect_coll = 0.0
                 # get vehicle state
+                capture = Trace.now()
                 transform = self.player.get_transform()
                 velocity = self.player.get_velocity()
                 location = transform.location
@@ -397,18 +422,32 @@ class World(object):
                     'location': {'x': location.x, 'y': location.y, 'z': location.z},
                     'rotation': {'pitch': rotation.pitch, 'yaw': rotation.yaw, 'roll': rotation.roll},
                     'velocity': {'x': velocity.x, 'y': velocity.y, 'z': velocity.z},
-                    'collision': detect_coll
+                    'collision': detect_coll,
+                    'trace': {'capture': capture}
                 }
                 log_to_file(vehicle_state)
+                if self.lod is not None and not self.lod_due(vehicle_state):
+                    self.stop_sending.wait(self.update_interval)
+                    continue
+                if self.quant is not None:
+                    self.quant.round_json(vehicle_state)
                 # send vehicle state to CARLA2
                 try:
                     if not self.vehicle_socket:
-                        self.vehicle_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                        self.vehicle_socket.connect((self.carla2_host, self.carla2_port))
-                        print(f"Connected to CARLA2 at {self.carla2_host}:{self.carla2_port}")
+                        if self.carla2_transport == 'udp':
+                            self.vehicle_socket = UdpSender((self.carla2_host, self.carla2_port))
+                        else:
+                            self.vehicle_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                            self.vehicle_socket.connect((self.carla2_host, self.carla2_port))
+                        print(f"Connected to CARLA2 at {self.carla2_host}:{self.carla2_port} ({self.carla2_transport})")
 
-                    message = json.dumps(vehicle_state)
-                    self.vehicle_socket.sendall(message.encode('utf-8'))
+                    message = json.dumps(Trace.stamp_message(vehicle_state, 'send'))
+                    if self.carla2_transport == 'udp':
+                        self.vehicle_socket.send(message.encode('utf-8'))
+                    else:
+                        self.vehicle_socket.sendall(message.encode('utf-8'))
+                    if self.lod is not None:
+                        self.lod.account(len(message))
                     # print("Vehicle state sent successfully.")
                     print(vehicle_state)
                 except Exception as e:
@@ -1008,11 +1047,9 @@ def game_loop(args):
         spawn_points = world.map.get_spawn_points()
         # destination = random.choice(spawn_points).location
         min_distance = 200
-        valid_destinations = [
-            sp for sp in spawn_points 
-            if calculate_distance(now_point.location, sp.location) > min_distance
-        ]
-        destination = random.choice(valid_destinations).location
+        map_index = MapIndex.for_map(world.map)    # cached per town; the spawn points in get_spawn_points() order
+        valid_destinations = map_index.spawns.beyond(now_point.location, min_distance)
+        destination = spawn_points[random.choice(valid_destinations)].location
         now_point = destination
         agent.set_destination(destination)
 
@@ -1033,11 +1070,8 @@ def game_loop(args):
 
             if agent.done():
                 if args.loop:
-                    valid_destinations = [
-                        sp for sp in spawn_points 
-                        if calculate_distance(now_point, sp.location) > min_distance
-                    ]
-                    destination = random.choice(valid_destinations).location
+                    valid_destinations = map_index.spawns.beyond(now_point, min_distance)
+                    destination = spawn_points[random.choice(valid_destinations)].location
                     # destination = random.choice(spawn_points).location
                     agent.set_destination(destination)
                     now_point = destination
@@ -1261,6 +1295,31 @@ def main():
         metavar='ID',
         default='car1',
         help='Specify the car ID for MQTT topic (default: "car1")')
+    argparser.add_argument(
+        '--transport',
+        choices=['tcp', 'udp'],
+        default='tcp',
+        help='Transport for state updates to the bridge (default: tcp)')
+    argparser.add_argument(
+        '--lod',
+        nargs='?',
+        const=LOD_BANDS,
+        default=None,
+        metavar='BANDS',
+        help='Send fewer updates far from the --lod-focus points, bands as metres:k,... (default bands: %s)' % LOD_BANDS)
+    argparser.add_argument(
+        '--lod-focus',
+        nargs='+',
+        default=['0,0'],
+        metavar='X,Y',
+        help='Points of interest for --lod (default: 0,0)')
+    argparser.add_argument(
+        '--quantize',
+        nargs='?',
+        const=QUANT_SPEC,
+        default=None,
+        metavar='SPEC',
+        help='Round state updates within per-field error bounds, field:max error,... (default spec: %s)' % QUANT_SPEC)
     argparser.add_argument(
         '--mqtt_id',
         metavar='ID',
@@ -1276,6 +1335,7 @@ def main():
     custom_command_active = args.DTs_control
     global MQTT_TOPIC_CONTROL
     MQTT_TOPIC_CONTROL = f"carla/control/{mqtt_topic}"  # topic prefix for control commands
+    connect_mqtt(MQTT_CLIENT_ID)
 
     args.width, args.height = [int(x) for x in args.res.split('x')]
 
@@ -1294,8 +1354,4 @@ def main():
 
 
 if __name__ == '__main__':
-    mqtt_client.on_connect = on_connect
-    mqtt_client.on_message = on_message
-    # # Start the MQTT loop in the background
-    mqtt_client.loop_start()
     main()
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+"""
+Pluggable publish/subscribe transport for the MQTT path.
+
+The bridge, Physical_Auto and the MQTT twin only use a small part of the paho
+client: connect, subscribe, publish, message_callback_add, on_connect /
+on_message and the loop_* calls. create_client() returns an object with that
+interface, backed by one of:
+
+    mqtt     paho-mqtt against a real broker (default; TLS and credentials as before)
+    local    LocalClient against a LocalBroker served on loopback TCP by
+             `python Pubsub.py` (offline runs on one box, no broker install)
+    inproc   LocalClient on a broker inside this process (tests, single-process benchmarks)
+
+The backend comes from the CARLA_PUBSUB environment variable, so the scripts
+need no changes to run offline:
+
+    python Pubsub.py &                                   # local broker on 127.0.0.1:18830
+    CARLA_PUBSUB=local python ComDef_Syn_by_MQTT.py
+
+Topic filters follow MQTT: '+' matches one level, '#' the rest of the topic
+(e.g. carla/# or carla/control/+). The local broker keeps no retained messages
+and delivers QoS 0 only.
+"""
+import argparse, os, queue, socket, struct, threading
+
+BACKEND = os.environ.get('CARLA_PUBSUB', 'mqtt')
+LOCAL_ADDR = os.environ.get('CARLA_PUBSUB_ADDR', '127.0.0.1:18830')
+
+OP_SUB, OP_UNSUB, OP_PUB = 1, 2, 3
+_FRAME = struct.Struct('>BHI')       # op, topic length, payload length
+
+def topic_matches(pattern, topic):
+    """MQTT topic filter matching with '+' and '#' wildcards."""
+    if pattern == topic: return True
+    p, t = pattern.split('/'), topic.split('/')
+    for i, level in enumerate(p):
+        if level == '#': return True
+        if i >= len(t) or (level != '+' and level != t[i]): return False
+    return len(p) == len(t)
+
+class Message(object):
+    __slots__ = ('topic', 'payload', 'qos', 'retain')
+
+    def __init__(self, topic, payload):
+        self.topic, self.payload, self.qos, self.retain = topic, payload, 0, False
+
+def _to_bytes(payload):
+    if payload is None: return b''
+    return payload.encode('utf-8') if isinstance(payload, str) else bytes(payload)
+
+# ───────── Broker ─────────
+
+class LocalBroker(object):
+    """Routes publishes to subscribed sinks; routes per topic are cached until the subscriptions change."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subs = {}         # filter -> set of sinks (callables taking topic, payload)
+        self.routes = {}       # topic -> tuple of sinks
+        self.published = self.delivered = 0
+
+    def subscribe(self, pattern, sink):
+        with self.lock:
+            self.subs.setdefault(pattern, set()).add(sink)
+            self.routes.clear()
+
+    def unsubscribe(self, pattern, sink):
+        with self.lock:
+            sinks = self.subs.get(pattern)
+            if sinks:
+                sinks.discard(sink)
+                if not sinks: del self.subs[pattern]
+            self.routes.clear()
+
+    def remove(self, sink):
+        with self.lock:
+            for pattern in [p for p, sinks in self.subs.items() if sink in sinks]:
+                self.subs[pattern].discard(sink)
+                if not self.subs[pattern]: del self.subs[pattern]
+            self.routes.clear()
+
+    def publish(self, topic, payload):
+        route = self.routes.get(topic)
+        if route is None:
+            with self.lock:
+                # a client subscribed through several matching filters still gets one copy
+                route = tuple({s for p, sinks in self.subs.items() if topic_matches(p, topic) for s in sinks})
+                self.routes[topic] = route
+        self.published += 1
+        for sink in route:
+            sink(topic, payload)
+        self.delivered += len(route)
+
+    # ---- loopback TCP server ----
+    def serve(self, host='127.0.0.1', port=18830):
+        srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        srv.bind((host, port)); srv.listen(64)
+        print(f"[Pubsub] local broker on {host}:{port}")
+        while True:
+            conn, _ = srv.accept()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self._session, args=(conn,), daemon=True).start()
+
+    def _session(self, conn):
+        send_lock = threading.Lock()
+        def sink(topic, payload):
+            t = topic.encode('utf-8')
+            try:
+                with send_lock:
+                    conn.sendall(_FRAME.pack(OP_PUB, len(t), len(payload)) + t + payload)
+            except OSError:
+                pass
+        try:
+            for op, topic, payload in _read_frames(conn):
+                if op == OP_PUB: self.publish(topic, payload)
+                elif op == OP_SUB: self.subscribe(topic, sink)
+                elif op == OP_UNSUB: self.unsubscribe(topic, sink)
+        finally:
+            self.remove(sink)
+            conn.close()
+
+def _recv_exact(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk: return None
+        buf += chunk
+    return bytes(buf)
+
+def _read_frames(sock):
+    while True:
+        hdr = _recv_exact(sock, _FRAME.size)
+        if hdr is None: return
+        op, tl, pl = _FRAME.unpack(hdr)
+        body = _recv_exact(sock, tl + pl)
+        if body is None: return
+        yield op, body[:tl].decode('utf-8'), body[tl:]
+
+_inproc_broker = None
+
+def inproc_broker():
+    global _inproc_broker
+    if _inproc_broker is None: _inproc_broker = LocalBroker()
+    return _inproc_broker
+
+# ───────── Client ─────────
+
+class LocalClient(object):
+    """paho-compatible subset on top of a LocalBroker (in this process or over loopback TCP)."""
+
+    def __init__(self, client_id='', userdata=None, inproc=False):
+        self.client_id, self._userdata, self.inproc = client_id, userdata, inproc
+        self.on_connect = self.on_message = None
+        self._callbacks = []                 # (filter, callback), checked before on_message
+        self._inbox = queue.Queue()
+        self._sock = None
+        self._send_lock = threading.Lock()
+        self._connected = self._announced = False
+        self._loop = None
+
+    # credentials and TLS only matter for a real broker
+    def username_pw_set(self, username, password=None): pass
+    def tls_set(self, *args, **kwargs): pass
+    def user_data_set(self, userdata): self._userdata = userdata
+
+    def connect(self, host=None, port=None, keepalive=60):
+        if not self.inproc:
+            if host is None or port is None:
+                host, port = LOCAL_ADDR.rsplit(':', 1)
+            self._sock = socket.create_connection((host, int(port)))
+            self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self._reader, daemon=True).start()
+        self._connected = True
+        return 0
+
+    def _deliver(self, topic, payload):
+        self._inbox.put(Message(topic, payload))
+
+    def _reader(self):
+        try:
+            for op, topic, payload in _read_frames(self._sock):
+                if op == OP_PUB: self._deliver(topic, payload)
+        except OSError:
+            pass
+
+    def _send(self, op, topic, payload=b''):
+        t = topic.encode('utf-8')
+        with self._send_lock:
+            self._sock.sendall(_FRAME.pack(op, len(t), len(payload)) + t + payload)
+
+    def subscribe(self, topic, qos=0):
+        topics = [t if isinstance(t, str) else t[0] for t in topic] if isinstance(topic, list) else [topic]
+        for t in topics:
+            if self.inproc: inproc_broker().subscribe(t, self._deliver)
+            else: self._send(OP_SUB, t)
+        return 0, len(topics)
+
+    def unsubscribe(self, topic):
+        if self.inproc: inproc_broker().unsubscribe(topic, self._deliver)
+        else: self._send(OP_UNSUB, topic)
+        return 0, 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        payload = _to_bytes(payload)
+        if self.inproc: inproc_broker().publish(topic, payload)
+        else: self._send(OP_PUB, topic, payload)
+
+    def message_callback_add(self, sub, callback):
+        self._callbacks.append((sub, callback))
+
+    def message_callback_remove(self, sub):
+        self._callbacks = [(s, cb) for s, cb in self._callbacks if s != sub]
+
+    # ---- callback dispatch, like paho's network loop ----
+    def loop(self, timeout=1.0):
+        if self._connected and not self._announced:
+            self._announced = True
+            if self.on_connect: self.on_connect(self, self._userdata, {}, 0)
+        try:
+            msg = self._inbox.get(timeout=timeout)
+        except queue.Empty:
+            return 0
+        if msg is None: return 1
+        handled = False
+        for sub, cb in self._callbacks:
+            if topic_matches(sub, msg.topic):
+                cb(self, self._userdata, msg); handled = True
+        if not handled and self.on_message:
+            self.on_message(self, self._userdata, msg)
+        return 0
+
+    def loop_forever(self, *args, **kwargs):
+        while self._connected:
+            if self.loop(): break
+
+    def loop_start(self):
+        if self._loop is None:
+            self._loop = threading.Thread(target=self.loop_forever, daemon=True)
+            self._loop.start()
+
+    def loop_stop(self, force=False):
+        if self._loop is not None:
+            self._inbox.put(None)
+            self._loop.join(1.0)
+            self._loop = None
+
+    def disconnect(self):
+        self._connected = False
+        self._inbox.put(None)
+        if self.inproc: inproc_broker().remove(self._deliver)
+        elif self._sock: self._sock.close()
+
+# ───────── Factory ─────────
+
+def create_client(client_id='', userdata=None, backend=None):
+    """A paho-compatible client for the configured backend ('mqtt', 'local' or 'inproc')."""
+    backend = backend or BACKEND
+    if backend == 'mqtt':
+        import paho.mqtt.client as mqtt
+        return mqtt.Client(client_id=client_id, userdata=userdata)
+    if backend in ('local', 'inproc'):
+        return LocalClient(client_id, userdata, inproc=backend == 'inproc')
+    raise ValueError(f"unknown pub/sub backend {backend!r}")
+
+def connect(client, broker, port, username=None, password=None, tls=True, keepalive=60):
+    """Credentials, TLS and connect for a real broker; a local backend uses LOCAL_ADDR instead."""
+    if isinstance(client, LocalClient):
+        client.connect()
+        print(f"Connected to {'in-process' if client.inproc else 'local'} broker ({BACKEND})")
+        return
+    if username: client.username_pw_set(username, password)
+    if tls: client.tls_set()
+    client.connect(broker, port, keepalive)
+    print(f"Connected to MQTT{'S' if tls else ''} broker at {broker}:{port}")
+
+# ───────── Entry Point ─────────
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local pub/sub broker for offline runs of the MQTT path.')
+    host, port = LOCAL_ADDR.rsplit(':', 1)
+    parser.add_argument('--host', default=host)
+    parser.add_argument('--port', type=int, default=int(port))
+    args = parser.parse_args()
+    try:
+        LocalBroker().serve(args.host, args.port)
+    except KeyboardInterrupt:
+        print("[Pubsub] broker stopped")
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""
+Error-bounded fixed-point quantization of actor states.
+
+Each quantized field has a maximum absolute error per component:
+
+    loc   0.01 m       int32 in steps of 0.02 m
+    rot   0.1 deg      int16 in steps of 0.2 deg
+    vel   0.01 m/s     int16 in steps of 0.02 m/s
+
+A value is rounded to the nearest step, so it comes back at most half a step
+off. The encoder decodes what it sends and keeps a field as floats when any
+component would come back more than its bound off (beyond the integer range,
+or not finite), so the bound holds for every value the twin receives, not just
+on average. One frame is one numpy pass per field.
+
+Pickled frames (Physical_world --quantize): a quantized field is replaced by
+the bytes of its integers, 12 or 6 bytes where a tuple of three floats pickles
+to 28. The init packet carries the spec, so the twin decodes with the same
+steps. A field that is still a tuple was sent raw.
+
+JSON states (Physical_Auto --quantize): the numbers of location, rotation and
+velocity are rounded to the decimals their bounds allow, '12.35' instead of
+'12.346789012345678'. The receivers are unchanged.
+
+    q = Quantizer('loc:0.01:i4,rot:0.1:i2,vel:0.01:i2')
+    frame = q.encode(entities)          # sender
+    q.decode(frame)                     # twin, in place
+    q.round_json(vehicle_state)         # JSON sender, in place
+
+Run this file to check the round trip on random states.
+"""
+import math, pickle
+import numpy as np
+
+QUANT_SPEC = 'loc:0.01:i4,rot:0.1:i2,vel:0.01:i2'  # field:max abs error per component:integer type
+JSON_FIELDS = {'location': 'loc', 'rotation': 'rot', 'velocity': 'vel'}  # JSON state dict -> frame field
+SAMPLE_EVERY = 50       # frames between compression-ratio samples (pickles the raw frame as well)
+
+def parse_spec(spec):
+    """'loc:0.01:i4,rot:0.1' -> (('loc', 0.01, '<i4'), ('rot', 0.1, '<i4')); the type defaults to i4."""
+    fields = []
+    for f in spec.split(','):
+        name, bound, *kind = f.split(':')
+        fields.append((name, float(bound), '<' + (kind[0] if kind else 'i4')))
+    return tuple(fields)
+
+def decimals(bound):
+    """Fewest decimals that round any number to within bound."""
+    return max(0, math.ceil(-math.log10(2.0 * bound) - 1e-12))
+
+class Quantizer(object):
+
+    def __init__(self, spec=QUANT_SPEC):
+        self.spec = spec
+        self.fields = parse_spec(spec)
+        self.decimals = {name: decimals(bound) for name, bound, _ in self.fields}
+        self.stats = dict(frames=0, values=0, quantized=0, decoded=0, bytes_raw=0, bytes_coded=0)
+        self.err = {name: 0.0 for name, _, _ in self.fields}
+
+    @staticmethod
+    def quantize(x, bound, dtype):
+        """Integer rows of x, a mask of the rows that come back within bound, and their error."""
+        info, step = np.iinfo(dtype), 2.0 * bound
+        q = np.nan_to_num(np.rint(x / step), nan=0.0, posinf=info.max, neginf=info.min)
+        q = np.clip(q, info.min, info.max).astype(dtype)
+        err = np.abs(q * step - x)     # exactly what the decoder computes; nan never passes
+        return q, (err <= bound).all(axis=1), err
+
+    def encode(self, entities):
+        """Copies of the entities with each field within its bound as integer bytes."""
+        self.stats['frames'] += 1
+        out = [e.copy() for e in entities]
+        for name, bound, dtype in self.fields:
+            rows = [e for e in out if isinstance(e.get(name), (tuple, list))]
+            if not rows: continue
+            x = np.array([e[name] for e in rows], dtype=np.float64).reshape(len(rows), -1)
+            q, ok, err = self.quantize(x, bound, dtype)
+            blob, size = q.tobytes(), q.itemsize * q.shape[1]
+            for n, (e, good) in enumerate(zip(rows, ok.tolist())):
+                if good: e[name] = blob[n * size:(n + 1) * size]
+            self.stats['values'] += len(rows); self.stats['quantized'] += int(ok.sum())
+            if ok.any(): self.err[name] = max(self.err[name], float(err[ok].max()))
+        if self.stats['frames'] % SAMPLE_EVERY == 1:
+            self.stats['bytes_raw'] += len(pickle.dumps(entities))
+            self.stats['bytes_coded'] += len(pickle.dumps(out))
+        return out
+
+    def decode(self, entities):
+        """Restore the quantized fields of the entities as float tuples, in place."""
+        for name, bound, dtype in self.fields:
+            rows = [e for e in entities if type(e.get(name)) is bytes]
+            if not rows: continue
+            q = np.frombuffer(b''.join(e[name] for e in rows), dtype=dtype).reshape(len(rows), -1)
+            for e, v in zip(rows, (q * (2.0 * bound)).tolist()):
+                e[name] = tuple(v)
+            self.stats['decoded'] += len(rows)
+        return entities
+
+    def round_json(self, state):
+        """The numbers of a JSON state's location, rotation and velocity dicts rounded within their bounds, in place."""
+        for key, name in JSON_FIELDS.items():
+            d = self.decimals.get(name)
+            if d is not None and isinstance(state.get(key), dict):
+                state[key] = {k: round(v, d) for k, v in state[key].items()}
+        return state
+
+    def summary(self):
+        s = self.stats
+        return dict(s, spec=self.spec, quantized_pct=round(100.0 * s['quantized'] / s['values'], 1) if s['values'] else 0.0,
+                    ratio=round(s['bytes_raw'] / s['bytes_coded'], 3) if s['bytes_coded'] else None,
+                    err_max={name: round(v, 6) for name, v in self.err.items()})
+
+if __name__ == '__main__':
+    # round-trip property check: every field that comes back quantized is within its bound, every other one is untouched
+    rng = np.random.default_rng(0)
+    q = Quantizer()
+    bounds = {name: bound for name, bound, _ in q.fields}
+    for trial in range(200):
+        scale = 10.0 ** rng.integers(0, 6)
+        n = int(rng.integers(1, 300))
+        ents = [{'id': i, 'type': 'vehicle', 'loc': tuple(rng.normal(0, scale, 3)),
+                 'rot': tuple(rng.uniform(-180, 180, 3)), 'vel': tuple(rng.normal(0, scale / 100, 3))} for i in range(n)]
+        ents[0]['vel'] = (float('nan'), 0.0, 0.0)
+        ents[-1]['loc'] = (1e12, 0.0, -1e12)
+        del ents[n // 2]['vel']
+        back = q.decode(pickle.loads(pickle.dumps(q.encode(ents))))
+        for a, b in zip(ents, back):
+            assert a.keys() == b.keys()
+            for name, bound in bounds.items():
+                if name not in a: continue
+                assert type(b[name]) is tuple, (name, b[name])
+                if all(x == y or x != x and y != y for x, y in zip(a[name], b[name])): continue     # sent raw
+                assert max(abs(x - y) for x, y in zip(a[name], b[name])) <= bound, (name, a[name], b[name])
+        for state in ents[:20]:
+            js = {'location': dict(zip('xyz', state['loc'])), 'rotation': dict(zip(('pitch', 'yaw', 'roll'), state['rot']))}
+            r = q.round_json({k: dict(v) for k, v in js.items()})
+            for key, name in JSON_FIELDS.items():
+                for k in js.get(key, ()):
+                    assert abs(r[key][k] - js[key][k]) <= bounds[name]
+    print(q.summary())
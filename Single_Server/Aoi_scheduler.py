@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# Age-of-Information aware bandwidth scheduler for the Scheduler relay
+"""
+Under a link budget (bytes/s) not every actor can be updated every frame. Each
+state frame the Scheduler receives is cut down to the actors whose update buys
+the most weighted Age of Information:
+
+    age_i      = physical_timestamp - timestamp of the twin's copy of actor i
+    weight_i   = (1 + SPEED_WEIGHT * speed_i) * (1 + PROXIMITY_WEIGHT * neighbours_i)
+    priority_i = weight_i * age_i
+
+Updates cost about the same number of bytes per actor, so the best use of the
+budget is the top-k priorities, k = available bytes / bytes per actor. When
+one actor costs more than the MAX_BURST credit, a full credit still sends the
+top actor and goes into debt, so a small budget slows updates down instead of
+stopping them. Actors the twin has never seen always go first. Neighbours are counted on a hash grid
+of PROXIMITY_RADIUS cells and the top-k is an argpartition, so one decision is
+a few vectorized passes over the fleet (well under a tick for 5,000 actors).
+
+Partial frames keep the frame's trace header and carry only the chosen actors;
+Twin_world updates the actors present in a frame and leaves the rest as they are.
+"""
+import os, pickle, sys, time
+from itertools import chain
+from operator import itemgetter
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Trace
+
+SPEED_WEIGHT = 0.1        # per m/s
+PROXIMITY_WEIGHT = 0.5    # per neighbour in the same cell
+PROXIMITY_RADIUS = 15.0   # m, grid cell size for the neighbour count
+MAX_BURST = 0.1           # seconds of budget that can be saved up while idle
+EMA = 0.1                 # smoothing of the bytes-per-actor estimate
+
+def neighbours(pos, radius=PROXIMITY_RADIUS):
+    """Number of other actors in each actor's grid cell."""
+    cells = np.floor(pos[:, :2] / radius).astype(np.int64)
+    keys = cells[:, 0] * 1000003 + cells[:, 1]
+    _, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    return counts[inverse] - 1
+
+class AoiScheduler(object):
+
+    def __init__(self, budget, speed_weight=SPEED_WEIGHT, proximity_weight=PROXIMITY_WEIGHT, radius=PROXIMITY_RADIUS):
+        self.budget = float(budget)
+        self.speed_weight, self.proximity_weight, self.radius = speed_weight, proximity_weight, radius
+        self.slots = {}                     # actor id -> index into last_sent
+        self.last_sent = np.full(1024, -np.inf)
+        self.credit, self.t_last = self.budget * MAX_BURST, None
+        self.actor_bytes = None             # running estimate of pickled bytes per actor
+        self.stats = {'frames': 0, 'actors': 0, 'sent': 0, 'debt': 0, 'aoi_sum': 0.0, 'weighted_aoi_sum': 0.0, 'decide_s': 0.0}
+
+    def _slots(self, ids):
+        slots = self.slots
+        for aid in ids:
+            if aid not in slots: slots[aid] = len(slots)
+        out = np.fromiter(map(slots.__getitem__, ids), np.int64, len(ids))
+        if len(slots) > len(self.last_sent):
+            grow = np.full(max(len(slots), 2 * len(self.last_sent)) - len(self.last_sent), -np.inf)
+            self.last_sent = np.concatenate([self.last_sent, grow])
+        return out
+
+    def priorities(self, ts, pos, vel, slots):
+        """Return (priority, age) per actor; never-sent actors get infinite priority."""
+        age = ts - self.last_sent[slots]
+        speed = np.sqrt(np.einsum('ij,ij->i', vel, vel))
+        weight = (1.0 + self.speed_weight * speed) * (1.0 + self.proximity_weight * neighbours(pos, self.radius))
+        return weight * age, age, weight
+
+    def select(self, entities, frame_bytes, now=None):
+        """Indices of the entities to forward in this frame."""
+        now = time.monotonic() if now is None else now
+        n = len(entities)
+        if not n: return []
+        t0 = time.perf_counter()
+        per_actor = frame_bytes / n
+        self.actor_bytes = per_actor if self.actor_bytes is None else (1 - EMA) * self.actor_bytes + EMA * per_actor
+        if self.t_last is not None:
+            self.credit = min(self.credit + self.budget * (now - self.t_last), self.budget * MAX_BURST)
+        self.t_last = now
+
+        ts = next((e['physical_timestamp'] for e in entities if 'physical_timestamp' in e), now)
+        slots = self._slots([e['id'] for e in entities])
+        pos = np.fromiter(chain.from_iterable(map(itemgetter('loc'), entities)), np.float64, 3 * n).reshape(n, 3)
+        vel = np.fromiter(chain.from_iterable(e.get('vel', (0.0, 0.0, 0.0)) for e in entities), np.float64, 3 * n).reshape(n, 3)
+        prio, age, weight = self.priorities(ts, pos, vel, slots)
+
+        k = min(n, int(self.credit // self.actor_bytes))
+        if k <= 0 and self.credit >= self.budget * MAX_BURST:
+            # one actor is more than the credit can ever hold: send it anyway and pay it back
+            k = 1; self.stats['debt'] += 1
+        if k >= n:
+            chosen = np.arange(n)
+        elif k > 0:
+            chosen = np.argpartition(-prio, k - 1)[:k]
+        else:
+            chosen = np.empty(0, np.int64)
+        self.credit -= len(chosen) * self.actor_bytes
+        self.last_sent[slots[chosen]] = ts
+
+        # fleet AoI right after this decision (chosen actors are fresh again)
+        age[chosen] = 0.0
+        finite = np.isfinite(age)
+        st = self.stats
+        st['frames'] += 1; st['actors'] += n; st['sent'] += len(chosen)
+        st['aoi_sum'] += float(age[finite].mean()) if finite.any() else 0.0
+        st['weighted_aoi_sum'] += float((weight * age)[finite].mean()) if finite.any() else 0.0
+        st['decide_s'] += time.perf_counter() - t0
+        return chosen
+
+    def on_init(self, payload):
+        """The init packet gives the twin a copy of every actor."""
+        msg = pickle.loads(Trace.payload(payload))
+        entities = msg.get('vehicles', []) if isinstance(msg, dict) else []
+        if entities:
+            slots = self._slots([e['id'] for e in entities])
+            self.last_sent[slots] = entities[0].get('physical_timestamp', 0.0)
+
+    def schedule(self, payload):
+        """Cut one traced state frame down to the chosen actors; None if nobody fits the budget."""
+        hdr = Trace.read_header(payload)
+        body = Trace.payload(payload)
+        entities = pickle.loads(body)
+        chosen = self.select(entities, len(body))
+        if not len(chosen): return None
+        if len(chosen) == len(entities): return payload
+        part = pickle.dumps([entities[i] for i in np.sort(chosen)])
+        # header stays writable for the relay_out stamp
+        return bytearray(payload[:Trace.HEADER_SIZE]) + part if hdr is not None else part
+
+    def summary(self):
+        st, f = self.stats, max(self.stats['frames'], 1)
+        return {'budget_Bps': self.budget, 'frames': st['frames'],
+                'sent_fraction': st['sent'] / st['actors'] if st['actors'] else None,
+                'mean_aoi_s': st['aoi_sum'] / f, 'mean_weighted_aoi_s': st['weighted_aoi_sum'] / f,
+                'decide_ms': 1e3 * st['decide_s'] / f, 'bytes_per_actor': self.actor_bytes, 'debt_frames': st['debt']}
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+"""
+End-to-end benchmark of the Single_Server pipeline.
+
+Launches Scheduler.py, Twin_world.py and Physical_world.py (against the
+Carla_standin kinematic world unless --carla is given) for every combination
+of fleet size, tick rate, transport and impairment, lets each run for a fixed
+time and collects:
+
+    fps          frames/s applied by the twin (sustained, first to last frame)
+    e2e p50/p99  capture -> apply latency from the twin's per-hop trace (ms)
+    cpu          CPU seconds and utilisation of each process
+    bytes/frame  mean frame size at the Scheduler ingress
+    overruns     twin frames that took longer than one tick to apply
+    dropped      frames dropped by the Scheduler impairment
+
+Results are written to a JSON file together with the git commit, so runs of
+different commits can be compared with --compare.
+
+    python Benchmark.py --fleet 100 500 2000 --transport tcp shm --duration 20
+    python Benchmark.py --compare bench_old.json bench_new.json
+"""
+import argparse, itertools, json, os, signal, subprocess, sys, time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.append(ROOT)
+import Impairment
+STARTUP_WAIT = 1.0     # seconds between starting the scheduler / twin / physical side
+STOP_TIMEOUT = 15.0
+
+# ───────── Process handling ─────────
+
+def launch(script, args, cwd, env, log):
+    return subprocess.Popen([sys.executable, os.path.join(HERE, script)] + [str(a) for a in args],
+                            cwd=cwd, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+def reap(proc, timeout=STOP_TIMEOUT):
+    """Wait for a child and return its CPU seconds (user + system); kill it after timeout."""
+    deadline = time.time() + timeout
+    while True:
+        pid, status, ru = os.wait4(proc.pid, os.WNOHANG)
+        if pid:
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            return ru.ru_utime + ru.ru_stime
+        if time.time() > deadline:
+            os.kill(proc.pid, signal.SIGKILL); deadline = float('inf')
+        time.sleep(0.05)
+
+def stop(proc, timeout=STOP_TIMEOUT):
+    # os.kill rather than Popen.send_signal, which would reap the child and lose its rusage
+    os.kill(proc.pid, signal.SIGINT)
+    return reap(proc, timeout)
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def load_json(path):
+    try:
+        with open(path) as f: return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+# ───────── One run ─────────
+
+def refusal(transport, drop, delay, budget, impairment):
+    """Why the Scheduler would refuse this combination at startup (its own argument checks), or None."""
+    if transport != 'shm':
+        return None
+    if budget:
+        return '--budget needs tcp or udp'
+    if Impairment.from_spec(impairment, drop, delay).may_delay:
+        return '--delay and delaying --impairment models need tcp or udp'
+    return None
+
+def run_once(fleet, rate, transport, drop, delay, duration, workdir, carla=False, budget=0, impairment=None):
+    os.makedirs(workdir, exist_ok=True)
+    env = dict(os.environ)
+    if not carla:
+        env['CARLA_STANDIN'] = '1'
+    delta = 1.0 / rate
+    logs = {name: open(os.path.join(workdir, f'{name}.log'), 'w') for name in ('scheduler', 'twin', 'physical')}
+    procs, walls = {}, {}
+    try:
+        walls['scheduler'] = time.time()
+        procs['scheduler'] = launch('Scheduler.py', ['--transport', transport, '--drop', drop, '--delay', delay] +
+                                    (['--budget', budget] if budget else []) +
+                                    (['--impairment', impairment] if impairment else []), workdir, env, logs['scheduler'])
+        time.sleep(STARTUP_WAIT)
+        # the twin is driven by incoming frames, so its stand-in world must not pace itself as well
+        walls['twin'] = time.time()
+        procs['twin'] = launch('Twin_world.py', ['--transport', transport, '--fixed-delta', delta],
+                               workdir, dict(env, CARLA_STANDIN_REALTIME='0'), logs['twin'])
+        time.sleep(STARTUP_WAIT)
+        walls['physical'] = time.time()
+        procs['physical'] = launch('Physical_world.py', ['-n', fleet, '--transport', transport, '--fixed-delta', delta],
+                                   workdir, env, logs['physical'])
+        time.sleep(duration)
+    finally:
+        cpu = {}
+        for name in ('physical', 'scheduler', 'twin'):
+            if name in procs:
+                cpu[name] = stop(procs[name])
+                walls[name] = time.time() - walls[name]
+        for f in logs.values(): f.close()
+
+    sched = load_json(os.path.join(workdir, f'scheduler_latency_{transport}.json'))
+    trace = load_json(os.path.join(workdir, 'latency_trace_twin.json'))
+    frames = sched.get('frames', {})
+    twin = trace.get('twin', {})
+    e2e = trace.get('summary', {}).get('end_to_end', {})
+    return {
+        'params': {'fleet': fleet, 'tick_rate': rate, 'transport': transport, 'drop': drop, 'delay': delay,
+                   'budget': budget, 'impairment': impairment, 'duration': duration, 'world': 'carla' if carla else 'standin'},
+        'fps': twin.get('fps'),
+        'frames': twin.get('frames'),
+        'e2e_p50_ms': e2e.get('p50'),
+        'e2e_p99_ms': e2e.get('p99'),
+        'bytes_per_frame': frames['bytes'] / frames['frames'] if frames.get('frames') else None,
+        'overruns': twin.get('overruns'),
+        'dropped': frames.get('dropped'),
+        'aoi': sched.get('aoi'),
+        'cpu_s': cpu,
+        'cpu_pct': {k: 100.0 * cpu[k] / walls[k] for k in cpu if walls[k] > 0},
+        'exit_codes': {k: p.returncode for k, p in procs.items()},
+    }
+
+# ───────── Reporting ─────────
+
+COLS = (('fps', 'fps', '{:.1f}'), ('p50', 'e2e_p50_ms', '{:.2f}'), ('p99', 'e2e_p99_ms', '{:.2f}'),
+        ('B/frame', 'bytes_per_frame', '{:.0f}'), ('overrun', 'overruns', '{}'), ('drop', 'dropped', '{}'))
+
+def run_key(r):
+    p = r['params']
+    key = f"n={p['fleet']} {p['tick_rate']:g}Hz {p['transport']} drop={p['drop']:g} delay={p['delay']:g}"
+    key += f" budget={p['budget']:g}" if p.get('budget') else ''
+    return key + (f" {p['impairment']}" if p.get('impairment') else '')
+
+def fmt(fmt_, v):
+    return fmt_.format(v) if v is not None else '-'
+
+def print_table(runs, label=''):
+    cpu_names = ('physical', 'scheduler', 'twin')
+    print(f"{label:<44}" + ''.join(f"{c:>10}" for c, _, _ in COLS) + ''.join(f"{'cpu% ' + n[:5]:>12}" for n in cpu_names))
+    for r in runs:
+        row = ''.join(f"{fmt(f, r.get(k)):>10}" for _, k, f in COLS)
+        row += ''.join(f"{fmt('{:.0f}', r['cpu_pct'].get(n)):>12}" for n in cpu_names)
+        print(f"{run_key(r):<44}{row}")
+
+def compare(paths):
+    """Prints runs with the same parameters from several result files one below the other."""
+    files = [(os.path.basename(p), load_json(p)) for p in paths]
+    keys = []
+    for _, d in files:
+        for r in d.get('runs', []):
+            if run_key(r) not in keys: keys.append(run_key(r))
+    for key in keys:
+        print(f"\n{key}")
+        for name, d in files:
+            for r in d.get('runs', []):
+                if run_key(r) == key:
+                    print(f"  {name} @ {d.get('commit')}: " +
+                          '  '.join(f"{c}={fmt(f, r.get(k))}" for c, k, f in COLS) +
+                          '  cpu%=' + '/'.join(fmt('{:.0f}', r['cpu_pct'].get(n)) for n in ('physical', 'scheduler', 'twin')))
+
+# ───────── Entry Point ─────────
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--fleet', type=int, nargs='+', default=[100])
+    parser.add_argument('--tick-rate', type=float, nargs='+', default=[50.0], help='physical ticks per second')
+    parser.add_argument('--transport', nargs='+', choices=['tcp', 'udp', 'shm'], default=['tcp'])
+    parser.add_argument('--drop', type=float, nargs='+', default=[0.0], help='Scheduler drop probability')
+    parser.add_argument('--delay', type=float, nargs='+', default=[0.0], help='Scheduler added delay (s)')
+    parser.add_argument('--budget', type=float, nargs='+', default=[0.0], help='Scheduler link budget (bytes/s), 0 = off')
+    parser.add_argument('--impairment', nargs='+', default=[None],
+                        help="Scheduler loss/delay model, e.g. 'ge:0.02,0.25' or 'trace:drive.csv' (replaces --drop/--delay)")
+    parser.add_argument('--duration', type=float, default=20.0, help='seconds per run after all processes started')
+    parser.add_argument('--workdir', default='bench_runs', help='per-run logs and result files go here')
+    parser.add_argument('--out', default='benchmark_results.json')
+    parser.add_argument('--carla', action='store_true', help='use real CARLA servers on 2000/2100 instead of the stand-in')
+    parser.add_argument('--compare', nargs='+', metavar='JSON', help='compare result files of earlier runs and exit')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(args.compare); sys.exit()
+    # the Scheduler runs inside the per-run workdir
+    args.impairment = ['trace:' + os.path.abspath(s[6:]) if s and s.startswith('trace:') else s for s in args.impairment]
+
+    result = {'commit': git_commit(), 'started': time.strftime('%Y-%m-%dT%H:%M:%S'), 'runs': [], 'refused': []}
+    for fleet, rate, transport, drop, delay, budget, impairment in itertools.product(
+            args.fleet, args.tick_rate, args.transport, args.drop, args.delay, args.budget, args.impairment):
+        name = f"n{fleet}_{rate:g}hz_{transport}_d{drop:g}_l{delay:g}" + (f"_b{budget:g}" if budget else '')
+        if impairment: name += '_' + ''.join(c if c.isalnum() or c in '.,' else '_' for c in os.path.basename(impairment))
+        reason = refusal(transport, drop, delay, budget, impairment)
+        if reason:
+            # the Scheduler would exit at startup; an empty run must not pass for a measurement
+            print(f"[Bench] {name} skipped: {reason}")
+            result['refused'].append({'name': name, 'reason': reason})
+            continue
+        print(f"[Bench] {name} ...")
+        run = run_once(fleet, rate, transport, drop, delay, args.duration,
+                       os.path.abspath(os.path.join(args.workdir, name)), args.carla, budget, impairment)
+        result['runs'].append(run)
+        with open(args.out, 'w') as f:
+            json.dump(result, f, indent=1)
+    with open(args.out, 'w') as f:
+        json.dump(result, f, indent=1)
+    print_table(result['runs'], f"commit {result['commit']}")
+    print(f"[Bench] results written to {args.out}")
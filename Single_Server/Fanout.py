@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+# Twin fan-out - one Scheduler ingress stream sent to several twins, each with its own link
+"""
+Each twin gets a TwinLink: its own connection, impairment model (Impairment.py
+spec), bounded send queue and sender thread. The relay only ever calls
+offer(), which never blocks. A twin that falls behind fills its own queue
+(frames still inside their impairment delay do not count), and the link's
+policy decides what happens then:
+
+    drop      the arriving state frame is dropped (the queue keeps the older ones)
+    coalesce  the queued state frames are merged with the arriving one into a single
+              frame, latest state wins per actor (actors missing from the newer,
+              partial frames keep their last state)
+
+Init frames are never dropped or coalesced: when the queue is full they push
+out the oldest state frame instead. So a slow twin never stalls the physical
+sender or the other twins.
+
+A TCP twin that acknowledges applied frames (Twin_world does) never has more
+than WINDOW frames in flight; everything behind them waits in the queue, where
+the policy bounds it, instead of in socket buffers where no policy reaches.
+
+A TCP twin that is not up yet, or whose connection breaks, is retried every
+RECONNECT_INTERVAL seconds. When it connects, its queue is cleared and it gets
+the Scheduler's keyframe (the current world as an init frame) before anything
+else. Twins are given as host:port[=impairment], e.g.
+
+    127.0.0.1:9999  127.0.0.1:9998=ge:0.02,0.25  127.0.0.1:9997=trace:lte.csv
+"""
+import collections, os, pickle, socket, struct, sys, threading, time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Trace
+import Impairment
+from Latency_hist import LatencyHistogram
+from Udp_transport import UdpSender
+
+# ───────── Configuration ─────────
+QUEUE_LIMIT = 16            # frames per twin
+POLICIES = ('drop', 'coalesce')
+FRAME_HDR = struct.Struct('>Id')   # same framing as Scheduler.send_frame: payload length, send time
+SEND_BUFFER = 1 << 20      # bytes; a small kernel buffer keeps a slow twin's backlog in the queue, where the policy sees it
+WINDOW = 2                 # frames sent to a twin but not yet applied by it
+RECONNECT_INTERVAL = 0.5   # seconds between connection attempts to a twin that is down
+
+def merge_frames(parts):
+    """One state frame with the newest state of every actor in parts (oldest first).
+
+    It carries the trace header of the oldest frame that still contributes an
+    actor, so the twin's latency covers the oldest state it applies.
+    """
+    actors, origin = {}, {}
+    for n, blob in enumerate(parts):
+        for e in pickle.loads(Trace.payload(blob)):
+            actors[e['id']] = e
+            origin[e['id']] = n
+    oldest = parts[min(origin.values(), default=len(parts) - 1)]
+    hdr = bytes(oldest[:Trace.HEADER_SIZE]) if Trace.read_header(oldest) is not None else b''
+    return bytearray(hdr + pickle.dumps(list(actors.values())))
+
+def parse_twin(spec):
+    """'host:port[=impairment]' -> (host, port, impairment spec or None)."""
+    addr, _, impairment = spec.partition('=')
+    host, _, port = addr.rpartition(':')
+    return host or '127.0.0.1', int(port), impairment or None
+
+# ───────── One twin ─────────
+
+class TwinLink(object):
+
+    def __init__(self, spec, transport='tcp', queue_limit=QUEUE_LIMIT, policy='drop', keyframe=None):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown fan-out policy {policy!r}")
+        host, port, impairment = parse_twin(spec)
+        self.name, self.addr = f"{host}:{port}", (host, port)
+        self.impairment = Impairment.from_spec(impairment)
+        self.queue_limit, self.policy = queue_limit, policy
+        self.keyframe = keyframe             # () -> init frame of the current world, or None
+        self.send_lock = threading.Lock()
+        self.queue = collections.deque()     # (due, ready, payload, traced, is_init)
+        self.cond = threading.Condition()
+        self.initialized = False
+        self.sent_frames, self.acked = 0, None     # per connection; acked stays None for twins that do not ack
+        self.queue_delay = LatencyHistogram()      # due -> sent: backpressure only
+        self.impairment_delay = LatencyHistogram() # offered -> due: the delay the model adds on purpose
+        self.stats = dict(offered=0, sent=0, sent_bytes=0, lost=0, dropped=0, coalesced=0, errors=0, max_depth=0,
+                          keyframes=0, connects=0)
+        self.running = True
+        self.sock = None
+        if transport == 'udp':
+            self.sock = UdpSender((host, port))
+            threading.Thread(target=self._responder, args=(self.sock,), daemon=True).start()
+        elif not self._connect():
+            print(f"[Fanout] {self.name}: not up yet, retrying every {RECONNECT_INTERVAL:g} s")
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _connect(self):
+        """One connection attempt; a twin that joins gets the keyframe before any queued frame."""
+        try:
+            sock = socket.create_connection(self.addr)
+        except OSError:
+            return False
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER)
+        with self.cond:
+            self.queue.clear()      # everything queued so far is folded into the keyframe
+        frame = self.keyframe() if self.keyframe else None
+        self.sock, self.initialized = sock, False
+        self.sent_frames, self.acked = 0, None
+        self.stats['connects'] += 1
+        threading.Thread(target=self._responder, args=(sock,), daemon=True).start()
+        if frame is not None:
+            try:
+                self._send(frame, False)
+            except OSError:
+                self._disconnect(); return False
+            self.initialized = True
+            self.sent_frames += 1
+            self.stats['keyframes'] += 1
+            self.stats['sent'] += 1
+            self.stats['sent_bytes'] += len(frame)
+            print(f"[Fanout] {self.name}: connected, sent keyframe ({len(frame)} bytes)")
+        return True
+
+    def _disconnect(self):
+        sock, self.sock, self.initialized = self.sock, None, False
+        try: sock.close()
+        except OSError: pass
+
+    def offer(self, payload, traced, is_init):
+        """Queue one frame for this twin; never blocks."""
+        st = self.stats
+        st['offered'] += 1
+        lost, delay = self.impairment.step()
+        if lost and not is_init:
+            st['lost'] += 1
+            return
+        self.impairment_delay.record(delay)
+        now = time.monotonic()
+        ready = now + delay     # when the frame leaves the impairment and starts to wait for the twin
+        with self.cond:
+            q = self.queue
+            # frames still inside their impairment delay are in flight, only due ones are backlog
+            due = [i for i, item in enumerate(q) if item[0] <= now]
+            if len(due) >= self.queue_limit:
+                state = [i for i in due if not q[i][4]]
+                if self.policy == 'coalesce' and not is_init:
+                    # only states after the last queued init belong to the world that is current
+                    last_init = max((i for i in due if q[i][4]), default=-1)
+                    state = [i for i in state if i > last_init]
+                    parts = []
+                    for i in state:
+                        parts += q[i][2] if isinstance(q[i][2], list) else [q[i][2]]
+                        ready = min(ready, q[i][1])
+                    for i in reversed(state): del q[i]
+                    st['coalesced'] += len(state)
+                    if parts: payload = parts + [payload]     # merged by the sender, off the relay thread
+                elif is_init and state:
+                    del q[state[0]]
+                    st['dropped'] += 1
+                elif not is_init:
+                    st['dropped'] += 1
+                    return
+            q.append((now + delay, ready, payload, traced, is_init))
+            st['max_depth'] = max(st['max_depth'], len(q))
+            self.cond.notify()
+
+    def depth(self):
+        return len(self.queue)
+
+    def _run(self):
+        while self.running:
+            if self.sock is None:
+                if not self._connect(): time.sleep(RECONNECT_INTERVAL)
+                continue
+            with self.cond:
+                if not self.queue:
+                    self.cond.wait(0.5); continue
+                if self.acked is not None and self.sent_frames - self.acked >= WINDOW:
+                    self.cond.wait(0.5); continue     # woken by the twin's next ack
+                due = self.queue[0][0]
+                wait = due - time.monotonic()
+                if wait > 0:
+                    # in order: a frame never overtakes an earlier, longer-delayed one
+                    self.cond.wait(wait); continue
+                _, ready, payload, traced, is_init = self.queue.popleft()
+            if not (is_init or self.initialized):
+                continue     # the twin cannot apply state before its init packet
+            self.queue_delay.record(time.monotonic() - ready)
+            if isinstance(payload, list):
+                payload = merge_frames(payload)
+            try:
+                self._send(payload, traced)
+            except OSError as e:
+                self.stats['errors'] += 1
+                print(f"[Fanout] {self.name}: send failed: {e}")
+                if not isinstance(self.sock, UdpSender): self._disconnect()
+                continue
+            self.initialized |= bool(is_init)
+            self.sent_frames += 1
+            self.stats['sent'] += 1
+            self.stats['sent_bytes'] += len(payload)
+
+    def _send(self, payload, traced):
+        # frames are shared by all links, so relay_out goes into a per-twin copy of the header only
+        if traced:
+            hdr = bytearray(payload[:Trace.HEADER_SIZE])
+            Trace.stamp(hdr, 'relay_out')
+            body = memoryview(payload)[Trace.HEADER_SIZE:]
+        else:
+            hdr, body = b'', memoryview(payload)
+        with self.send_lock:
+            if isinstance(self.sock, UdpSender):
+                self.sock.send(bytes(hdr) + body)
+            else:
+                self.sock.sendall(FRAME_HDR.pack(len(payload), time.time()) + hdr)
+                self.sock.sendall(body)
+
+    def send_raw(self, blob, sock=None):
+        sock = sock or self.sock
+        with self.send_lock:
+            if isinstance(sock, UdpSender):
+                sock.send(blob)
+            else:
+                sock.sendall(FRAME_HDR.pack(len(blob), time.time()) + blob)
+
+    def _responder(self, conn):
+        """Reads this twin's applied acks on one connection (its clock pings go to the Scheduler's ClockResponder)."""
+        sock = conn.sock if isinstance(conn, UdpSender) else conn
+        buf = b''
+        try:
+            while self.running:
+                if isinstance(conn, UdpSender):
+                    blobs = [sock.recv(65535)]
+                else:
+                    data = sock.recv(65536)
+                    if not data: return
+                    buf += data
+                    blobs = []
+                    while len(buf) >= FRAME_HDR.size:
+                        ln, _ = FRAME_HDR.unpack_from(buf)
+                        if len(buf) < FRAME_HDR.size + ln: break
+                        blobs.append(buf[FRAME_HDR.size:FRAME_HDR.size + ln])
+                        buf = buf[FRAME_HDR.size + ln:]
+                for blob in blobs:
+                    msg = pickle.loads(blob)
+                    if isinstance(msg, dict) and msg.get('cmd') == 'applied' and conn is self.sock \
+                            and not isinstance(conn, UdpSender):
+                        with self.cond:
+                            self.acked = msg['frames']
+                            self.cond.notify()
+        except (OSError, ValueError, pickle.UnpicklingError):
+            pass
+        finally:
+            if conn is self.sock:
+                with self.cond:
+                    self.acked = None       # a closed window would hide the dead connection from the sender
+                    self.cond.notify()
+
+    def close(self):
+        """Tell the twin to shut down once its queue has drained."""
+        deadline = time.monotonic() + 2.0
+        while self.queue and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.running = False
+        with self.cond: self.cond.notify()
+        if self.sock is None: return
+        try:
+            self.send_raw(pickle.dumps({"cmd": "shutdown"}))
+        except OSError:
+            pass
+        self.sock.close()
+
+    def summary(self):
+        return dict(self.stats, depth=len(self.queue), policy=self.policy, queue_limit=self.queue_limit,
+                    impairment=self.impairment.describe(), queue_delay_ms=self.queue_delay.summary(),
+                    impairment_delay_ms=self.impairment_delay.summary())
+
+# ───────── All twins ─────────
+
+class Fanout(object):
+    """Offers every relayed frame to all twin links, or each link its shard of it (Shard.ShardRouter)."""
+
+    def __init__(self, specs, transport='tcp', queue_limit=QUEUE_LIMIT, policy='drop', keyframe=None, router=None):
+        self.router = router
+        if router is not None and keyframe is not None:
+            # a shard that joins late only gets the actors in its tiles
+            keyframes = [lambda k=k: None if router.table is None else keyframe(router.select(k))
+                         for k in range(len(specs))]
+        else:
+            keyframes = [keyframe] * len(specs)
+        self.links = [TwinLink(s, transport, queue_limit, policy, kf) for s, kf in zip(specs, keyframes)]
+
+    def offer(self, payload, traced, is_init):
+        if self.router is None:
+            for link in self.links:
+                link.offer(payload, traced, is_init)
+            return
+        for link, part in zip(self.links, self.router.split(payload, is_init)):
+            link.offer(part, traced, is_init)
+
+    def close(self):
+        for link in self.links:
+            link.close()
+
+    def summary(self):
+        return {link.name: link.summary() for link in self.links}
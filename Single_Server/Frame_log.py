@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# Frame log - append-only record of the Scheduler's ingress stream, replayable into Twin_world
+"""
+A recording is a directory holding `frames.bin`, the raw frames (trace header
+and pickle, exactly as they reached the Scheduler) back to back, and an
+append-only `index.bin` with one record per frame (offset, length, arrival
+time, flags). Frames are written by a background thread in batches; an index
+record is only written after its frame, so a recording that was killed
+mid-write is still readable up to the last indexed frame.
+
+Replay yields the frames with their recorded spacing divided by `speed`
+(speed 0 = as fast as the consumer takes them). The capture and send stamps of
+traced frames are shifted by the replay offset, so the twin's serialize and
+uplink hops keep their recorded values while relay, downlink and apply are
+measured again.
+"""
+import os, bisect, sys, threading, time
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Trace
+
+# ───────── Configuration ─────────
+INDEX_DTYPE = np.dtype([('offset', '<i8'), ('length', '<i8'), ('t_arrival', '<f8'), ('flags', '<i8')])
+FLAG_INIT = 1
+FLUSH_INTERVAL = 0.5     # seconds; buffered frames are written at least this often
+MAX_PENDING = 64 << 20   # bytes buffered before the writer is woken early
+
+# ───────── Writer ─────────
+
+class FrameLogWriter(object):
+    """Appends frames from the relay thread; disk writes happen on a background thread."""
+
+    def __init__(self, path, flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        os.makedirs(path, exist_ok=True)
+        self._data = open(os.path.join(path, 'frames.bin'), 'ab')
+        self._index = open(os.path.join(path, 'index.bin'), 'ab')
+        self._offset = self._data.tell()
+        self._pending, self._pending_bytes = [], 0
+        self.frames = self.bytes = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, payload, t_arrival, flags=0):
+        """Queue one frame; the payload is copied, so the caller may keep patching its buffer."""
+        blob = bytes(payload)
+        with self._cond:
+            self._pending.append((blob, t_arrival, flags))
+            self._pending_bytes += len(blob)
+            if self._pending_bytes >= MAX_PENDING:
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._closed and self._pending_bytes < MAX_PENDING:
+                    self._cond.wait(self.flush_interval)
+                batch, self._pending, self._pending_bytes = self._pending, [], 0
+                closed = self._closed
+            if batch:
+                self._write_batch(batch)
+            if closed:
+                break
+
+    def _write_batch(self, batch):
+        index = np.empty(len(batch), dtype=INDEX_DTYPE)
+        for i, (blob, t_arrival, flags) in enumerate(batch):
+            index[i] = (self._offset, len(blob), t_arrival, flags)
+            self._data.write(blob)
+            self._offset += len(blob)
+        self._data.flush()
+        self._index.write(index.tobytes())
+        self._index.flush()
+        self.frames += len(batch)
+        self.bytes += int(index['length'].sum())
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self._data.close()
+        self._index.close()
+
+# ───────── Reader ─────────
+
+class FrameLogReader(object):
+    """Memory-maps a recording for random access by frame number or arrival time."""
+
+    def __init__(self, path):
+        self.path = path
+        self.index = np.fromfile(os.path.join(path, 'index.bin'), dtype=INDEX_DTYPE)
+        size = os.path.getsize(os.path.join(path, 'frames.bin'))
+        # a torn tail (index written, data cut short) is never indexed, but be safe with copied files
+        self.index = self.index[self.index['offset'] + self.index['length'] <= size]
+        self.data = np.memmap(os.path.join(path, 'frames.bin'), dtype=np.uint8, mode='r') if size else b''
+        self._times = self.index['t_arrival'].tolist()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, n):
+        off, ln, t_arrival, flags = self.index[n]
+        return bytes(self.data[off:off + ln]), float(t_arrival), int(flags)
+
+    def seek(self, t):
+        """Number of the first frame that arrived at or after recording time t."""
+        return bisect.bisect_left(self._times, t)
+
+    def duration(self):
+        return self._times[-1] - self._times[0] if self._times else 0.0
+
+    def close(self):
+        self.data = b''
+
+    def summary(self):
+        return {'frames': len(self), 'bytes': int(self.index['length'].sum()), 'duration_s': self.duration(),
+                'init_frames': int(np.count_nonzero(self.index['flags'] & FLAG_INIT))}
+
+    def replay(self, speed=1.0, start=0):
+        """Yield (payload, t_arrival, flags) paced like the recording; speed 0 = no pacing."""
+        if start >= len(self): return
+        t_first = self._times[start]
+        wall0 = time.monotonic()
+        frames = range(start, len(self))
+        if start > 0:
+            # a twin joining mid-recording still needs the last init frame first
+            inits = np.flatnonzero(self.index['flags'][:start] & FLAG_INIT)
+            if len(inits): frames = [int(inits[-1])] + list(frames)
+        for n in frames:
+            payload, t_arrival, flags = self[n]
+            if speed > 0:
+                wait = wall0 + max(t_arrival - t_first, 0.0) / speed - time.monotonic()
+                if wait > 0: time.sleep(wait)
+            hdr = Trace.read_header(payload)
+            if hdr is not None:
+                # keep the recorded serialize / uplink hops, relative to this replay's arrival
+                shift = Trace.now() - t_arrival
+                payload = bytearray(payload)
+                _, _, stamps = hdr
+                if stamps[0]: Trace.stamp(payload, 'capture', stamps[0] + shift)
+                if stamps[1]: Trace.stamp(payload, 'send', stamps[1] + shift)
+            yield payload, t_arrival, flags
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# Keyframe cache - the Scheduler's copy of the full world state, sent to twins that join late
+"""
+The relay hands every ingress frame to WorldState.update(), which only keeps a
+reference to it. A background thread unpickles the queued frames in batches
+and folds them into one entity table (id -> latest entity dict), so the relay
+thread never unpickles anything and the table costs one dict per actor.
+
+    init frame    replaces the entities of its source (a restarted physical world
+                  brings new actor ids; with --sources only that source's actors go)
+    state frame   updates its entities field by field; partial frames only touch
+                  the actors they carry
+
+keyframe() folds what is still queued and returns the table as an untraced
+init frame ({'init': True, 'keyframe': True, 'vehicles': [...]}), with the
+lane index of the last init when its poses are lane-coded. A twin that
+connects or reconnects gets it first and is complete after one frame, instead
+of waiting for an init packet the physical world sent long ago. Like
+Twin_world, the table never forgets an actor.
+"""
+import pickle, sys, os, threading
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Trace
+
+# ───────── Configuration ─────────
+FOLD_EVERY = 25      # queued frames that wake the fold thread
+
+class WorldState(object):
+
+    def __init__(self, fold_every=FOLD_EVERY):
+        self.fold_every = fold_every
+        self.entities = {}          # id -> latest entity dict
+        self.pending = []           # (payload, is_init) not folded yet
+        self.lock = threading.Lock()        # guards entities
+        self.cond = threading.Condition()   # guards pending
+        self.ready = False                  # an init frame has been folded
+        self.lane_index = None              # lane index key of lane-coded poses (Physical_world --lane-codec)
+        self.quant = None                   # quantizer spec of fixed-point poses (Physical_world --quantize)
+        self.stats = dict(frames=0, folded=0, keyframes=0)
+        self.running = True
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def update(self, payload, is_init):
+        """Queue one ingress frame; O(1) on the relay thread."""
+        with self.cond:
+            self.pending.append((payload, is_init))
+            self.stats['frames'] += 1
+            if len(self.pending) >= self.fold_every:
+                self.cond.notify()
+
+    def _run(self):
+        while self.running:
+            with self.cond:
+                if len(self.pending) < self.fold_every:
+                    self.cond.wait(0.5)
+            self._fold()
+
+    def _fold(self):
+        with self.lock:
+            with self.cond:
+                batch, self.pending = self.pending, []
+            for payload, is_init in batch:
+                msg = pickle.loads(Trace.payload(payload))
+                if is_init:
+                    vehicles = msg.get('vehicles', [])
+                    self.lane_index = msg.get('lane_index', self.lane_index)
+                    self.quant = msg.get('quant', self.quant)
+                    sources = {e.get('source') for e in vehicles}
+                    self.entities = {i: e for i, e in self.entities.items() if e.get('source') not in sources}
+                    for e in vehicles:
+                        self.entities[e['id']] = e
+                    self.ready = True
+                elif isinstance(msg, list):
+                    for e in msg:
+                        cur = self.entities.get(e['id'])
+                        if cur is None: self.entities[e['id']] = e
+                        else: cur.update(e)
+            self.stats['folded'] += len(batch)
+
+    def keyframe(self, select=None):
+        """The current world (the entities select() accepts) as an init frame, or None before the first init."""
+        self._fold()
+        with self.lock:
+            if not self.ready: return None
+            self.stats['keyframes'] += 1
+            vehicles = [e for e in self.entities.values() if select is None or select(e)]
+            frame = {'init': True, 'keyframe': True, 'vehicles': vehicles}
+            if self.lane_index is not None: frame['lane_index'] = self.lane_index
+            if self.quant is not None: frame['quant'] = self.quant
+            return pickle.dumps(frame)
+
+    def close(self):
+        self.running = False
+        with self.cond: self.cond.notify()
+
+    def summary(self):
+        return dict(self.stats, entities=len(self.entities))
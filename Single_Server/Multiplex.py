@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# Physical-world multiplexer - several Physical_world streams merged into one twin stream
+"""
+Each physical source k sends its own init packet and state frames to the
+Scheduler. The Multiplexer turns them into one stream for one twin:
+
+- id namespacing: actor ids become k * ID_STRIDE + id, so equal CARLA ids from
+  different worlds stay distinct in the twin (k = source index in connect order)
+- clock alignment: each source's sim time is mapped onto the Scheduler's clock
+  with offset_k = min(arrival - sim time), the least-delayed frame seen so far
+  (a min filter, like the NTP-style estimate in Clock_sync)
+- merging: aligned sim time is cut into ticks; a merged frame for tick b holds
+  the latest states of every source in b and is emitted once every source has
+  moved past b, or after MERGE_WAIT seconds when a source stalls; two frames
+  of one source in the same tick are merged by actor id, field by field, the
+  newer frame winning (a partial --lod frame keeps the actors it skips)
+
+Init packets are forwarded one per source (namespaced), so sources may join at
+different times. Their timestamps are aligned like the merged frames' (the
+init is also an offset sample), so the twin and the AoI scheduler compare
+times of one clock. The merged frame's trace header keeps the earliest capture and
+send stamps of its parts, so the twin's end-to-end latency covers the oldest
+contribution.
+"""
+import collections, os, pickle, queue, sys, threading
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Trace
+
+# ───────── Configuration ─────────
+ID_STRIDE = 1 << 32        # id namespace per source
+MERGE_TICK = 0.02          # seconds of aligned sim time per merged frame (the physical fixed delta)
+MERGE_WAIT = 0.2           # seconds a tick waits for a stalled source before it is emitted without it
+
+class Multiplexer(object):
+
+    def __init__(self, sources, tick=MERGE_TICK, wait=MERGE_WAIT):
+        self.sources, self.tick, self.wait = sources, tick, wait
+        self.lock = threading.Lock()
+        self.out = queue.Queue()
+        self.offset = {}                       # source -> clock offset (Scheduler clock - sim time)
+        self.newest = {}                       # source -> newest tick seen
+        self.active = set(range(sources))
+        self.pending = collections.OrderedDict()   # tick -> {source: ({id: entity}, capture, send, t_send)}
+        self.first_seen = {}                   # tick -> Scheduler time its first part arrived
+        self.emitted = None                    # newest emitted tick
+        self.seq = 0
+        self.stats = dict(frames_in=0, inits=0, merged=0, partial=0, late=0, coalesced=0, sources=sources)
+
+    def _namespace(self, k, entities, ts=None):
+        base = k * ID_STRIDE
+        for e in entities:
+            e['id'] = base + e['id']
+            e['source'] = k
+            if ts is not None: e['physical_timestamp'] = ts
+        return entities
+
+    def push(self, k, payload, t_send):
+        """One frame of source k, in arrival order; merged frames appear on frames()."""
+        t_arr = Trace.now()
+        hdr = Trace.read_header(payload)
+        msg = pickle.loads(Trace.payload(payload))
+        stamps = hdr[2] if hdr is not None else [0.0] * len(Trace.STAMPS)
+        with self.lock:
+            self.stats['frames_in'] += 1
+            if isinstance(msg, dict):
+                if msg.get('init'):
+                    self.stats['inits'] += 1
+                    vehicles = msg.get('vehicles', [])
+                    ts = next((e['physical_timestamp'] for e in vehicles if 'physical_timestamp' in e), None)
+                    if ts is None:
+                        ts = t_arr
+                    else:
+                        self.offset[k] = min(self.offset.get(k, float('inf')), t_arr - ts)
+                        ts += self.offset[k]
+                    msg['vehicles'] = self._namespace(k, vehicles, ts)
+                    self._emit(msg, stamps[0], stamps[1], t_send, Trace.FLAG_INIT)
+                return
+            ts = next((e['physical_timestamp'] for e in msg if 'physical_timestamp' in e), None)
+            if ts is None: return
+            self.offset[k] = min(self.offset.get(k, float('inf')), t_arr - ts)
+            b = int(round((ts + self.offset[k]) / self.tick))
+            if self.emitted is not None and b <= self.emitted:
+                self.stats['late'] += 1
+                b = self.emitted + 1
+            self.newest[k] = max(self.newest.get(k, b), b)
+            if b not in self.pending:
+                self.pending[b] = {}
+                self.first_seen[b] = t_arr
+                if len(self.pending) > 1 and b < next(reversed(self.pending)):
+                    self.pending = collections.OrderedDict(sorted(self.pending.items()))
+            capture, send = stamps[0] or t_arr, stamps[1] or t_arr
+            part = self.pending[b].get(k)
+            if part is None:
+                self.pending[b][k] = ({e['id']: e for e in msg}, capture, send, t_send)
+            else:
+                # another frame of k in this tick: newest fields win, actors it does not carry stay
+                ents = part[0]
+                for e in msg:
+                    ents[e['id']] = {**ents[e['id']], **e} if e['id'] in ents else e
+                self.pending[b][k] = (ents, min(part[1], capture), min(part[2], send), min(part[3], t_send))
+                self.stats['coalesced'] += 1
+            self._flush(t_arr)
+
+    def _flush(self, now):
+        while self.pending:
+            b, parts = next(iter(self.pending.items()))
+            complete = all(self.newest.get(k, -1) >= b for k in self.active) and len(parts) >= len(self.active)
+            passed = all(self.newest.get(k, -1) > b for k in self.active)
+            if not (complete or passed or now - self.first_seen[b] > self.wait):
+                break
+            del self.pending[b]; del self.first_seen[b]
+            if len(parts) < len(self.active): self.stats['partial'] += 1
+            ts = b * self.tick
+            entities = [e for k, (ents, _, _, _) in sorted(parts.items()) for e in self._namespace(k, ents.values(), ts)]
+            capture = min(p[1] for p in parts.values())
+            send = min(p[2] for p in parts.values())
+            t_send = min(p[3] for p in parts.values())
+            self._emit(entities, capture, send, t_send, 0)
+            self.emitted = b
+            self.stats['merged'] += 1
+
+    def _emit(self, msg, capture, send, t_send, flags):
+        self.seq += 1
+        hdr = bytearray(Trace.pack_header(self.seq, capture, flags))
+        Trace.stamp(hdr, 'send', send)
+        self.out.put((hdr + pickle.dumps(msg), t_send))
+
+    def source_closed(self, k):
+        """A source that disconnected no longer holds back merged frames."""
+        with self.lock:
+            self.active.discard(k)
+            print(f"[Multiplex] source {k} closed, {len(self.active)} left")
+            self._flush(Trace.now())
+            if not self.active:
+                self.out.put(None)
+
+    def frames(self):
+        """Yields merged (payload, send time) like the Scheduler's per-transport frame generators."""
+        while True:
+            try:
+                item = self.out.get(timeout=self.wait)
+            except queue.Empty:
+                with self.lock: self._flush(Trace.now())     # emit ticks a stalled source holds back
+                continue
+            if item is None: return
+            yield item
+
+    def close(self):
+        self.out.put(None)
+
+    def summary(self):
+        return dict(self.stats, offsets={k: round(v, 6) for k, v in self.offset.items()})
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 # CARLA1 Sender - Robust, timestamped, multi-run safe + graceful shutdown
 
-import glob, os, sys, time, argparse, socket, threading, pickle, csv, copy
+import glob, os, sys, time, argparse, socket, threading, pickle, copy, struct
 from numpy import random
 
 try:
@@ -12,7 +12,18 @@ try:
 except IndexError:
     pass
 
-import carla
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+if os.environ.get('CARLA_STANDIN'):
+    import Carla_standin as carla    # kinematic stand-in, no simulator needed
+else:
+    import carla
+from Trajectory_log import open_vehicle_log
+from Shm_transport import ShmRing, FLAG_INIT
+from Udp_transport import UdpSender
+from Lod import LodPolicy, LOD_BANDS
+from Lane_codec import LaneIndex, LaneCodec
+from Quantize import Quantizer, QUANT_SPEC
+import Trace
 
 def get_blueprints(world, filt, gen="All"):
     bps = world.get_blueprint_library().filter(filt)
@@ -53,47 +64,102 @@ def extract_actor_states(world, v_ids, w_ids):
             })
     return data
 
-def start_sender(world, vehicles, walkers, ip='127.0.0.1', port=8999, shutdown_event=None):
+def focus_points(world, focus, data, hero):
+    """(x, y) of each LOD focus: 'hero' (the first vehicle), 'spectator' (the camera) or 'x,y'."""
+    points = []
+    for f in focus:
+        if f == 'hero':
+            points += [e['loc'][:2] for e in data if e['id'] == hero][:1]
+        elif f == 'spectator':
+            loc = world.get_spectator().get_transform().location
+            points.append((loc.x, loc.y))
+        else:
+            points.append(tuple(float(v) for v in f.split(',')))
+    return points
+
+def start_sender(world, vehicles, walkers, ip='127.0.0.1', port=8999, shutdown_event=None, log_format='columnar',
+                 transport='tcp', shm_name='carla_twin', period=0.02, lod_bands=None, lod_focus=('hero',),
+                 lane_codec=False, quant_spec=None):
+    # distance-based level of detail: far actors are sent every few ticks only (Lod.py)
+    lod = LodPolicy(lod_bands) if lod_bands else None
+    # vehicle poses as lane coordinates (Lane_codec.py); the index is cached on disk per town
+    codec = None
+    if lane_codec:
+        t0 = time.time()
+        codec = LaneCodec(LaneIndex.for_map(world.get_map()))
+        print(f"[Sender] Lane index {codec.index.summary()} ready in {time.time() - t0:.2f}s")
+    # poses as error-bounded fixed-point integers (Quantize.py)
+    quant = Quantizer(quant_spec) if quant_spec else None
+    hero = vehicles[0] if vehicles else None
     def run():
-        log_path = 'physical_vehicle_log4.csv'
-        with open(log_path, 'w', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow(['timestamp','id','x','y','z'])
-            try:
+        # 'captured' is the Trace clock at capture, what Sync_analyzer measures the twin's apply times against
+        log = open_vehicle_log('physical_vehicle_log4', log_format, ('captured',))
+        sock = None
+        try:
+            if transport == 'shm':
+                sock = ShmRing.attach(shm_name)
+                send = lambda blob, init=False: sock.write(blob, FLAG_INIT if init else 0)
+                print(f"[Sender] Attached to scheduler ring '{shm_name}'")
+            elif transport == 'udp':
+                sock = UdpSender((ip, port))
+                send = lambda blob, init=False: sock.send(blob)
+                print(f"[Sender] Sending datagrams to scheduler at {ip}:{port}")
+            else:
                 sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 sock.connect((ip, port))
+                send = lambda blob, init=False: sock.sendall(struct.pack('>Id', len(blob), time.time()) + blob)
                 print(f"[Sender] Connected to scheduler at {ip}:{port}")
 
-                ts0 = world.get_snapshot().timestamp.elapsed_seconds
-                init_payload = extract_actor_states(world, vehicles, walkers)
-                for e in init_payload: e['physical_timestamp'] = ts0
-                blob = pickle.dumps({'init': True, 'vehicles': init_payload})
-                sock.sendall(len(blob).to_bytes(4, 'big') + blob)
-                print(f"[Sender] Init packet sent ({len(init_payload)} entities)")
-
-                while not shutdown_event.is_set():
-                    ts = world.get_snapshot().timestamp.elapsed_seconds
-                    data = extract_actor_states(world, vehicles, walkers)
-                    for e in data:
-                        e['physical_timestamp'] = ts
-                        if e['type'] == 'vehicle':
-                            x, y, z = e['loc']
-                            writer.writerow([ts, e['id'], x, y, z])
-                    f.flush()
-                    blob = pickle.dumps(copy.deepcopy(data))
-                    try:
-                        sock.sendall(len(blob).to_bytes(4, 'big') + blob)
-                    except BrokenPipeError:
-                        print("[Sender] Scheduler closed connection. Shutting down sender...")
-                        shutdown_event.set()
-                        break
-                    time.sleep(0.02)
-            except Exception as e:
-                print(f"[Sender Error] {e}")
-                shutdown_event.set()
-            finally:
-                sock.close()
+            capture = Trace.now()
+            ts0 = world.get_snapshot().timestamp.elapsed_seconds
+            init_payload = extract_actor_states(world, vehicles, walkers)
+            for e in init_payload: e['physical_timestamp'] = ts0
+            # a sample of the road network, for routers that cut the map into regions (Scheduler --shard)
+            pts = world.get_map().get_spawn_points()
+            roads = [(p.location.x, p.location.y) for p in pts[::max(1, len(pts) // 2000)]]
+            init = {'init': True, 'vehicles': init_payload, 'roads': roads}
+            if codec is not None: init['lane_index'] = (codec.index.key, codec.index.spacing)
+            if quant is not None: init['quant'] = quant.spec; init['vehicles'] = quant.encode(init_payload)
+            body = pickle.dumps(init)
+            send(Trace.pack_header(0, capture, Trace.FLAG_INIT) + body, init=True)
+            print(f"[Sender] Init packet sent ({len(init_payload)} entities)")
+
+            seq = 0
+            while not shutdown_event.is_set():
+                capture = Trace.now()
+                ts = world.get_snapshot().timestamp.elapsed_seconds
+                data = extract_actor_states(world, vehicles, walkers)
+                ids, xs, ys, zs = [], [], [], []
+                for e in data:
+                    e['physical_timestamp'] = ts
+                    if e['type'] == 'vehicle':
+                        x, y, z = e['loc']
+                        ids.append(e['id']); xs.append(x); ys.append(y); zs.append(z)
+                log.write(ts, ids, xs, ys, zs, capture)
+                if lod is not None:
+                    lod.focus(focus_points(world, lod_focus, data, hero))
+                    data = lod.select(data)
+                if codec is not None: data = codec.encode(data)
+                if quant is not None: data = quant.encode(data)
+                body = pickle.dumps(copy.deepcopy(data))
+                if lod is not None: lod.account(len(body))
+                seq += 1
+                blob = Trace.pack_header(seq, capture) + body
+                try:
+                    send(blob)
+                except BrokenPipeError:
+                    print("[Sender] Scheduler closed connection. Shutting down sender...")
+                    shutdown_event.set()
+                    break
+                time.sleep(period)
+        except Exception as e:
+            print(f"[Sender Error] {e}")
+            shutdown_event.set()
+        finally:
+            if sock is not None: sock.close()
+            log.close()
     threading.Thread(target=run, daemon=True).start()
+    return lod, codec, quant
 
 def main():
     parser = argparse.ArgumentParser()
@@ -104,6 +170,18 @@ def main():
     parser.add_argument('--tm-port',type=int,default=8000)
     parser.add_argument('--scheduler-ip',default='127.0.0.1')
     parser.add_argument('--scheduler-port',type=int,default=8999)
+    parser.add_argument('--log-format',choices=['columnar','csv'],default='columnar')
+    parser.add_argument('--transport',choices=['tcp','udp','shm'],default='tcp')
+    parser.add_argument('--shm-name',default='carla_twin')
+    parser.add_argument('--fixed-delta',type=float,default=0.02)
+    parser.add_argument('--lod',nargs='?',const=LOD_BANDS,default=None,metavar='BANDS',
+                        help='send far actors every k-th tick only, bands as metres:k,...')
+    parser.add_argument('--lane-codec',action='store_true',
+                        help='send vehicle poses as lane coordinates (not with Scheduler --shard or --budget)')
+    parser.add_argument('--quantize',nargs='?',const=QUANT_SPEC,default=None,metavar='SPEC',
+                        help='send poses as fixed-point integers, field:max error:int type,... (not with Scheduler --shard or --budget)')
+    parser.add_argument('--lod-focus',nargs='+',default=['hero'],metavar='FOCUS',
+                        help="LOD focus points: 'hero' (first vehicle), 'spectator' or x,y")
     args = parser.parse_args()
 
     client = carla.Client(args.host, args.port); client.set_timeout(10)
@@ -117,7 +195,7 @@ def main():
 
     settings = world.get_settings()
     settings.synchronous_mode = True
-    settings.fixed_delta_seconds = 0.02
+    settings.fixed_delta_seconds = args.fixed_delta
     world.apply_settings(settings)
 
     v_bps = get_blueprints(world, 'vehicle.*', 'All')
@@ -145,7 +223,9 @@ def main():
     world.tick()
 
     shutdown_event = threading.Event()
-    start_sender(world, vehicles, walkers, args.scheduler_ip, args.scheduler_port, shutdown_event)
+    lod, codec, quant = start_sender(world, vehicles, walkers, args.scheduler_ip, args.scheduler_port, shutdown_event,
+                              args.log_format, args.transport, args.shm_name, args.fixed_delta, args.lod, args.lod_focus,
+                              args.lane_codec, args.quantize)
 
     print(f"[CARLA1] Running with {len(vehicles)} vehicles, {len(walkers)} walkers.")
     try:
@@ -156,6 +236,9 @@ def main():
     finally:
         client.apply_batch([carla.command.DestroyActor(x) for x in vehicles])
         client.apply_batch([carla.command.DestroyActor(w['id']) for w in walkers])
+        if lod is not None: print(f"[CARLA1] LOD {lod.summary()}")
+        if codec is not None: print(f"[CARLA1] Lane codec {codec.summary()}")
+        if quant is not None: print(f"[CARLA1] Quantizer {quant.summary()}")
         print("[CARLA1] Cleanup complete.")
 
 if __name__ == '__main__':
@@ -5,16 +5,71 @@ import pickle
 import time
 import struct
 import argparse
+import os
+import sys
+import queue
+
+from Shm_transport import ShmRing, SHM_NAME, POLL_SLEEP, FLAG_INIT, SLOTS as SHM_SLOTS
+from Aoi_scheduler import AoiScheduler
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Latency_hist import LatencyHistogram, dump_histograms, load_histograms
+from Udp_transport import UdpSender, UdpReceiver
+import Trace
+from Clock_sync import ClockResponder, CLOCK_PORT
+from Link_shaper import LinkShaper
+from Frame_log import FrameLogWriter, FrameLogReader, FLAG_INIT as LOG_INIT
+from Metrics import MetricsRegistry, serve as serve_metrics
+from Fanout import Fanout, POLICIES as FANOUT_POLICIES, QUEUE_LIMIT as TWIN_QUEUE, RECONNECT_INTERVAL
+from Multiplex import Multiplexer, MERGE_TICK
+from Keyframe import WorldState
+from Shard import ShardRouter, TILE_SIZE
+import Impairment
 
 # ───────── Configuration ─────────
 RECV_PORT = 8999
 SEND_IP, SEND_PORT = '127.0.0.1', 9999
 MAX_RUNTIME = 600
+TRANSPORT = 'tcp'     # 'tcp', 'udp' or 'shm' (shared-memory ring, single host only)
+FRAME_HDR = struct.Struct('>Id')   # TCP frame header: payload length, send time
+DROP_PROBABILITY = 0.0   # share of state frames dropped (the init packet is never dropped)
+DELAY = 0.0              # seconds every frame is held before it is forwarded
+IMPAIRMENT = None        # Impairment spec ('ge:...', 'trace:...') replacing DROP_PROBABILITY / DELAY
+LINK_BUDGET = None       # bytes/s; when set, state frames are cut down to the actors with the highest AoI priority
+LINK_RATE = None         # bytes/s; when set, frames queue behind each other on a token-bucket shaped link
+SHAPER_POLICY = 'strict' # 'strict' or 'wfq' service between the spawn (init) and state classes
+RECORD = None           # directory; when set, every ingress frame is appended to a Frame_log recording
+REPLAY = None           # directory; when set, a recording replaces CARLA1 as the frame source
+REPLAY_SPEED = 1.0      # replay pacing: 1 = real time, 2 = twice as fast, 0 = as fast as the twin takes frames
+METRICS_PORT = None     # local HTTP port for /metrics (Prometheus text) and /metrics.json
+METRICS_DUMP = None     # seconds between scheduler_metrics.json snapshots
+TWINS = []              # 'host:port[=impairment]' per twin; when set, frames fan out to all of them
+TWIN_POLICY = 'drop'    # what a full twin queue does with a new state frame: 'drop' it or 'coalesce' (latest wins)
+SHARD = False           # split the fleet across the --twins by map tile instead of sending every twin everything
+SHARD_TILE = TILE_SIZE  # metres per shard tile
+RELAY_QUEUE = None      # frames; when set, CARLA2 is sent to from a queue that coalesces under overload, not from the listener
+SOURCES = 1             # physical worlds merged into one twin stream (ids namespaced, frames merged on sim time)
 
 # Global state for synchronization
 initialized = False
 state_lock = threading.Lock()
 send_sock = None
+ingress_latency = LatencyHistogram()   # CARLA1 send -> scheduler arrival
+frame_stats = {'frames': 0, 'bytes': 0, 'dropped': 0, 'forwarded': 0, 'forwarded_bytes': 0, 'sent': 0, 'sent_bytes': 0,
+               'offered': 0, 'offered_bytes': 0}
+drop_reasons = {'impairment': 0, 'budget': 0, 'queue_full': 0, 'uninitialized': 0, 'twin_down': 0, 'overwritten': 0}
+relay_latency = LatencyHistogram()     # relay_in -> relay_out of traced frames
+delay_queue = None                     # frames held by the delay line
+metrics = None                         # MetricsRegistry, read only when scraped or dumped
+fanout = None                          # Fanout over several twins, replaces send_sock
+mux = None                             # Multiplexer over several physical sources
+world_state = None                     # WorldState behind the keyframes for twins that join late (tcp/udp)
+router = None                          # ShardRouter when the twins are shards of one world
+aoi = None                             # AoiScheduler in link-budget mode
+shaper = None                          # LinkShaper in rate-limited mode
+impairment = None                      # loss / delay model, stepped once per frame
+recorder = None                        # FrameLogWriter when recording
+replay_done = threading.Event()        # set once a replay has sent its last frame
+refused = threading.Event()            # set when the physical stream cannot be relayed in this mode
 
 # ───────── Utility Functions ─────────
 
@@ -28,74 +83,449 @@ def recv_exact(sock, n):
         buf += data
     return buf
 
+def tcp_frames(conn_in):
+    """Yields (payload, send time) from the length-prefixed CARLA1 stream."""
+    while True:
+        hdr = recv_exact(conn_in, FRAME_HDR.size)
+        if not hdr:
+            return
+        ln, t_send = FRAME_HDR.unpack(hdr)
+        payload = recv_exact(conn_in, ln)
+        if not payload:
+            return
+        yield payload, t_send
+
+def source_reader(k, frames, conn):
+    """Feeds one physical source's frames to the multiplexer."""
+    try:
+        for payload, t_send in frames:
+            mux.push(k, payload, t_send)
+    except Exception as e:
+        print(f"[Scheduler] Source {k} error:", e)
+    finally:
+        conn.close()
+        mux.source_closed(k)
+
+def udp_sources(rx):
+    """Feeds datagram frames to the multiplexer; a source is one sending address."""
+    index = {}
+    while True:
+        addr, _, t_send, payload = rx.recv()
+        if addr not in index:
+            if len(index) == SOURCES: continue
+            index[addr] = len(index)
+            metrics.peers[f"physical {index[addr]}"] = f"{addr[0]}:{addr[1]}"
+            print(f"[Scheduler] Physical source {index[addr]} at {addr}")
+        mux.push(index[addr], payload, t_send)
+
+def udp_frames(rx):
+    """Yields (payload, send time) of reassembled, in-order CARLA1 datagrams."""
+    last = None
+    while True:
+        addr, _, t_send, payload = rx.recv()
+        if addr != last:
+            last = addr
+            metrics.peers['physical'] = f"{addr[0]}:{addr[1]}"
+        yield payload, t_send
+
+def replay_frames(reader, speed):
+    """Yields (payload, send time) from a recording in place of the CARLA1 stream."""
+    for payload, _, _ in reader.replay(speed):
+        yield payload, time.time()
+    print(f"[Scheduler] Replay finished ({len(reader)} frames)")
+    replay_done.set()
+
+def send_frame(payload):
+    """Forwards one frame to CARLA2 over whichever transport send_sock is."""
+    if isinstance(send_sock, UdpSender):
+        send_sock.send(payload)
+    else:
+        send_sock.sendall(FRAME_HDR.pack(len(payload), time.time()) + payload)
+
+def forward(payload):
+    """send_frame for the relay (state_lock held); a broken CARLA2 connection is reconnected instead of ending the relay."""
+    global send_sock, initialized
+    try:
+        send_frame(payload)
+    except OSError as e:
+        drop_reasons['twin_down'] += 1
+        if not isinstance(send_sock, UdpSender):
+            print(f"[Scheduler] Lost CARLA2 ({e}), reconnecting")
+            send_sock.close()
+            send_sock, initialized = None, False
+            threading.Thread(target=twin_connector, daemon=True).start()
+        return False
+    frame_stats['sent'] += 1; frame_stats['sent_bytes'] += len(payload)
+    return True
+
+def twin_connector():
+    """Connects to CARLA2 once it is up; a twin that joins mid-run gets the keyframe before any state frame."""
+    global send_sock, initialized
+    while True:
+        try:
+            sock = socket.create_connection((SEND_IP, SEND_PORT))
+            break
+        except OSError:
+            time.sleep(RECONNECT_INTERVAL)
+    with state_lock:
+        # taken under the lock, so every frame the relay skipped while the twin was down is in it
+        frame = world_state.keyframe()
+        send_sock = sock
+        metrics.peers['twin'] = f"{SEND_IP}:{SEND_PORT}"
+        print(f"[Scheduler] Connected to CARLA2 at {SEND_IP}:{SEND_PORT}")
+        threading.Thread(target=twin_reader, args=(sock,), daemon=True).start()
+        if frame is not None and forward(frame):
+            initialized = True
+            print(f"[Scheduler] Sent keyframe ({len(frame)} bytes)")
+
+def twin_reader(sock):
+    """Drains what CARLA2 sends back on the frame connection (applied acks), so its replies never block it.
+    Clock pings do not come this way: the ClockResponder answers them without waiting behind frames."""
+    try:
+        if isinstance(sock, UdpSender):
+            while True:
+                sock.sock.recv(65535)
+        else:
+            for _ in tcp_frames(sock):
+                pass
+    except Exception as e:
+        print("[Scheduler] Twin reader stopped:", e)
+
 # ───────── Receiver Thread ─────────
 
-def listener(conn_in):
+def relay(payload, traced, is_init):
+    """Forwards one frame to CARLA2 once the twin has been initialized."""
+    global initialized
+    if fanout is not None:
+        # every twin link applies its own impairment, queue and relay_out stamp
+        if traced: relay_latency.record(Trace.now() - Trace.read_header(payload)[2][2])
+        fanout.offer(payload, traced, is_init)
+        frame_stats['offered'] += 1; frame_stats['offered_bytes'] += len(payload)
+        return
+    with state_lock:
+        if send_sock is None:       # CARLA2 is down; twin_connector sends it a keyframe when it is back
+            drop_reasons['twin_down'] += 1
+            return
+        if traced:
+            t_out = Trace.now()
+            Trace.stamp(payload, 'relay_out', t_out)
+            relay_latency.record(t_out - Trace.read_header(payload)[2][2])
+
+        # Handle Init Packet: Synchronize and initialize the twin world
+        if is_init:
+            if forward(payload):
+                initialized = True
+                print(f"[Scheduler] Forwarded initialization packet")
+            return
+
+        # Forward all vehicle state data immediately to maintain full synchronization
+        if initialized:
+            forward(payload)
+        else:
+            drop_reasons['uninitialized'] += 1
+
+def coded_poses(payload):
+    """Why --shard / --budget cannot relay the stream an init packet announces, or None."""
+    msg = pickle.loads(Trace.payload(payload))
+    if not isinstance(msg, dict): return None
+    # both read each actor's raw 'loc' (and 'vel'): lane-coded frames do not carry it, quantized ones carry integer bytes
+    codings = [flag for key, flag in (('lane_index', '--lane-codec'), ('quant', '--quantize')) if msg.get(key)]
+    modes = [flag for flag, on in (('--shard', router is not None), ('--budget', aoi is not None)) if on]
+    if codings and modes:
+        return (f"Physical_world {' and '.join(codings)} sends no raw poses, and {' and '.join(modes)} "
+                f"need them; restart Physical_world without {' and '.join(codings)} or the Scheduler without {' and '.join(modes)}")
+    return None
+
+def dispatch(frame):
+    """Relays a frame now, or queues it on the shaped link."""
+    if shaper is None:
+        relay(*frame)
+    else:
+        payload, _, is_init = frame
+        if not shaper.enqueue('spawn' if is_init else 'state', len(payload), frame):
+            drop_reasons['queue_full'] += 1
+
+def delay_line(held):
+    """Releases frames when they are due, in arrival order (a frame never overtakes an earlier, longer-delayed one)."""
+    while True:
+        due, frame = held.get()
+        wait = due - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        dispatch(frame)
+
+def listener(frames, conn_in):
     """Listens to CARLA1, updates local state, and handles initialization logic."""
-    global initialized, send_sock
+    global delay_queue
+    held = None
+    if impairment.may_delay:
+        held = delay_queue = queue.Queue()
+        threading.Thread(target=delay_line, args=(held,), daemon=True).start()
     try:
-        while True:
-            hdr = recv_exact(conn_in, 4)
-            if not hdr: 
-                break
-            ln = struct.unpack('>I', hdr)[0]
-            payload = recv_exact(conn_in, ln)
-            if not payload: 
-                break
-            
-            data = pickle.loads(payload)
-
-            with state_lock:
-                # Handle Init Packet: Synchronize and initialize the twin world
-                if isinstance(data, dict) and data.get('init'):
-                    send_sock.sendall(len(payload).to_bytes(4, 'big') + payload)
-                    initialized = True
-                    print(f"[Scheduler] Forwarded initialization packet")
-                    continue
+        for payload, t_send in frames:
+            t_in = Trace.now()
+            ingress_latency.record(time.time() - t_send)
+            hdr = Trace.read_header(payload)
+            if hdr is None:
+                data = pickle.loads(payload)
+                is_init = isinstance(data, dict) and data.get('init')
+            else:
+                # traced frames are never unpickled here, only their header is patched
+                payload = bytearray(payload)
+                Trace.stamp(payload, 'relay_in', t_in)
+                is_init = hdr[0] & Trace.FLAG_INIT
+            if is_init and (aoi is not None or router is not None):
+                reason = coded_poses(payload)
+                if reason:
+                    print(f"[Scheduler] Refusing the physical stream: {reason}")
+                    refused.set()
+                    return
+            if recorder is not None:
+                recorder.write(payload, t_in, LOG_INIT if is_init else 0)
+            world_state.update(payload, is_init)
+            frame_stats['frames'] += 1
+            frame_stats['bytes'] += len(payload)
 
-                # Forward all vehicle state data immediately to maintain full synchronization
-                if initialized:
-                    send_sock.sendall(len(payload).to_bytes(4, 'big') + payload)
+            if aoi is not None:
+                if is_init:
+                    aoi.on_init(payload)
+                else:
+                    payload = aoi.schedule(payload)
+                    if payload is None:             # nothing fits the link budget this frame
+                        drop_reasons['budget'] += 1
+                        continue
+            lost, delay = impairment.step()
+            if lost and not is_init:
+                frame_stats['dropped'] += 1
+                drop_reasons['impairment'] += 1
+                continue
+            frame_stats['forwarded'] += 1
+            frame_stats['forwarded_bytes'] += len(payload)
+            if held is not None:
+                held.put((time.time() + delay, (payload, hdr is not None, is_init)))
+            else:
+                dispatch((payload, hdr is not None, is_init))
 
     except Exception as e:
         print("[Scheduler] Listener error:", e)
     finally:
         conn_in.close()
 
+def shm_gate(ring):
+    """Shared-memory counterpart of listener: frames stay in the ring, only their visibility is decided here.
+
+    Every frame is decided when it is first seen; the ring only holds SLOTS frames, so it cannot delay them
+    (delaying impairments are refused for shm at startup).
+    """
+    global initialized
+    while not ring.closed:
+        gate = ring.next_gate
+        frames = ring.pending()
+        if ring.next_gate > gate:
+            # the writer lapped the gate: these frames were overwritten before they could be gated
+            lapped = ring.next_gate - gate
+            frame_stats['frames'] += lapped; frame_stats['dropped'] += lapped
+            drop_reasons['overwritten'] += lapped
+            print(f"[Scheduler] {lapped} frames overwritten in the ring before they were gated")
+        for n, flags, t_write, ln in frames:
+            t_in = Trace.now()
+            ingress_latency.record(time.monotonic() - t_write)
+            Trace.stamp(ring.buf, 'relay_in', t_in, base=ring.payload_offset(n))
+            if recorder is not None:
+                off = ring.payload_offset(n)
+                recorder.write(ring.buf[off:off + ln], t_in, LOG_INIT if flags & FLAG_INIT else 0)
+            frame_stats['frames'] += 1
+            frame_stats['bytes'] += ln
+            lost, _ = impairment.step()
+            t_out = Trace.now()
+            Trace.stamp(ring.buf, 'relay_out', t_out, base=ring.payload_offset(n))
+            if flags & FLAG_INIT:
+                initialized = True
+                ring.publish(n)
+                print("[Scheduler] Forwarded initialization packet")
+            elif initialized and not lost:
+                ring.publish(n)
+            else:
+                frame_stats['dropped'] += initialized
+                drop_reasons['impairment' if initialized else 'uninitialized'] += 1
+                ring.drop(n)
+                continue
+            relay_latency.record(t_out - t_in)
+            frame_stats['forwarded'] += 1
+            frame_stats['forwarded_bytes'] += ln
+            frame_stats['sent'] += 1
+            frame_stats['sent_bytes'] += ln
+        time.sleep(POLL_SLEEP)
+
+# ───────── Metrics ─────────
+
+def sent_totals():
+    """Frames and bytes sent to CARLA2; with a fan-out, relay() only offers them and each twin link counts what it sent."""
+    if fanout is None:
+        return frame_stats['sent'], frame_stats['sent_bytes']
+    return (sum(l.stats['sent'] for l in fanout.links), sum(l.stats['sent_bytes'] for l in fanout.links))
+
+def make_metrics():
+    """Registers callbacks over the relay's own counters; nothing is added to the frame path."""
+    m = MetricsRegistry('scheduler')
+    m.counter('frames_in_total', 'frames received from CARLA1', lambda: frame_stats['frames'])
+    m.counter('bytes_in_total', 'bytes received from CARLA1', lambda: frame_stats['bytes'])
+    m.counter('frames_out_total', 'frames sent to CARLA2', lambda: sent_totals()[0])
+    m.counter('bytes_out_total', 'bytes sent to CARLA2', lambda: sent_totals()[1])
+    m.counter('frames_offered_total', 'frames offered to the twin queues (fan-out)', lambda: frame_stats['offered'])
+    m.counter('drops_total', 'frames not sent to CARLA2, by reason', lambda: dict(drop_reasons), label='reason')
+    m.gauge('initialized', 'whether the twin has received the init packet', lambda: int(initialized))
+    m.gauge('delay_queue_depth', 'frames held by the delay line', lambda: delay_queue.qsize())
+    m.gauge('shaper_queue_depth', 'frames queued on the shaped link, by class', lambda: shaper.depth(), label='class')
+    m.counter('shaper_drops_total', 'frames dropped by full shaper queues, by class',
+              lambda: {c: st['dropped'] for c, st in shaper.stats.items()}, label='class')
+    m.summary('ingress_latency_seconds', 'CARLA1 send -> Scheduler arrival', lambda: ingress_latency)
+    m.summary('relay_latency_seconds', 'relay_in -> relay_out per frame', lambda: relay_latency)
+    m.summary('shaper_queue_delay_seconds', 'time frames wait on the shaped link, by class',
+              lambda: shaper.delay, label='class')
+    m.gauge('twin_queue_depth', 'frames queued per twin (fan-out)',
+            lambda: {l.name: l.depth() for l in fanout.links}, label='twin')
+    m.counter('twin_frames_sent_total', 'frames sent per twin (fan-out)',
+              lambda: {l.name: l.stats['sent'] for l in fanout.links}, label='twin')
+    m.counter('twin_drops_total', 'frames lost to the twin impairment or dropped by a full queue (fan-out)',
+              lambda: {l.name: l.stats['lost'] + l.stats['dropped'] for l in fanout.links}, label='twin')
+    m.counter('twin_coalesced_total', 'queued frames replaced by newer ones (fan-out, coalesce policy)',
+              lambda: {l.name: l.stats['coalesced'] for l in fanout.links}, label='twin')
+    m.gauge('shard_actors', 'actors owned per twin shard', lambda: dict(enumerate(router.load())), label='shard')
+    m.counter('shard_handoffs_total', 'actors moved between twin shards', lambda: router.stats['handoffs'])
+    m.gauge('world_entities', 'actors in the keyframe cache', lambda: len(world_state.entities))
+    m.counter('keyframes_total', 'keyframes sent to twins that joined late',
+              lambda: world_state.stats['keyframes'])
+    m.gauge('aoi_mean_seconds', 'mean fleet Age of Information under the link budget',
+            lambda: aoi.summary()['mean_aoi_s'])
+    return m
+
 # ───────── Main Scheduler ─────────
 
-def scheduler():
-    global send_sock
-
-    # Setup receiving socket for CARLA1
-    server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server_sock.bind(('0.0.0.0', RECV_PORT))
-    server_sock.listen(1)
-    print(f"[Scheduler] Waiting for CARLA1 on port {RECV_PORT}...")
-    
-    conn_in, _ = server_sock.accept()
-    print("[Scheduler] CARLA1 connected")
-
-    # Setup sending socket for CARLA2
-    send_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    try:
-        send_sock.connect((SEND_IP, SEND_PORT))
-        print(f"[Scheduler] Connected to CARLA2 at {SEND_IP}:{SEND_PORT}")
-    except ConnectionRefusedError:
-        print("[Scheduler] Error: Could not connect to CARLA2. Is it running?")
-        return
+def scheduler(transport=TRANSPORT):
+    global send_sock, aoi, shaper, impairment, recorder, metrics, fanout, mux, world_state, router
+
+    metrics = make_metrics()
+    if METRICS_PORT:
+        serve_metrics(metrics, METRICS_PORT)
+        print(f"[Scheduler] Metrics on http://127.0.0.1:{METRICS_PORT}/metrics")
+    impairment = Impairment.from_spec(IMPAIRMENT, DROP_PROBABILITY, DELAY)
+    if IMPAIRMENT:
+        print(f"[Scheduler] Impairment: {impairment.describe()}")
+    if LINK_BUDGET:
+        aoi = AoiScheduler(LINK_BUDGET)
+        print(f"[Scheduler] AoI scheduling under a link budget of {LINK_BUDGET:.0f} bytes/s")
+    if LINK_RATE:
+        shaper = LinkShaper(LINK_RATE, lambda frame: relay(*frame), policy=SHAPER_POLICY)
+        print(f"[Scheduler] Shaping the CARLA2 link to {LINK_RATE:.0f} bytes/s ({SHAPER_POLICY})")
+    if RECORD:
+        recorder = FrameLogWriter(RECORD)
+        print(f"[Scheduler] Recording ingress frames to {RECORD}")
+    reader = rx = None
+    if SOURCES > 1 and not REPLAY:
+        mux = Multiplexer(SOURCES, MERGE_TICK)
+        print(f"[Scheduler] Merging {SOURCES} physical worlds on {MERGE_TICK:g} s ticks")
+    if REPLAY:
+        reader = FrameLogReader(REPLAY)
+        metrics.peers['physical'] = f"replay:{REPLAY}"
+        print(f"[Scheduler] Replaying {REPLAY} at {'max' if not REPLAY_SPEED else f'{REPLAY_SPEED:g}x'} speed: {reader.summary()}")
+
+    if transport != 'shm':
+        world_state = WorldState()
+    if TWINS:
+        if SHARD:
+            router = ShardRouter(len(TWINS), SHARD_TILE)
+            print(f"[Scheduler] Sharding the twin over {len(TWINS)} servers on {SHARD_TILE:g} m tiles")
+        fanout = Fanout(TWINS, transport, TWIN_QUEUE, TWIN_POLICY, world_state.keyframe, router)
+        for link in fanout.links:
+            metrics.peers[f"twin {link.name}"] = link.name
+        print(f"[Scheduler] Fanning out to {len(fanout.links)} twins ({TWIN_POLICY}, {TWIN_QUEUE} frames per queue)")
+
+    # twins estimate their offset to this clock by pinging CLOCK_PORT (a shm twin shares it)
+    clock = ClockResponder(('0.0.0.0', CLOCK_PORT)) if transport != 'shm' else None
+
+    if transport == 'shm':
+        ring = ShmRing.create(SHM_NAME)
+        print(f"[Scheduler] Shared-memory ring '{SHM_NAME}' ready ({ring.slots} x {ring.slot_size} bytes)")
+        metrics.peers['physical'] = metrics.peers['twin'] = f"shm:{SHM_NAME}"
+        threading.Thread(target=shm_gate, args=(ring,), daemon=True).start()
+        server_sock = None
+    elif transport == 'udp':
+        ring = server_sock = None
+        if fanout is None:
+            send_sock = UdpSender((SEND_IP, SEND_PORT))
+            metrics.peers['twin'] = f"{SEND_IP}:{SEND_PORT}"
+            threading.Thread(target=twin_reader, args=(send_sock,), daemon=True).start()
+        if reader is not None:
+            frames, source = replay_frames(reader, REPLAY_SPEED), reader
+        elif mux is not None:
+            rx = UdpReceiver(('0.0.0.0', RECV_PORT))
+            threading.Thread(target=udp_sources, args=(rx,), daemon=True).start()
+            frames, source = mux.frames(), rx
+        else:
+            rx = UdpReceiver(('0.0.0.0', RECV_PORT))
+            frames, source = udp_frames(rx), rx
+            print(f"[Scheduler] UDP relay {RECV_PORT} -> " + (f"{len(fanout.links)} twins" if fanout else f"{SEND_IP}:{SEND_PORT}"))
+        threading.Thread(target=listener, args=(frames, source), daemon=True).start()
+    else:
+        ring = server_sock = None
+        if reader is not None:
+            frames, conn_in = replay_frames(reader, REPLAY_SPEED), reader
+        else:
+            # Setup receiving socket for CARLA1
+            server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server_sock.bind(('0.0.0.0', RECV_PORT))
+            server_sock.listen(SOURCES)
+            print(f"[Scheduler] Waiting for CARLA1 on port {RECV_PORT}...")
+
+            if mux is not None:
+                for k in range(SOURCES):
+                    conn, addr = server_sock.accept()
+                    metrics.peers[f"physical {k}"] = f"{addr[0]}:{addr[1]}"
+                    print(f"[Scheduler] Physical source {k} connected from {addr}")
+                    threading.Thread(target=source_reader, args=(k, tcp_frames(conn), conn), daemon=True).start()
+                frames, conn_in = mux.frames(), mux
+            else:
+                conn_in, addr = server_sock.accept()
+                metrics.peers['physical'] = f"{addr[0]}:{addr[1]}"
+                frames = tcp_frames(conn_in)
+                print("[Scheduler] CARLA1 connected")
 
-    # Start the listener thread to handle incoming data
-    threading.Thread(target=listener, args=(conn_in,), daemon=True).start()
+        # Setup sending socket for CARLA2
+        if fanout is None:
+            try:
+                send_sock = socket.create_connection((SEND_IP, SEND_PORT))
+                print(f"[Scheduler] Connected to CARLA2 at {SEND_IP}:{SEND_PORT}")
+                metrics.peers['twin'] = f"{SEND_IP}:{SEND_PORT}"
+                threading.Thread(target=twin_reader, args=(send_sock,), daemon=True).start()
+            except ConnectionRefusedError:
+                print("[Scheduler] CARLA2 is not up yet; it gets a keyframe when it connects")
+                threading.Thread(target=twin_connector, daemon=True).start()
 
-    start_time = time.time()
+        # Start the listener thread to handle incoming data
+        threading.Thread(target=listener, args=(frames, conn_in), daemon=True).start()
+
+    start_time = last_dump = time.time()
     try:
         while True:
+            if METRICS_DUMP and time.time() - last_dump >= METRICS_DUMP:
+                metrics.dump('scheduler_metrics.json')
+                last_dump = time.time()
             # Keep the main thread alive and check for runtime limits
             if time.time() - start_time > MAX_RUNTIME:
                 print("[Scheduler] Maximum runtime reached. Shutting down.")
                 break
+            if ring is not None and ring.closed:
+                print("[Scheduler] Frame ring closed by a peer. Shutting down.")
+                break
+            if refused.is_set():
+                print("[Scheduler] Shutting down.")
+                break
+            if replay_done.is_set():
+                time.sleep(1)    # let delayed / shaped frames drain
+                print("[Scheduler] Replay complete. Shutting down.")
+                break
             time.sleep(1)
 
     except KeyboardInterrupt:
@@ -103,15 +533,133 @@ def scheduler():
 
     finally:
         # Graceful shutdown
-        try:
-            shutdown_pkt = pickle.dumps({"cmd": "shutdown"})
-            send_sock.sendall(len(shutdown_pkt).to_bytes(4, 'big') + shutdown_pkt)
-        except:
-            pass
-        send_sock.close()
-        server_sock.close()
+        if ring is not None:
+            ring.close()
+        elif fanout is not None:
+            fanout.close()
+            if server_sock: server_sock.close()
+        else:
+            try:
+                send_frame(pickle.dumps({"cmd": "shutdown"}))
+            except:
+                pass
+            if send_sock is not None: send_sock.close()
+            if server_sock: server_sock.close()
+        frame_stats['sent'], frame_stats['sent_bytes'] = sent_totals()
+        stats = {'udp': rx.stats} if rx is not None else {}
+        if clock is not None:
+            clock.close()
+            stats['clock_pings'] = clock.pings
+        if recorder is not None:
+            recorder.close()
+            stats['recorded'] = {'path': RECORD, 'frames': recorder.frames, 'bytes': recorder.bytes}
+            print(f"[Scheduler] Recorded {recorder.frames} frames ({recorder.bytes} bytes) to {RECORD}")
+        if reader is not None:
+            stats['replay'] = dict(reader.summary(), path=REPLAY, speed=REPLAY_SPEED)
+        if world_state is not None:
+            world_state.close()
+            stats['keyframes'] = world_state.summary()
+            print(f"[Scheduler] Keyframe cache: {stats['keyframes']}")
+        if mux is not None:
+            stats['multiplex'] = mux.summary()
+            print(f"[Scheduler] Multiplexer: {stats['multiplex']}")
+        if router is not None:
+            stats['shards'] = router.summary()
+            print(f"[Scheduler] Shards: {stats['shards']}")
+        if fanout is not None:
+            stats['twins'] = fanout.summary()
+            for name, s in stats['twins'].items():
+                print(f"[Scheduler] Twin {name}: sent {s['sent']}, lost {s['lost']}, dropped {s['dropped']}, "
+                      f"coalesced {s['coalesced']}, queue delay {s['queue_delay_ms']}")
+        if aoi is not None:
+            stats['aoi'] = aoi.summary()
+            print(f"[Scheduler] AoI scheduling: {stats['aoi']}")
+        if shaper is not None:
+            stats['shaper'] = shaper.summary()
+            print(f"[Scheduler] Shaper: {stats['shaper']}")
+        if METRICS_DUMP:
+            metrics.dump('scheduler_metrics.json')
+        dump_histograms(f'scheduler_latency_{transport}.json', {'ingress': ingress_latency, 'relay': relay_latency},
+                        transport=transport, frames=frame_stats, drops=drop_reasons,
+                        drop_probability=DROP_PROBABILITY, delay=DELAY, impairment=impairment.describe(), **stats)
+        print(f"[Scheduler] Ingress latency ({transport}): {ingress_latency.summary()}")
         print("[Scheduler] Cleanup complete")
 
+def compare_latency(paths):
+    """Prints the ingress latency distributions of several runs side by side (e.g. TCP vs UDP)."""
+    cols = ['count', 'p50', 'p90', 'p99', 'p999', 'max', 'mean']
+    print(f"{'run':<36}" + ''.join(f"{c:>10}" for c in cols) + "  udp")
+    for path in paths:
+        hists, raw = load_histograms(path)
+        summ = hists['ingress'].summary()
+        row = ''.join(f"{summ[c]:>10.3f}" if isinstance(summ.get(c), float) else f"{summ.get(c, '-'):>10}" for c in cols)
+        print(f"{os.path.basename(path):<36}{row}  {raw.get('udp', '')}")
+
 # ───────── Entry Point ─────────
 if __name__ == "__main__":
-    scheduler()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--transport', choices=['tcp', 'udp', 'shm'], default=TRANSPORT)
+    parser.add_argument('--compare', nargs='+', metavar='JSON',
+                        help='compare scheduler_latency_*.json files from earlier runs and exit')
+    parser.add_argument('--drop', type=float, default=DROP_PROBABILITY, help='state frame drop probability')
+    parser.add_argument('--delay', type=float, default=DELAY, help='seconds added to every frame')
+    parser.add_argument('--impairment', default=IMPAIRMENT,
+                        help="loss/delay model instead of --drop/--delay: 'ge:p_gb,p_bg[,loss_bad[,loss_good]][@delay]' "
+                             "or 'trace:file.csv[,once]' (see Impairment.py)")
+    parser.add_argument('--budget', type=float, default=LINK_BUDGET,
+                        help='link budget in bytes/s; enables AoI-aware partial frames (tcp/udp only)')
+    parser.add_argument('--rate-limit', type=float, default=LINK_RATE,
+                        help='shape the CARLA2 link to this many bytes/s with bounded queues (tcp/udp only)')
+    parser.add_argument('--shaper-policy', choices=['strict', 'wfq'], default=SHAPER_POLICY)
+    parser.add_argument('--record', metavar='DIR', default=RECORD, help='append every ingress frame to a recording')
+    parser.add_argument('--replay', metavar='DIR', default=REPLAY,
+                        help='feed a recording to CARLA2 instead of waiting for CARLA1 (tcp/udp only)')
+    parser.add_argument('--speed', type=float, default=REPLAY_SPEED, help='replay speed factor, 0 = as fast as possible')
+    parser.add_argument('--twins', nargs='+', metavar='HOST:PORT[=IMPAIRMENT]', default=TWINS,
+                        help='fan frames out to several twins, each with its own impairment and send queue (tcp/udp only)')
+    parser.add_argument('--twin-queue', type=int, default=TWIN_QUEUE, help='frames queued per twin')
+    parser.add_argument('--twin-policy', choices=FANOUT_POLICIES, default=TWIN_POLICY,
+                        help="full twin queue: 'drop' the new state frame or 'coalesce' queued ones into it")
+    parser.add_argument('--shard', action='store_true',
+                        help='the --twins are shards of one world: each gets the actors in its map tiles')
+    parser.add_argument('--shard-tile', type=float, default=TILE_SIZE, help='shard tile size in metres')
+    parser.add_argument('--relay-queue', type=int, default=RELAY_QUEUE, metavar='FRAMES',
+                        help='send to CARLA2 from a queue of this many frames; a full queue merges the pending '
+                             'states per actor (latest wins) instead of blocking the listener (tcp/udp only)')
+    parser.add_argument('--sources', type=int, default=SOURCES,
+                        help='merge this many Physical_world streams into one twin stream (tcp/udp only)')
+    parser.add_argument('--merge-tick', type=float, default=MERGE_TICK, help='sim-time seconds per merged frame')
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+                        help='serve /metrics (Prometheus text) and /metrics.json on this local port')
+    parser.add_argument('--metrics-dump', type=float, default=METRICS_DUMP, metavar='SECONDS',
+                        help='write scheduler_metrics.json this often')
+    args = parser.parse_args()
+    if (args.budget or args.rate_limit) and args.transport == 'shm':
+        parser.error('--budget and --rate-limit need --transport tcp or udp: shared-memory frames bypass the relay')
+    DROP_PROBABILITY, DELAY, LINK_BUDGET, IMPAIRMENT = args.drop, args.delay, args.budget, args.impairment
+    if args.transport == 'shm' and Impairment.from_spec(IMPAIRMENT, DROP_PROBABILITY, DELAY).may_delay:
+        parser.error(f'--delay and delaying --impairment models need --transport tcp or udp: the shared-memory ring '
+                     f'holds {SHM_SLOTS} frames, so a frame held longer than {SHM_SLOTS} periods would be overwritten')
+    if args.twins and args.transport == 'shm':
+        parser.error('--twins needs --transport tcp or udp: the shared-memory ring has a single reader')
+    if args.shard and len(args.twins) < 2:
+        parser.error('--shard needs at least two --twins')
+    if args.relay_queue and (args.twins or args.transport == 'shm'):
+        parser.error('--relay-queue is for a single tcp/udp twin; use --twin-queue with --twins')
+    if args.sources > 1 and args.transport == 'shm':
+        parser.error('--sources needs --transport tcp or udp: the shared-memory ring has a single writer')
+    if args.replay and args.transport == 'shm':
+        parser.error('--replay needs --transport tcp or udp: the shared-memory ring has no backpressure')
+    LINK_RATE, SHAPER_POLICY = args.rate_limit, args.shaper_policy
+    RECORD, REPLAY, REPLAY_SPEED = args.record, args.replay, args.speed
+    METRICS_PORT, METRICS_DUMP = args.metrics_port, args.metrics_dump
+    TWINS, TWIN_QUEUE, TWIN_POLICY = args.twins, args.twin_queue, args.twin_policy
+    if args.relay_queue:
+        # the single twin becomes a one-link fan-out: its own queue and sender thread, coalescing when full
+        TWINS, TWIN_QUEUE, TWIN_POLICY = [f"{SEND_IP}:{SEND_PORT}"], args.relay_queue, 'coalesce'
+    SOURCES, MERGE_TICK = args.sources, args.merge_tick
+    SHARD, SHARD_TILE = args.shard, args.shard_tile
+    if args.compare:
+        compare_latency(args.compare)
+    else:
+        scheduler(args.transport)
\ No newline at end of file
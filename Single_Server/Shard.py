@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# Shard router - splits the fleet across several twins (each on its own CARLA server) by map region
+"""
+The map is cut into square tiles of TILE_SIZE metres and every tile belongs to
+one shard (one twin of the fan-out). The tile table is built once, from the
+first init frame. It covers the extent of the init's 'roads', a sample of
+spawn points sent by Physical_world. Tiles are walked in snake order (row by
+row, alternating direction) and cut into contiguous runs holding about the
+same share of road points. Each shard therefore owns one connected region with
+a fair share of the places traffic can drive. Without 'roads', the init's
+actors are used instead. Routing an actor is then two
+divisions and a table lookup, O(1) per actor and frame:
+
+    shard = table[(y - y0) // TILE_SIZE][(x - x0) // TILE_SIZE]    (clamped to the grid)
+
+Positions outside the grid use the nearest edge tile.
+
+Handoff: an actor that crosses into another shard's tile is moved after
+HANDOFF_FRAMES consecutive frames there (hysteresis, so an actor driving
+along a boundary is not respawned every frame). Its new shard spawns it from
+the state entity (bp and color are in every state). The old shard gets a
+release marker {'id', 'type', 'released': True} in its next RELEASE_REPEAT
+frames, so that one lost or dropped frame does not leave a ghost behind.
+Markers are kept per (actor, shard): every handoff queues a full run for the
+shard left, and only the marker of the shard the actor moves into is
+cancelled, so A -> B -> A releases B and A -> B -> C still releases A.
+Because the marker is an entity, coalescing merges it like any other state
+(latest wins).
+"""
+import pickle, os, sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Trace
+
+# ───────── Configuration ─────────
+TILE_SIZE = 100.0       # metres
+HANDOFF_FRAMES = 5      # consecutive frames in another shard's tile before the actor moves there
+RELEASE_REPEAT = 25     # frames the old shard is told to release a handed-off actor
+
+class ShardRouter(object):
+
+    def __init__(self, shards, tile=TILE_SIZE, handoff_frames=HANDOFF_FRAMES):
+        self.shards, self.tile, self.handoff_frames = shards, tile, handoff_frames
+        self.table = None       # tile row -> tile column -> shard, built from the first init frame
+        self.x0 = self.y0 = 0.0
+        self.nx = self.ny = 0
+        self.owner = {}         # actor id -> shard
+        self.candidate = {}     # actor id -> (shard, consecutive frames seen in its tiles)
+        self.released = {}      # (actor id, old shard) -> (type, markers left)
+        self.stats = dict(frames=0, handoffs=0)
+
+    def build(self, points):
+        """Tile table over the (x, y) points, each shard holding about the same number of them."""
+        xs = [p[0] for p in points] or [0.0]
+        ys = [p[1] for p in points] or [0.0]
+        self.x0, self.y0 = min(xs) - self.tile, min(ys) - self.tile
+        self.nx = int((max(xs) - self.x0) // self.tile) + 2
+        self.ny = int((max(ys) - self.y0) // self.tile) + 2
+        self.table = [[0] * self.nx for _ in range(self.ny)]
+        counts = [[0] * self.nx for _ in range(self.ny)]
+        for p in points:
+            iy, ix = self._tile(p)
+            counts[iy][ix] += 1
+        order = [(iy, ix if iy % 2 == 0 else self.nx - 1 - ix) for iy in range(self.ny) for ix in range(self.nx)]
+        total = len(points)
+        seen = 0
+        for n, (iy, ix) in enumerate(order):
+            # the shard is fixed by the actors before this tile, so each shard gets about total / shards
+            k = seen * self.shards // total if total else n * self.shards // len(order)
+            self.table[iy][ix] = min(k, self.shards - 1)
+            seen += counts[iy][ix]
+
+    def _tile(self, loc):
+        return (min(max(int((loc[1] - self.y0) // self.tile), 0), self.ny - 1),
+                min(max(int((loc[0] - self.x0) // self.tile), 0), self.nx - 1))
+
+    def shard_of(self, loc):
+        iy, ix = self._tile(loc)
+        return self.table[iy][ix]
+
+    def _route(self, e):
+        """Owning shard of one state entity, with handoff hysteresis."""
+        aid, k = e['id'], self.shard_of(e['loc'])
+        cur = self.owner.get(aid)
+        if cur is None:
+            self.owner[aid] = k
+            return k
+        if k == cur:
+            self.candidate.pop(aid, None)
+            return cur
+        cand, n = self.candidate.get(aid, (k, 0))
+        n = n + 1 if cand == k else 1
+        if n < self.handoff_frames:
+            self.candidate[aid] = (k, n)
+            return cur
+        del self.candidate[aid]
+        self.owner[aid] = k
+        self.stats['handoffs'] += 1
+        self.released.pop((aid, k), None)    # back where it was just released from: it must not be released again
+        self.released[(aid, cur)] = (e.get('type', 'vehicle'), RELEASE_REPEAT)
+        return k
+
+    def split(self, payload, is_init):
+        """One payload per shard (same trace header, the shard's entities only)."""
+        head = bytes(payload[:Trace.HEADER_SIZE]) if Trace.read_header(payload) is not None else b''
+        msg = pickle.loads(Trace.payload(payload))
+        parts = [[] for _ in range(self.shards)]
+        if is_init:
+            vehicles = msg.get('vehicles', [])
+            if self.table is None: self.build(msg.get('roads') or [e['loc'] for e in vehicles])
+            for e in vehicles:
+                k = self.owner[e['id']] = self.shard_of(e['loc'])
+                parts[k].append(e)
+            return [head + pickle.dumps(dict(msg, vehicles=p)) for p in parts]
+        self.stats['frames'] += 1
+        if self.table is None:
+            return [head + pickle.dumps(p) for p in parts]     # the twins drop state before their init anyway
+        for e in msg:
+            parts[self._route(e)].append(e)
+        for (aid, k), (kind, left) in list(self.released.items()):
+            parts[k].append({'id': aid, 'type': kind, 'released': True})
+            if left > 1: self.released[(aid, k)] = (kind, left - 1)
+            else: del self.released[(aid, k)]
+        return [head + pickle.dumps(p) for p in parts]
+
+    def select(self, k):
+        """Entity filter for shard k's keyframe."""
+        return lambda e: self.owner.get(e['id'], self.shard_of(e['loc'])) == k
+
+    def load(self):
+        """Actors owned per shard."""
+        counts = [0] * self.shards
+        for k in list(self.owner.values()): counts[k] += 1
+        return counts
+
+    def summary(self):
+        return dict(self.stats, shards=self.shards, tile_m=self.tile, grid=[self.ny, self.nx], actors=self.load())
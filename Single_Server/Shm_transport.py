@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# Shared-memory frame ring - single-host alternative to the loopback TCP hops
+"""
+One ring carries the whole Physical_world -> Scheduler -> Twin_world path:
+
+- Physical_world writes each pickled frame into the next slot (seqlock: the slot
+  sequence is odd while the frame is being copied in, even once it is complete)
+- the Scheduler never copies frames; it decides per frame whether it becomes
+  visible to the twin (`publish`) or is dropped (`drop`), and how long it holds
+  the visibility cursor back
+- Twin_world reads visible slots in order, skipping dropped ones, and re-checks
+  the slot sequence after copying so a frame overwritten mid-read is detected
+
+Header: magic, slots, slot_size, write_seq, visible_seq, closed
+Slot:   seq, length, flags, write time (time.monotonic), payload
+"""
+import struct, time
+from multiprocessing import shared_memory
+
+# ───────── Configuration ─────────
+SHM_NAME   = 'carla_twin'
+SLOTS      = 8
+SLOT_SIZE  = 4 << 20      # bytes per frame slot
+POLL_SLEEP = 20e-6        # seconds between polls of an idle ring
+
+MAGIC = 0x43545731        # 'CTW1'
+FLAG_INIT, FLAG_DROP = 1, 2
+
+_HDR = struct.Struct('<IIQQQI')      # magic, slots, slot_size, write_seq, visible_seq, closed
+_SLOT = struct.Struct('<QIId')       # seq, length, flags, t_write
+_OFF_WRITE, _OFF_VISIBLE, _OFF_CLOSED = 16, 24, 32
+HDR_SIZE = 64
+
+def _attach(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13: stop the resource tracker from unlinking the Scheduler's segment at our exit
+        from multiprocessing import resource_tracker
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+class ShmRing(object):
+    """Seqlock frame ring in a named shared memory segment (one writer, one gate, one reader)."""
+
+    def __init__(self, shm, owner=False):
+        self.shm, self.buf, self.owner = shm, shm.buf, owner
+        magic, self.slots, self.slot_size = struct.unpack_from('<IIQ', self.buf, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{shm.name} is not a frame ring")
+        self.next_read = 0     # reader cursor
+        self.next_gate = 0     # scheduler cursor
+        self.lost = 0          # frames overwritten before the reader got them
+
+    @classmethod
+    def create(cls, name=SHM_NAME, slots=SLOTS, slot_size=SLOT_SIZE):
+        try:
+            stale = _attach(name); stale.close(); stale.unlink()
+        except FileNotFoundError:
+            pass
+        shm = shared_memory.SharedMemory(name=name, create=True, size=HDR_SIZE + slots * (_SLOT.size + slot_size))
+        _HDR.pack_into(shm.buf, 0, MAGIC, slots, slot_size, 0, 0, 0)
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name=SHM_NAME, timeout=None):
+        """Attach to a ring created by the Scheduler, waiting for it to appear."""
+        t0 = time.time()
+        while True:
+            try:
+                return cls(_attach(name))
+            except FileNotFoundError:
+                if timeout is not None and time.time() - t0 > timeout: raise
+                time.sleep(0.1)
+
+    # ───────── header fields ─────────
+
+    def _get(self, off):
+        return struct.unpack_from('<Q', self.buf, off)[0]
+
+    def _slot(self, n):
+        return HDR_SIZE + (n % self.slots) * (_SLOT.size + self.slot_size)
+
+    def payload_offset(self, n):
+        """Offset of frame n's payload in self.buf, for in-place patches by the gate."""
+        return self._slot(n) + _SLOT.size
+
+    @property
+    def write_seq(self):
+        return self._get(_OFF_WRITE)
+
+    @property
+    def visible_seq(self):
+        return self._get(_OFF_VISIBLE)
+
+    @property
+    def closed(self):
+        return bool(struct.unpack_from('<I', self.buf, _OFF_CLOSED)[0])
+
+    # ───────── writer (Physical_world) ─────────
+
+    def write(self, blob, flags=0):
+        """Copy one frame into the next slot; raises BrokenPipeError once the ring is closed."""
+        if self.closed:
+            raise BrokenPipeError("frame ring closed")
+        if len(blob) > self.slot_size:
+            raise ValueError(f"frame of {len(blob)} bytes exceeds slot size {self.slot_size}")
+        n = self.write_seq
+        off = self._slot(n)
+        struct.pack_into('<Q', self.buf, off, 2 * n + 1)
+        self.buf[off + _SLOT.size:off + _SLOT.size + len(blob)] = blob
+        struct.pack_into('<IId', self.buf, off + 8, len(blob), flags, time.monotonic())
+        struct.pack_into('<Q', self.buf, off, 2 * n + 2)
+        struct.pack_into('<Q', self.buf, _OFF_WRITE, n + 1)
+        return n
+
+    # ───────── gate (Scheduler) ─────────
+
+    def pending(self):
+        """Frames written but not yet published or dropped: [(n, flags, t_write, length)]."""
+        out = []
+        head = self.write_seq
+        # frames already overwritten by the writer can no longer be gated
+        self.next_gate = max(self.next_gate, head - self.slots)
+        for n in range(self.next_gate, head):
+            seq, ln, flags, t_write = _SLOT.unpack_from(self.buf, self._slot(n))
+            if seq == 2 * n + 2:
+                out.append((n, flags, t_write, ln))
+        return out
+
+    def drop(self, n):
+        off = self._slot(n)
+        flags = struct.unpack_from('<I', self.buf, off + 12)[0]
+        struct.pack_into('<I', self.buf, off + 12, flags | FLAG_DROP)
+        self.publish(n)
+
+    def publish(self, n):
+        """Make every frame up to and including n visible to the reader."""
+        self.next_gate = max(self.next_gate, n + 1)
+        if n + 1 > self.visible_seq:
+            struct.pack_into('<Q', self.buf, _OFF_VISIBLE, n + 1)
+
+    # ───────── reader (Twin_world) ─────────
+
+    def read(self, timeout=None):
+        """Return the next visible, non-dropped frame as bytes; None once closed or timed out."""
+        t0 = time.monotonic()
+        while True:
+            visible = self.visible_seq
+            if self.next_read < visible - self.slots:
+                self.lost += visible - self.slots - self.next_read
+                self.next_read = visible - self.slots
+            while self.next_read < visible:
+                n = self.next_read; self.next_read += 1
+                off = self._slot(n)
+                seq, ln, flags, _ = _SLOT.unpack_from(self.buf, off)
+                if seq != 2 * n + 2:
+                    self.lost += 1; continue
+                if flags & FLAG_DROP: continue
+                data = bytes(self.buf[off + _SLOT.size:off + _SLOT.size + ln])
+                if struct.unpack_from('<Q', self.buf, off)[0] != seq:
+                    self.lost += 1; continue
+                return data
+            if self.closed: return None
+            if timeout is not None and time.monotonic() - t0 > timeout: return None
+            time.sleep(POLL_SLEEP)
+
+    def close(self):
+        """Mark the ring closed; the owner also removes the segment."""
+        try:
+            struct.pack_into('<I', self.buf, _OFF_CLOSED, 1)
+        except (TypeError, ValueError):
+            pass
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            try: self.shm.unlink()
+            except FileNotFoundError: pass
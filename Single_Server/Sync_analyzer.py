@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+# DT sync analyzer - joins physical and twin vehicle logs, reports position error, lag and AoI
+"""
+Streams `physical_vehicle_log4` and `twin_vehicle_log_pod4` (columnar run
+directories or the legacy CSV files) chunk by chunk and joins them on actor id
+and timestamp with a vectorized as-of match:
+
+- position error: twin position vs. latest physical position at the same timestamp
+- lag:            frames between the physical state the twin shows when it applies a
+                  frame and the physical state at that moment
+- AoI:            for every physical sample, age of the freshest state the twin has
+                  applied for that actor by the time the sample was captured
+
+Lag and AoI need the delivery times: the physical log's 'captured' column and the
+twin log's 'applied' (frame apply time, mapped onto the relay clock by Clock_sync)
+and 'updated' (physical time of the actor's last received state) columns, all on
+the Trace clock of the host the physical world and the relay share. Logs without
+them still get position error; lag and AoI are then reported as None.
+
+Memory is bounded by the chunk size plus MAX_AGE of twin rows; distributions are
+accumulated in fixed-bin histograms and per-actor sums.
+"""
+import os, csv, json, time, argparse, itertools
+import numpy as np
+
+from Trajectory_log import TrajectoryLogReader
+
+# ───────── Configuration ─────────
+CHUNK_ROWS     = 1 << 20
+MAX_LAG_FRAMES = 50      # lag search window (frames)
+MAX_AGE        = 5.0     # seconds of twin rows kept for the AoI and lag joins (longest delivery delay measured)
+LAG_STRIDE     = 20      # estimate lag on every n-th twin row
+ERR_EDGES = np.concatenate([np.linspace(0, 10, 2001), [np.inf]])   # m, 5 mm bins
+AOI_EDGES = np.concatenate([np.linspace(0, 5, 2501), [np.inf]])    # s, 2 ms bins
+BASE_COLUMNS = ('timestamp', 'id', 'x', 'y', 'z')
+
+# ───────── Log readers ─────────
+
+def resolve_log(name):
+    """Accept a run directory, a CSV file or a bare name (directory preferred)."""
+    if os.path.exists(name): return name
+    return name + '.csv'
+
+def iter_log(path, chunk_rows=CHUNK_ROWS):
+    """Yield (t, id, xyz, extra) chunks of at most chunk_rows rows, in file order; extra maps further columns to values."""
+    if os.path.isdir(path):
+        for c in TrajectoryLogReader(path).iter_chunks(chunk_rows):
+            yield (np.asarray(c['timestamp'], dtype=np.float64), np.asarray(c['id'], dtype=np.int64),
+                   np.column_stack([c['x'], c['y'], c['z']]),
+                   {k: np.asarray(v, dtype=np.float64) for k, v in c.items() if k not in BASE_COLUMNS})
+        return
+    with open(path) as f:
+        names = next(f, '').strip().split(',')
+        while True:
+            lines = list(itertools.islice(f, chunk_rows))
+            if not lines: break
+            a = np.loadtxt(lines, delimiter=',', ndmin=2)
+            yield a[:, 0], a[:, 1].astype(np.int64), a[:, 2:5], {k: a[:, i] for i, k in enumerate(names) if i >= 5}
+
+# ───────── As-of join buffer ─────────
+
+class _Buffer(object):
+    """Rows of one log covering [horizon - window, latest] plus the last row of every actor."""
+
+    def __init__(self):
+        self.t = np.empty(0); self.a = np.empty(0, dtype=np.int64); self.xyz = np.empty((0, 3))
+        self.x = {}     # further columns
+        self.done = False
+
+    def extend(self, t, a, xyz, extra):
+        self.t = np.concatenate([self.t, t]); self.a = np.concatenate([self.a, a])
+        self.xyz = np.concatenate([self.xyz, xyz])
+        for k, v in extra.items():
+            self.x[k] = np.concatenate([self.x.get(k, np.empty(0)), v])
+
+    def t_max(self):
+        return self.t.max() if len(self.t) else -np.inf
+
+    def build(self, time=None):
+        """Sort by (actor, time) so that as-of lookups are one searchsorted call; time names a column other than t."""
+        if not len(self.t): self._keys = np.empty(0); return
+        t = self.t if time is None else self.x[time]
+        self._t0, self._span = t.min(), t.max() - t.min() + 1.0
+        keys = self.a * self._span + (t - self._t0)
+        self._order = np.argsort(keys, kind='stable')
+        self._keys = keys[self._order]
+
+    def asof(self, a, t):
+        """Index of the latest row of actor a with (build) time <= t, or -1."""
+        if not len(self._keys): return np.full(len(a), -1)
+        rel = np.minimum(t - self._t0, self._span - 0.5)
+        pos = np.searchsorted(self._keys, a * self._span + rel, side='right') - 1
+        row = self._order[np.maximum(pos, 0)]
+        ok = (pos >= 0) & (self.a[row] == a) & (rel >= 0)
+        return np.where(ok, row, -1)
+
+    def trim(self, horizon, window):
+        if not len(self.t): return
+        keep = self.t >= horizon - window
+        # always keep each actor's newest old row so long gaps still match
+        old = np.flatnonzero(~keep)
+        if len(old):
+            order = old[np.lexsort((self.t[old], self.a[old]))]
+            last = np.r_[self.a[order][1:] != self.a[order][:-1], True]
+            keep[order[last]] = True
+        self.t, self.a, self.xyz = self.t[keep], self.a[keep], self.xyz[keep]
+        self.x = {k: v[keep] for k, v in self.x.items()}
+
+    def frame_times(self, column):
+        """Per distinct t, in order, the value of a per-frame column."""
+        t, first = np.unique(self.t, return_index=True)
+        return t, self.x[column][first]
+
+# ───────── Analyzer ─────────
+
+class SyncAnalyzer(object):
+
+    def __init__(self, dt=None, max_lag_frames=MAX_LAG_FRAMES, lag_stride=LAG_STRIDE):
+        self.dt = dt
+        self.max_lag_frames = max_lag_frames
+        self.lag_stride = lag_stride
+        self.err_hist = np.zeros(len(ERR_EDGES) - 1, dtype=np.int64)
+        self.aoi_hist = np.zeros(len(AOI_EDGES) - 1, dtype=np.int64)
+        self.lag_hist = np.zeros(max_lag_frames + 1, dtype=np.int64)
+        self.ids = np.empty(0, dtype=np.int64)
+        self.acc = np.zeros((0, 7))   # n_err, sum_err, sum_err2, max_err, n_aoi, sum_aoi, max_aoi
+        self.unmatched = 0
+        self.missing_aoi = 0
+        self.timed = None   # whether the logs carry the delivery times lag and AoI need
+        self._lag_phase = 0
+
+    def _dense(self, ids):
+        new = np.setdiff1d(ids, self.ids)
+        if len(new):
+            merged = np.union1d(self.ids, new)
+            acc = np.zeros((len(merged), self.acc.shape[1]))
+            acc[np.searchsorted(merged, self.ids)] = self.acc
+            self.ids, self.acc = merged, acc
+        return np.searchsorted(self.ids, ids)
+
+    def _accumulate(self, cols, idx, values):
+        n = len(self.ids)
+        self.acc[:, cols[0]] += np.bincount(idx, minlength=n)
+        self.acc[:, cols[1]] += np.bincount(idx, weights=values, minlength=n)
+        if len(cols) == 4:
+            self.acc[:, cols[2]] += np.bincount(idx, weights=values * values, minlength=n)
+        mx = np.full(n, -np.inf); np.maximum.at(mx, idx, values)
+        self.acc[:, cols[-1]] = np.maximum(self.acc[:, cols[-1]], mx)
+
+    def _twin_rows(self, phys, t, a, xyz):
+        row = phys.asof(a, t)
+        ok = row >= 0
+        self.unmatched += int((~ok).sum())
+        t, a, xyz, row = t[ok], a[ok], xyz[ok], row[ok]
+        err = np.linalg.norm(xyz - phys.xyz[row], axis=1)
+        self.err_hist += np.histogram(err, ERR_EDGES)[0]
+        self._accumulate((0, 1, 2, 3), self._dense(a), err)
+
+    def _lag_rows(self, phys, t, a, xyz):
+        """t: the physical time at which each twin row was applied."""
+        # lag: shift k frames back in physical time, keep the k with the smallest error
+        s = np.arange(self._lag_phase, len(t), self.lag_stride)
+        self._lag_phase = (self._lag_phase - len(t)) % self.lag_stride
+        if len(s) and self.dt:
+            best, best_k = np.full(len(s), np.inf), np.zeros(len(s), dtype=np.int64)
+            for k in range(self.max_lag_frames + 1):
+                r = phys.asof(a[s], t[s] - k * self.dt)
+                e = np.where(r >= 0, np.linalg.norm(xyz[s] - phys.xyz[np.maximum(r, 0)], axis=1), np.inf)
+                better = e < best
+                best[better], best_k[better] = e[better], k
+            self.lag_hist += np.bincount(best_k[np.isfinite(best)], minlength=self.max_lag_frames + 1)
+
+    def _phys_rows(self, twin, t, a, captured):
+        self._dense(a)  # physical actors the twin never reported still get a per-actor row
+        row = twin.asof(a, captured)     # twin built on 'applied': what the twin showed when the sample was taken
+        ok = row >= 0
+        self.missing_aoi += int((~ok).sum())
+        aoi = np.maximum(t[ok] - twin.x['updated'][row[ok]], 0.0)     # clock-sync error can put an update a hair ahead
+        self.aoi_hist += np.histogram(aoi, AOI_EDGES)[0]
+        self._accumulate((4, 5, 6), self._dense(a[ok]), aoi)
+
+    def _pull(self, buf, it):
+        chunk = next(it, None)
+        if chunk is None:
+            buf.done = True
+            return
+        t, ids, xyz, extra = chunk
+        buf.extend(t, ids, xyz, extra)
+        if self.dt is None and buf is self._phys:
+            steps = np.diff(np.unique(t))
+            self.dt = float(np.median(steps)) if len(steps) else None
+
+    def run(self, physical_path, twin_path, chunk_rows=CHUNK_ROWS):
+        phys_it, twin_it = iter_log(physical_path, chunk_rows), iter_log(twin_path, chunk_rows)
+        phys = self._phys = _Buffer()
+        twin = _Buffer()
+        horizon = -np.inf
+        while not (phys.done and twin.done):
+            # one twin chunk, then the physical log until it has caught up with it
+            if not twin.done: self._pull(twin, twin_it)
+            while not phys.done and (twin.done or phys.t_max() <= twin.t_max()):
+                self._pull(phys, phys_it)
+                if twin.done: break
+            # rows at the newest timestamp may continue in the next chunk, so stop just before it
+            new_h = min(np.inf if phys.done else phys.t_max(), np.inf if twin.done else twin.t_max())
+            if self.timed is None and len(phys.t) and len(twin.t):
+                self.timed = 'captured' in phys.x and {'applied', 'updated'} <= twin.x.keys()
+                if not self.timed: print("[Analyzer] logs without delivery times: no lag or AoI")
+            phys.build(); twin.build('applied' if self.timed else None)
+            sel = (twin.t >= horizon) & (twin.t < new_h)
+            self._twin_rows(phys, twin.t[sel], twin.a[sel], twin.xyz[sel])
+            if self.timed:
+                # a twin row counts for lag at the physical time it was applied, found through the capture times
+                t_applied = np.interp(twin.x['applied'], *phys.frame_times('captured')[::-1])
+                sel = (t_applied >= horizon) & (t_applied < new_h)
+                self._lag_rows(phys, t_applied[sel], twin.a[sel], twin.xyz[sel])
+                sel = (phys.t >= horizon) & (phys.t < new_h)
+                self._phys_rows(twin, phys.t[sel], phys.a[sel], phys.x['captured'][sel])
+            horizon = new_h
+            phys.trim(horizon, (self.max_lag_frames + 1) * (self.dt or 0.0)); twin.trim(horizon, MAX_AGE)
+        return self
+
+    # ───────── Reporting ─────────
+
+    @staticmethod
+    def _quantiles(hist, edges, qs=(0.5, 0.9, 0.99)):
+        total = hist.sum()
+        if not total: return {f'p{int(q * 100)}': None for q in qs}
+        cdf = np.cumsum(hist) / total
+        # lower edge of the bin holding the quantile
+        return {f'p{int(q * 100)}': float(edges[np.searchsorted(cdf, q)]) for q in qs}
+
+    def summary(self):
+        n_err, s_err, s_err2 = self.acc[:, 0].sum(), self.acc[:, 1].sum(), self.acc[:, 2].sum()
+        n_aoi, s_aoi = self.acc[:, 4].sum(), self.acc[:, 5].sum()
+        n_lag = self.lag_hist.sum()
+        return {
+            'actors': int(len(self.ids)), 'dt': self.dt,
+            'position_error_m': dict(mean=float(s_err / n_err) if n_err else None,
+                                     rmse=float(np.sqrt(s_err2 / n_err)) if n_err else None,
+                                     max=float(self.acc[:, 3].max()) if n_err else None,
+                                     samples=int(n_err), unmatched_twin_rows=self.unmatched,
+                                     **self._quantiles(self.err_hist, ERR_EDGES)),
+            'lag_frames_hist': self.lag_hist.tolist(),
+            'lag_mean_s': float((np.arange(len(self.lag_hist)) * self.lag_hist).sum() / n_lag * (self.dt or 0.0))
+                          if n_lag else None,
+            'aoi_s': dict(mean=float(s_aoi / n_aoi) if n_aoi else None,
+                          max=float(self.acc[:, 6].max()) if n_aoi else None,
+                          samples=int(n_aoi), never_delivered=self.missing_aoi,
+                          **self._quantiles(self.aoi_hist, AOI_EDGES)),
+        }
+
+    def per_actor_rows(self, collisions=None):
+        collisions = collisions or {}
+        for aid, (n_e, s_e, s_e2, m_e, n_a, s_a, m_a) in zip(self.ids, self.acc):
+            yield [int(aid), int(n_e),
+                   s_e / n_e if n_e else '', np.sqrt(s_e2 / n_e) if n_e else '', m_e if n_e else '',
+                   s_a / n_a if n_a else '', m_a if n_a else '', collisions.get(int(aid), 0)]
+
+def load_collisions(path):
+    if not path or not os.path.exists(path): return {}
+    with open(path) as f:
+        return {int(r['id']): int(r['collision_count']) for r in csv.DictReader(f)}
+
+# ───────── Entry Point ─────────
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure physical-vs-twin synchronization quality')
+    parser.add_argument('--physical', default='physical_vehicle_log4')
+    parser.add_argument('--twin', default='twin_vehicle_log_pod4')
+    parser.add_argument('--collisions', default='collision_summary.csv')
+    parser.add_argument('--out', default='sync_report', help='writes <out>.json and <out>_per_actor.csv')
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS)
+    parser.add_argument('--dt', type=float, default=None, help='physical frame period (default: inferred)')
+    parser.add_argument('--max-lag-frames', type=int, default=MAX_LAG_FRAMES)
+    parser.add_argument('--lag-stride', type=int, default=LAG_STRIDE)
+    args = parser.parse_args()
+
+    t0 = time.time()
+    an = SyncAnalyzer(args.dt, args.max_lag_frames, args.lag_stride)
+    an.run(resolve_log(args.physical), resolve_log(args.twin), args.chunk_rows)
+    collisions = load_collisions(args.collisions)
+    report = an.summary()
+    report['collisions'] = sum(collisions.values())
+    report['elapsed_s'] = time.time() - t0
+
+    with open(args.out + '.json', 'w') as f:
+        json.dump(report, f, indent=2)
+    with open(args.out + '_per_actor.csv', 'w', newline='') as f:
+        w = csv.writer(f)
+        w.writerow(['id', 'samples', 'err_mean', 'err_rmse', 'err_max', 'aoi_mean', 'aoi_max', 'collision_count'])
+        w.writerows(an.per_actor_rows(collisions))
+    print(json.dumps(report, indent=2))
+    print(f"[Analyzer] {report['actors']} actors in {report['elapsed_s']:.2f}s -> {args.out}.json")
+
+if __name__ == '__main__':
+    main()
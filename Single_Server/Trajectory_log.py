@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# Columnar trajectory log - append-only column files + chunk index, batched background writer
+"""
+A run is a directory holding one raw little-endian file per column
+(`timestamp.bin`, `id.bin`, `x.bin`, ...), a `schema.json` and an append-only
+`index.bin` with one record per written chunk (row_start, rows, t_min, t_max).
+A chunk only becomes visible once its index record is written, so a run that
+was killed mid-write is still readable up to the last complete chunk.
+"""
+import os, json, csv, threading, itertools
+import numpy as np
+
+# ───────── Configuration ─────────
+SCHEMA = (('timestamp', '<f8'), ('id', '<i8'), ('x', '<f8'), ('y', '<f8'), ('z', '<f8'))
+INDEX_DTYPE = np.dtype([('row_start', '<i8'), ('rows', '<i8'), ('t_min', '<f8'), ('t_max', '<f8')])
+BATCH_ROWS = 65536       # rows buffered before a chunk is written
+FLUSH_INTERVAL = 1.0     # seconds; a partial chunk is written at least this often
+
+# ───────── Writer ─────────
+
+class TrajectoryLogWriter(object):
+    """Buffers frames in memory and writes them as large column chunks from a background thread."""
+
+    def __init__(self, path, schema=SCHEMA, batch_rows=BATCH_ROWS, flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.schema = tuple((name, np.dtype(dt)) for name, dt in schema)
+        self.batch_rows = batch_rows
+        self.flush_interval = flush_interval
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, 'schema.json'), 'w') as f:
+            json.dump([[name, dt.str] for name, dt in self.schema], f)
+        self._files = [open(os.path.join(path, name + '.bin'), 'wb') for name, _ in self.schema]
+        self._index = open(os.path.join(path, 'index.bin'), 'wb')
+        self._pending, self._pending_rows, self._rows = [], 0, 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, *columns):
+        """Append one frame; columns follow the schema order, scalars are broadcast."""
+        n = max((np.size(c) for c in columns if np.ndim(c)), default=0)
+        if n == 0: return
+        frame = [np.broadcast_to(np.asarray(c, dtype=dt), (n,)) for c, (_, dt) in zip(columns, self.schema)]
+        with self._cond:
+            self._pending.append(frame)
+            self._pending_rows += n
+            if self._pending_rows >= self.batch_rows:
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._closed and self._pending_rows < self.batch_rows:
+                    self._cond.wait(self.flush_interval)
+                frames, self._pending, self._pending_rows = self._pending, [], 0
+                closed = self._closed
+            if frames:
+                self._write_chunk(frames)
+            if closed:
+                break
+
+    def _write_chunk(self, frames):
+        cols = [np.concatenate([fr[i] for fr in frames]) for i in range(len(self.schema))]
+        for f, col in zip(self._files, cols):
+            f.write(col.tobytes())
+            f.flush()
+        ts = cols[0]
+        rec = np.array([(self._rows, len(ts), ts.min(), ts.max())], dtype=INDEX_DTYPE)
+        self._index.write(rec.tobytes())
+        self._index.flush()
+        self._rows += len(ts)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        for f in self._files: f.close()
+        self._index.close()
+
+# ───────── Reader ─────────
+
+class TrajectoryLogReader(object):
+    """Memory-maps a run for random access by time range or actor id."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'schema.json')) as f:
+            self.schema = tuple((name, np.dtype(dt)) for name, dt in json.load(f))
+        self.index = np.fromfile(os.path.join(path, 'index.bin'), dtype=INDEX_DTYPE)
+        self.rows = int(self.index['row_start'][-1] + self.index['rows'][-1]) if len(self.index) else 0
+        self.columns = {}
+        for name, dt in self.schema:
+            if self.rows:
+                self.columns[name] = np.memmap(os.path.join(path, name + '.bin'), dtype=dt, mode='r', shape=(self.rows,))
+            else:
+                self.columns[name] = np.empty(0, dtype=dt)
+        self._actor_order = None
+
+    def __len__(self):
+        return self.rows
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def _rows_in_time(self, t0, t1):
+        """Row numbers with t0 <= timestamp <= t1, pruned by the chunk index first."""
+        t0 = -np.inf if t0 is None else t0
+        t1 = np.inf if t1 is None else t1
+        hit = self.index[(self.index['t_max'] >= t0) & (self.index['t_min'] <= t1)]
+        if not len(hit): return np.empty(0, dtype=np.int64)
+        parts = []
+        for start, n, cmin, cmax in hit:
+            if cmin >= t0 and cmax <= t1:
+                parts.append(np.arange(start, start + n))
+            else:
+                ts = self.columns['timestamp'][start:start + n]
+                parts.append(start + np.flatnonzero((ts >= t0) & (ts <= t1)))
+        return np.concatenate(parts)
+
+    def _rows_of_actor(self, actor_id):
+        # sorted once on first use, every later lookup is a binary search
+        if self._actor_order is None:
+            ids = np.asarray(self.columns['id'])
+            self._actor_order = np.argsort(ids, kind='stable')
+            self._sorted_ids = ids[self._actor_order]
+        lo, hi = np.searchsorted(self._sorted_ids, [actor_id, actor_id + 1])
+        return self._actor_order[lo:hi]
+
+    def actor_ids(self):
+        if self._actor_order is None: self._rows_of_actor(0)
+        return np.unique(self._sorted_ids)
+
+    def select(self, t0=None, t1=None, actor_id=None):
+        """Return {column: array} for rows in [t0, t1], optionally of a single actor."""
+        if actor_id is None:
+            if t0 is None and t1 is None:
+                return {name: np.asarray(col) for name, col in self.columns.items()}
+            rows = self._rows_in_time(t0, t1)
+        else:
+            rows = self._rows_of_actor(actor_id)
+            if t0 is not None or t1 is not None:
+                ts = self.columns['timestamp'][rows]
+                rows = rows[(ts >= (-np.inf if t0 is None else t0)) & (ts <= (np.inf if t1 is None else t1))]
+        return {name: col[rows] for name, col in self.columns.items()}
+
+    def iter_chunks(self, rows=1 << 20):
+        """Yield consecutive {column: array} slices of at most `rows` rows."""
+        for start in range(0, self.rows, rows):
+            yield {name: np.asarray(col[start:start + rows]) for name, col in self.columns.items()}
+
+# ───────── Vehicle logs used by Physical_world / Twin_world ─────────
+
+class CsvVehicleLog(object):
+    """Legacy per-row CSV log, kept for `--log-format csv`."""
+
+    def __init__(self, path, extra=()):
+        self._f = open(path, 'w', newline='')
+        self._writer = csv.writer(self._f)
+        self._writer.writerow(['timestamp', 'id', 'x', 'y', 'z', *extra])
+
+    def write(self, ts, ids, xs, ys, zs, *extra):
+        extra = [c if np.ndim(c) else itertools.repeat(c) for c in extra]
+        for row in zip(ids, xs, ys, zs, *extra):
+            self._writer.writerow([ts, *row])
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+def open_vehicle_log(name, log_format='columnar', extra=()):
+    """Open `<name>.csv` or the columnar run directory `<name>/`; extra names further float columns."""
+    if log_format == 'csv':
+        return CsvVehicleLog(name + '.csv', extra)
+    return TrajectoryLogWriter(name, SCHEMA + tuple((c, '<f8') for c in extra))
@@ -5,7 +5,7 @@ Twin World (CARLA2) receiver with collision counting.
 - Tracks collisions per vehicle using sensor.other.collision
 - Logs positions and outputs collision summary at shutdown
 """
-import glob, os, sys, time, socket, pickle, struct, csv
+import glob, os, sys, time, socket, pickle, struct, csv, argparse
 
 try:
     sys.path.append(glob.glob('../carla/dist/carla-*%d.%d-%s.egg' % (
@@ -15,16 +15,37 @@ try:
 except IndexError:
     pass
 
-import carla
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+if os.environ.get('CARLA_STANDIN'):
+    import Carla_standin as carla    # kinematic stand-in, no simulator needed
+else:
+    import carla
+from Trajectory_log import open_vehicle_log
+from Shm_transport import ShmRing, SHM_NAME
+from Udp_transport import UdpReceiver
+import Trace
+from Clock_sync import ClockSync, ClockPinger, CLOCK_PORT
+from Lod import LOD_HOLD
+from Lane_codec import LaneIndex, LaneCodec
+from Quantize import Quantizer
 
 RECV_PORT   = 9999   # from scheduler
 CARLA2_PORT = 2100   # CARLA2 simulator port
+LOG_FORMAT  = 'columnar'  # 'columnar' or 'csv'
+TRANSPORT   = 'tcp'       # 'tcp', 'udp' or 'shm' (shared-memory ring created by the scheduler)
+FIXED_DELTA = 0.02        # CARLA2 tick; frames taking longer than this to apply count as overruns
+OUT_SUFFIX  = ''          # output file suffix, '_<port>' when several twins run side by side (Scheduler --twins)
 
 vehicle_map   = {}   # id -> vehicle actor
 walker_map    = {}   # id -> walker actor
 sensor_map    = {}   # id -> collision sensor actor
 collision_cnt = {}   # id -> collision count
 last_col_time = {}   # id -> last collision time
+blueprints    = {}   # blueprint id -> blueprint, looked up once per type
+lod_states    = {}   # id -> last state of a vehicle sent at a reduced rate (Physical_world --lod)
+updated_at    = {}   # id -> physical_timestamp of the last state received for the actor
+lane_codec    = None # decoder of lane-coded poses, set by an init naming a lane index (Physical_world --lane-codec)
+quantizer     = None # decoder of fixed-point poses, set by an init naming a spec (Physical_world --quantize)
 COLLISION_WINDOW = 5.0  # seconds
 
 # ───────────────────────────────────────── helper ─────────────────────────────
@@ -37,6 +58,26 @@ def receive_exact(sock, size):
         data += pkt
     return data
 
+def tcp_frames(conn):
+    while True:
+        hdr = receive_exact(conn,12)
+        if not hdr: return
+        ln, _ = struct.unpack('>Id', hdr)
+        data = receive_exact(conn, ln)
+        if not data: return
+        yield data
+
+def udp_frames(rx, peer):
+    while True:
+        peer['addr'], _, _, data = rx.recv()
+        yield data
+
+def shm_frames(ring):
+    while True:
+        data = ring.read()
+        if data is None: return
+        yield data
+
 # attach collision sensor ------------------------------------------------------
 
 def attach_collision_sensor(world, parent, actor_id):
@@ -65,7 +106,9 @@ def sync_actor(world, actor_map, state, is_vehicle=True):
 
     if aid not in actor_map:
         bp_id = state.get('bp') or state.get('blueprint')
-        bp = world.get_blueprint_library().find(bp_id)
+        bp = blueprints.get(bp_id)
+        if bp is None:
+            bp = blueprints[bp_id] = world.get_blueprint_library().find(bp_id)
         if bp.has_attribute('color') and state.get('color'):
             bp.set_attribute('color', state['color'])
         actor = world.try_spawn_actor(bp, tf)
@@ -80,55 +123,145 @@ def sync_actor(world, actor_map, state, is_vehicle=True):
         if is_vehicle and 'vel' in state:
             actor.set_target_velocity(carla.Vector3D(*state['vel']))
 
+def dead_reckon(client, seen, ts):
+    """Move the reduced-rate vehicles missing from this frame along their last velocity, in one batch."""
+    cmds = []
+    for aid, st in list(lod_states.items()):
+        if aid in seen: continue
+        actor = vehicle_map.get(aid)
+        dt = ts - st['physical_timestamp']
+        if actor is None or dt > LOD_HOLD:
+            del lod_states[aid]; continue
+        (x, y, z), (vx, vy, vz) = st['loc'], st['vel']
+        tf = carla.Transform(carla.Location(x + vx * dt, y + vy * dt, z + vz * dt), carla.Rotation(*st['rot']))
+        cmds.append(carla.command.ApplyTransform(actor.id, tf))
+    if cmds: client.apply_batch(cmds)
+    return len(cmds)
+
+def open_lane_codec(world, key, spacing):
+    """The sender's lane index from the disk cache, or built from this twin's map (the same town)."""
+    index = LaneIndex.load(key, spacing) or LaneIndex.for_map(world.get_map(), spacing)
+    if index.key != key:
+        print(f"[CARLA2] lane index {index.key} of this map differs from the sender's {key}")
+    return LaneCodec(index)
+
+def release_actor(aid):
+    """An actor handed off to another shard (Scheduler --shard) leaves this twin."""
+    sensor = sensor_map.pop(aid, None)
+    actor = vehicle_map.pop(aid, None) or walker_map.pop(aid, None)
+    updated_at.pop(aid, None)
+    try:
+        if sensor: sensor.stop(); sensor.destroy()
+        if actor: actor.destroy()
+    except RuntimeError:
+        pass
+
 # ───────────────────────────────────── main routine ───────────────────────────
 
-def carla2_main():
+def carla2_main(transport=TRANSPORT, fixed_delta=FIXED_DELTA):
+    global lane_codec, quantizer
     client = carla.Client('127.0.0.1', CARLA2_PORT); client.set_timeout(10)
     world  = client.get_world()
-    settings = world.get_settings(); settings.synchronous_mode = True; settings.fixed_delta_seconds = 0.02
+    settings = world.get_settings(); settings.synchronous_mode = True; settings.fixed_delta_seconds = fixed_delta
     world.apply_settings(settings)
 
-    print(f"[CARLA2] listening on {RECV_PORT}…")
-    srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    srv.bind(('0.0.0.0', RECV_PORT)); srv.listen(1)
-    conn, addr = srv.accept(); print(f"[CARLA2] connected from {addr}")
+    # applied acks go back to the scheduler on the frame connection; clock pings go to its
+    # ClockResponder on a socket of their own (not needed for shm: same host)
+    clock = ClockSync(); pinger = None
+    if transport == 'shm':
+        conn = ShmRing.attach(SHM_NAME); srv = None
+        print(f"[CARLA2] attached to scheduler ring '{SHM_NAME}'")
+        frames = shm_frames(conn); reply = None
+    elif transport == 'udp':
+        conn = UdpReceiver(('0.0.0.0', RECV_PORT)); srv = None
+        print(f"[CARLA2] receiving datagrams on {RECV_PORT}…")
+        peer = {}
+        frames = udp_frames(conn, peer)
+        reply = lambda blob: conn.sock.sendto(blob, peer['addr'])
+        pinger = ClockPinger(clock)     # aimed at the scheduler once its first datagram arrives
+    else:
+        print(f"[CARLA2] listening on {RECV_PORT}…")
+        srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        srv.bind(('0.0.0.0', RECV_PORT)); srv.listen(1)
+        conn, addr = srv.accept(); print(f"[CARLA2] connected from {addr}")
+        frames = tcp_frames(conn)
+        reply = lambda blob: conn.sendall(struct.pack('>Id', len(blob), time.time()) + blob)
+        pinger = ClockPinger(clock, (addr[0], CLOCK_PORT))
 
-    csvf = open('twin_vehicle_log_pod4.csv','w',newline=''); writer = csv.writer(csvf)
-    writer.writerow(['timestamp','id','x','y','z'])
+    # 'applied': when the row's frame was applied, on the relay clock; 'updated': the physical time of the actor's own last state
+    vlog = open_vehicle_log('twin_vehicle_log_pod4' + OUT_SUFFIX, LOG_FORMAT, ('applied', 'updated'))
+    trace = Trace.TraceCollector(f'latency_trace_twin{OUT_SUFFIX}.json', clock=clock)
+    stats = trace.extra['twin'] = {'frames': 0, 'overruns': 0, 'first': None, 'last': None, 'fps': None,
+                                   'rpcs': 0, 'rpcs_full': 0, 'dead_reckoned': 0}
+    applied = 0     # init and state frames applied, acknowledged so a queued relay can bound the frames in flight
 
     try:
-        while True:
-            hdr = receive_exact(conn,4)
-            if not hdr: break
-            ln  = struct.unpack('>I', hdr)[0]
-            data = receive_exact(conn, ln)
-            if not data: break
-            states = pickle.loads(data)
+        for data in frames:
+            t_recv = Trace.now()
+            hdr = Trace.read_header(data)
+            states = pickle.loads(Trace.payload(data))
+            if isinstance(states, dict) and states.get('cmd') == 'shutdown': break
+            if pinger is not None and pinger.addr is None: pinger.addr = (peer['addr'][0], CLOCK_PORT)
 
             # init dict --------------------------------------------------
             if isinstance(states, dict) and states.get('init'):
+                if states.get('lane_index') and (lane_codec is None or lane_codec.index.key != states['lane_index'][0]):
+                    lane_codec = open_lane_codec(world, *states['lane_index'])
+                if states.get('quant') and (quantizer is None or quantizer.spec != states['quant']):
+                    quantizer = Quantizer(states['quant'])
+                if quantizer is not None: quantizer.decode(states.get('vehicles', []))
+                if lane_codec is not None: lane_codec.decode(states.get('vehicles', []))
                 for ent in states.get('vehicles', []):
                     sync_actor(world, vehicle_map, ent, ent['type']=='vehicle')
-                print(f"[CARLA2] init {len(vehicle_map)} vehicles from packet")
-                world.tick(); continue
+                    updated_at[ent['id']] = ent.get('physical_timestamp', 0.0)
+                print(f"[CARLA2] init {len(vehicle_map)} vehicles from {'keyframe' if states.get('keyframe') else 'packet'}")
+                world.tick(); applied += 1
+                if reply: reply(pickle.dumps({'cmd': 'applied', 'frames': applied}))
+                continue
 
             # regular list ----------------------------------------------
+            if quantizer is not None: quantizer.decode(states)
+            if lane_codec is not None: lane_codec.decode(states)
             ts = None
             for ent in states:
                 if ent['type']=='vehicle' and 'physical_timestamp' in ent:
                     ts = ent['physical_timestamp']; break
+            if ts is not None and lod_states:
+                n = dead_reckon(client, {ent['id'] for ent in states}, ts)
+                stats['dead_reckoned'] += n; stats['rpcs'] += n > 0
             if ts is None:
                 ts = world.get_snapshot().timestamp.elapsed_seconds
 
+            # actor RPCs: set_transform + set_target_velocity per vehicle, set_transform per walker
+            nv = nw = 0
             for ent in states:
-                if ent['type']=='vehicle': sync_actor(world, vehicle_map, ent, True)
-                elif ent['type']=='walker': sync_actor(world, walker_map, ent, False)
+                if ent.get('released'): release_actor(ent['id']); lod_states.pop(ent['id'], None)
+                elif ent['type']=='vehicle':
+                    sync_actor(world, vehicle_map, ent, True); nv += 1
+                    updated_at[ent['id']] = ent.get('physical_timestamp', ts)
+                    if 'lod' in ent and 'vel' in ent: lod_states[ent['id']] = ent
+                    else: lod_states.pop(ent['id'], None)
+                elif ent['type']=='walker': sync_actor(world, walker_map, ent, False); nw += 1
+            stats['rpcs'] += 2 * nv + nw
+            stats['rpcs_full'] += 2 * len(vehicle_map) + len(walker_map)
+            if hdr is not None:
+                stamps = hdr[2]; stamps[4] = t_recv; stamps[5] = Trace.now()
+                trace.record(stamps)
 
+            ids, xs, ys, zs, upd = [], [], [], [], []
             for vid, act in vehicle_map.items():
                 loc = act.get_transform().location
-                writer.writerow([ts, vid, loc.x, loc.y, loc.z])
-            csvf.flush()
-            world.tick()
+                ids.append(vid); xs.append(loc.x); ys.append(loc.y); zs.append(loc.z); upd.append(updated_at.get(vid, ts))
+            vlog.write(ts, ids, xs, ys, zs, t_recv + clock.offset(t_recv), upd)
+            world.tick(); applied += 1
+            if reply: reply(pickle.dumps({'cmd': 'applied', 'frames': applied}))
+
+            t_done = Trace.now()
+            if t_done - t_recv > fixed_delta: stats['overruns'] += 1
+            stats['frames'] += 1
+            if stats['first'] is None: stats['first'] = t_recv
+            stats['last'] = t_recv
 
     except Exception as e:
         print(f"[CARLA2 Error] {e}")
@@ -142,11 +275,30 @@ def carla2_main():
             try: a.destroy()
             except: pass
         world.apply_settings(carla.WorldSettings())
-        conn.close(); srv.close(); csvf.close()
-        with open('collision_summary.csv','w',newline='') as f:
+        if transport == 'udp': print(f"[CARLA2] datagram stats {conn.stats}")
+        conn.close(); vlog.close()
+        if pinger is not None: pinger.close()
+        if stats['frames'] > 1: stats['fps'] = (stats['frames'] - 1) / (stats['last'] - stats['first'])
+        print(f"[CARLA2] applied {stats['frames']} frames ({stats['fps']} fps), {stats['overruns']} tick overruns")
+        print(f"[CARLA2] {stats['rpcs']} actor RPCs ({stats['rpcs_full']} with every actor in every frame), "
+              f"{stats['dead_reckoned']} dead-reckoned updates")
+        trace.dump(); print(f"[CARLA2] per-hop latency {trace.summary()}")
+        print(f"[CARLA2] clock offset to scheduler {clock.confidence()}")
+        if lane_codec is not None: print(f"[CARLA2] lane-coded poses decoded: {lane_codec.stats['decoded']}")
+        if quantizer is not None: print(f"[CARLA2] fixed-point fields decoded: {quantizer.stats['decoded']}")
+        if srv: srv.close()
+        with open(f'collision_summary{OUT_SUFFIX}.csv','w',newline='') as f:
             csw = csv.writer(f); csw.writerow(['id','collision_count'])
             for k,v in collision_cnt.items(): csw.writerow([k,v])
         print("[CARLA2] shutdown complete")
 
 if __name__ == '__main__':
-    carla2_main()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--transport', choices=['tcp', 'udp', 'shm'], default=TRANSPORT)
+    parser.add_argument('--fixed-delta', type=float, default=FIXED_DELTA)
+    parser.add_argument('--port', type=int, default=RECV_PORT, help='port the Scheduler sends frames to')
+    parser.add_argument('--carla-port', type=int, default=CARLA2_PORT)
+    args = parser.parse_args()
+    if args.port != RECV_PORT: OUT_SUFFIX = f'_{args.port}'
+    RECV_PORT, CARLA2_PORT = args.port, args.carla_port
+    carla2_main(args.transport, args.fixed_delta)
\ No newline at end of file
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+Per-hop latency tracing across the twin pipeline.
+
+Every message carries six time.monotonic() stamps:
+
+    capture -> send -> relay_in -> relay_out -> receive -> apply
+    (physical)         (Scheduler / bridge)     (twin)
+
+Single_Server frames carry them in a fixed 64-byte binary header in front of the
+pickled payload, so relays patch stamps in place without re-pickling; the MQTT
+path carries them as a 'trace' dict inside the JSON message. The twin feeds
+complete traces into one LatencyHistogram per hop and dumps them periodically
+and at shutdown. When the twin runs on another host, a Clock_sync.ClockSync
+estimate maps the physical- and relay-side stamps onto the twin clock first.
+"""
+import struct, time
+
+from Latency_hist import LatencyHistogram, dump_histograms
+
+now = time.monotonic
+
+STAMPS = ('capture', 'send', 'relay_in', 'relay_out', 'receive', 'apply')
+REMOTE_STAMPS = 4      # capture..relay_out are taken on the physical/relay host
+HOPS = (('serialize', 'capture', 'send'),
+        ('uplink', 'send', 'relay_in'),
+        ('relay', 'relay_in', 'relay_out'),
+        ('downlink', 'relay_out', 'receive'),
+        ('apply', 'receive', 'apply'),
+        ('end_to_end', 'capture', 'apply'))
+DUMP_INTERVAL = 10.0   # seconds
+
+# ───────── Binary frame header (Single_Server) ─────────
+
+MAGIC = b'TRC1'
+FLAG_INIT = 1
+_HDR = struct.Struct('<4sIQ6d')          # magic, flags, frame seq, six stamps
+HEADER_SIZE = _HDR.size
+_STAMP_OFF = {name: 16 + 8 * i for i, name in enumerate(STAMPS)}
+
+def pack_header(seq, capture, flags=0):
+    """Header for a new frame; 'send' is stamped now, later stamps are zero."""
+    return _HDR.pack(MAGIC, flags, seq, capture, now(), 0.0, 0.0, 0.0, 0.0)
+
+def stamp(buf, name, t=None, base=0):
+    """Write one stamp into a header held in a writable buffer (bytearray, shared memory)."""
+    struct.pack_into('<d', buf, base + _STAMP_OFF[name], now() if t is None else t)
+
+def read_header(buf):
+    """Return (flags, seq, [stamps]) of a framed message, or None if it has no header."""
+    if len(buf) < HEADER_SIZE or bytes(buf[:4]) != MAGIC: return None
+    _, flags, seq, *stamps = _HDR.unpack_from(buf)
+    return flags, seq, stamps
+
+def payload(buf):
+    """The pickled payload behind the header (zero-copy view)."""
+    mv = memoryview(buf)
+    return mv[HEADER_SIZE:] if bytes(mv[:4]) == MAGIC else mv
+
+# ───────── JSON messages (MQTT path) ─────────
+
+def stamp_message(msg, name, t=None):
+    msg.setdefault('trace', {})[name] = now() if t is None else t
+    return msg
+
+# ───────── Collector ─────────
+
+class TraceCollector(object):
+    """One histogram per hop; hops with a missing (zero) stamp are skipped."""
+
+    def __init__(self, path, dump_interval=DUMP_INTERVAL, clock=None):
+        self.path = path
+        self.dump_interval = dump_interval
+        self.clock = clock
+        self.hists = {hop: LatencyHistogram() for hop, _, _ in HOPS}
+        self._idx = [(self.hists[hop], STAMPS.index(a), STAMPS.index(b)) for hop, a, b in HOPS]
+        self._last_dump = now()
+        self.messages = 0
+        self.extra = {}      # further fields for the dump, e.g. receiver counters
+
+    def record(self, stamps):
+        """stamps: sequence in STAMPS order, or a {name: t} dict from a JSON message."""
+        if isinstance(stamps, dict):
+            stamps = [stamps.get(name, 0.0) for name in STAMPS]
+        if self.clock is not None and self.clock.ready:
+            t_local = stamps[4] or now()
+            stamps = [self.clock.to_local(t, t_local) if t and i < REMOTE_STAMPS else t for i, t in enumerate(stamps)]
+        self.messages += 1
+        for hist, a, b in self._idx:
+            if stamps[a] and stamps[b]:
+                hist.record(stamps[b] - stamps[a])
+        if now() - self._last_dump > self.dump_interval:
+            self.dump()
+
+    def dump(self):
+        self._last_dump = now()
+        extra = dict(self.extra)
+        if self.clock is not None: extra['clock'] = self.clock.confidence()
+        dump_histograms(self.path, self.hists, messages=self.messages, **extra)
+
+    def summary(self):
+        return {hop: h.summary() for hop, h in self.hists.items()}
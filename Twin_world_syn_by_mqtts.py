@@ -14,11 +14,17 @@ try:
 except IndexError:
     pass
 
-import carla
+if os.environ.get('CARLA_STANDIN'):
+    import Carla_standin as carla    # kinematic stand-in, no simulator needed
+else:
+    import carla
 import atexit
-import paho.mqtt.client as mqtt
+import Pubsub
 import json
 import threading
+import Trace
+from Clock_sync import ClockSync, make_ping
+from Geo_tiles import RoiSubscription, ROI_MARGIN
 
 # Dictionaries to store vehicle objects and their last update times
 generated_vehicles = {}
@@ -27,6 +33,14 @@ last_update_times = {}
 # Timeout duration for vehicle inactivity (in seconds)
 VEHICLE_TIMEOUT = 10
 
+# clock offset to the bridge host, estimated from ping/pong on CLOCK_TOPIC over a connection of
+# its own, so a pong is stamped when it arrives rather than after the vehicle messages ahead of it
+CLOCK_TOPIC = "carla/clock"
+clock_sync = ClockSync()
+
+# per-hop latency of every message that carries a trace
+trace_collector = Trace.TraceCollector('latency_trace_mqtt_twin.json', clock=clock_sync)
+
 
 def create_vehicle(world, vehicle_info, car_id):
     """Create a vehicle in CARLA for a specific car ID."""
@@ -131,11 +145,20 @@ def destroy_inactive_vehicles(world):
         del last_update_times[car_id]
 
 
+def on_clock_pong(client, userdata, message):
+    """Feed a bridge pong to the clock estimate, stamped before anything else is done with it."""
+    t_recv = Trace.now()
+    try:
+        clock_sync.on_pong(json.loads(message.payload.decode('utf-8')), t_recv)
+    except (ValueError, KeyError) as e:
+        print(f"Bad clock pong: {e}")
+
 def on_message(client, userdata, message):
     """Callback function for processing incoming MQTT messages."""
     global generated_vehicles
 
     # Decode and parse the received message
+    t_recv = Trace.now()
     payload = message.payload.decode('utf-8')
     print(f"Raw message payload: {payload}")
 
@@ -146,9 +169,15 @@ def on_message(client, userdata, message):
         return
 
     topic = message.topic
+    if topic.startswith(CLOCK_TOPIC + '/'):
+        return  # pongs are taken by the clock client
     car_id = topic.split('/')[-1]  # Extract car_id from topic
     print(f"Received message for car ID: {car_id}")
 
+    # a region of interest that follows one car moves its tile subscriptions along
+    if car_id == userdata.get('roi_follow') and 'location' in vehicle_info:
+        userdata['roi'].centre(vehicle_info['location']['x'], vehicle_info['location']['y'], userdata['roi_radius'])
+
     world = userdata['world']
 
     if car_id not in generated_vehicles and 'model' in vehicle_info:
@@ -158,6 +187,12 @@ def on_message(client, userdata, message):
         print(f"Updating vehicle for {car_id}...")
         update_vehicle_state(generated_vehicles[car_id], vehicle_info, car_id)
 
+    if 'trace' in vehicle_info:
+        trace = vehicle_info['trace']
+        trace['receive'] = t_recv
+        trace['apply'] = Trace.now()
+        trace_collector.record(trace)
+
 def destroy_all_vehicles():
     """Destroy all vehicles in the simulation."""
     global generated_vehicles
@@ -167,28 +202,49 @@ def destroy_all_vehicles():
         vehicle.destroy()
     generated_vehicles.clear()
 
-def start_receiver_mqtt(broker, port, topic_prefix, username, password, client_id):
-    """Start the MQTT receiver for multiple topics with MQTTS."""
+def start_receiver_mqtt(broker, port, topic_prefix, username, password, client_id,
+                        roi=None, roi_follow=None, roi_radius=300.0, roi_margin=ROI_MARGIN, tile_prefix="carla/publish"):
+    """Start the MQTT receiver for multiple topics with MQTTS.
+
+    With roi = (x_min, y_min, x_max, y_max) only the geo-tiled topics of that region (plus roi_margin)
+    are subscribed; with roi_follow = car_id the region is re-centred on that car as it drives.
+    """
     global generated_vehicles, last_update_times
 
     carla_client = carla.Client('127.0.0.1', 2000)
     carla_client.set_timeout(10.0)
     world = carla_client.get_world()
 
-    client = mqtt.Client(client_id=client_id, userdata={'world': world})
-    client.username_pw_set(username, password)
-    client.tls_set()
+    userdata = {'world': world, 'client_id': client_id, 'roi_follow': roi_follow, 'roi_radius': roi_radius}
+    client = Pubsub.create_client(client_id, userdata=userdata)
     client.on_message = on_message
-    client.connect(broker, port, 60)
-
-    # Subscribe to all car-related topics
-    topic = f"{topic_prefix}/#"
-    client.subscribe(topic)
-    print(f"Subscribed to MQTT topic: {topic}")
+    Pubsub.connect(client, broker, port, username, password)
+    clock_client = Pubsub.create_client(f"{client_id}_clock")
+    clock_client.on_message = on_clock_pong
+    Pubsub.connect(clock_client, broker, port, username, password)
+    clock_client.subscribe(f"{CLOCK_TOPIC}/pong/{client_id}")
+    clock_client.loop_start()
+
+    if roi is None and roi_follow is None:
+        # Subscribe to all car-related topics
+        topic = f"{topic_prefix}/#"
+        client.subscribe(topic)
+        print(f"Subscribed to MQTT topic: {topic}")
+    else:
+        # only the tiles of the region of interest
+        userdata['roi'] = RoiSubscription(client, tile_prefix, margin=roi_margin)
+        if roi_follow is not None:
+            # the followed car is found on any tile until its first message centres the region
+            client.subscribe(f"{tile_prefix}/tile/+/+/{roi_follow}")
+        if roi is not None:
+            userdata['roi'].move(roi)
+        print(f"Subscribed to region of interest: {userdata['roi'].summary()}")
 
     def periodic_cleanup():
         while True:
             destroy_inactive_vehicles(world)
+            # ping the bridge once a second to keep the clock offset estimate fresh
+            clock_client.publish(f"{CLOCK_TOPIC}/ping/{client_id}", json.dumps(make_ping()))
             time.sleep(1)  # Check every second
 
     # Start a thread for periodic cleanup
@@ -201,6 +257,11 @@ def start_receiver_mqtt(broker, port, topic_prefix, username, password, client_i
         print("MQTT receiver stopped.")
     finally:
         destroy_all_vehicles()  # Ensure all vehicles are destroyed
+        clock_client.loop_stop(); clock_client.disconnect()
+        trace_collector.dump()
+        print(f"Clock offset to bridge: {clock_sync.confidence()}")
+        if 'roi' in userdata:
+            print(f"Region of interest: {userdata['roi'].summary()}")
 
 # Register cleanup function at exit
 atexit.register(destroy_all_vehicles)
@@ -212,6 +273,9 @@ if __name__ == "__main__":
     MQTT_USERNAME = "your mqtt username"
     MQTT_PASSWORD = "your mqtt password"
     MQTT_CLIENT_ID = "carla_receiver"
+    ROI = None            # (x_min, y_min, x_max, y_max) in metres; None receives the whole map
+    ROI_FOLLOW = None     # car id (its MQTT topic) to centre the region on as it drives
+    ROI_RADIUS = 300.0    # metres around ROI_FOLLOW
 
     start_receiver_mqtt(
         broker=MQTT_BROKER,
@@ -219,7 +283,10 @@ if __name__ == "__main__":
         topic_prefix=MQTT_TOPIC_PREFIX,
         username=MQTT_USERNAME,
         password=MQTT_PASSWORD,
-        client_id=MQTT_CLIENT_ID
+        client_id=MQTT_CLIENT_ID,
+        roi=ROI,
+        roi_follow=ROI_FOLLOW,
+        roi_radius=ROI_RADIUS
     )
 
 
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+"""
+UDP datagram transport with sequence numbers.
+
+Every frame gets a sequence number and is split into MTU-sized fragments:
+
+    seq (u32) | fragment index (u16) | fragment count (u16) | send time (f64) | payload
+
+The receiver reassembles fragments per sender, gives up on a frame after REASSEMBLY_TIMEOUT,
+and only ever delivers frames newer than the last one it delivered, so late frames
+are discarded instead of blocking the ones behind them. Counters:
+
+    frames      delivered frames
+    lost        sequence numbers skipped over when a newer frame was delivered
+    stale       complete frames that arrived after a newer one had been delivered
+    reordered   frames whose first fragment arrived after a newer frame's
+    incomplete  frames dropped by the reassembly timeout
+"""
+import socket, struct, time
+
+MTU = 1400
+REASSEMBLY_TIMEOUT = 0.2
+SOCK_BUFFER = 8 << 20
+RESTART_GAP = 1000     # a sequence number this far behind means the sender restarted
+
+_HDR = struct.Struct('>IHHd')
+
+class UdpSender(object):
+
+    def __init__(self, addr, mtu=MTU):
+        self.addr = addr
+        self.chunk = mtu - _HDR.size
+        self.seq = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCK_BUFFER)
+
+    def send(self, blob, t_send=None):
+        self.seq = (self.seq + 1) & 0xFFFFFFFF
+        t_send = time.time() if t_send is None else t_send
+        n = max(1, -(-len(blob) // self.chunk))
+        if n > 0xFFFF:
+            raise ValueError(f"frame of {len(blob)} bytes needs more than 65535 fragments")
+        view = memoryview(blob)
+        for i in range(n):
+            self.sock.sendto(_HDR.pack(self.seq, i, n, t_send) + view[i * self.chunk:(i + 1) * self.chunk], self.addr)
+        return self.seq
+
+    def close(self):
+        self.sock.close()
+
+class _Stream(object):
+    """Reassembly state of one sender."""
+
+    def __init__(self):
+        self.partial = {}          # seq -> [fragment count, received, parts, first arrival]
+        self.last_seq = 0          # last delivered
+        self.max_seen = 0          # highest sequence number seen in any fragment
+        self.frames = 0
+
+class UdpReceiver(object):
+    """Reassembles frames per sending address; counters are summed over all senders."""
+
+    def __init__(self, bind=('0.0.0.0', 0), reassembly_timeout=REASSEMBLY_TIMEOUT):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCK_BUFFER)
+        self.sock.bind(bind)
+        self.reassembly_timeout = reassembly_timeout
+        self.streams = {}          # sender address -> _Stream
+        self.stats = dict(frames=0, lost=0, stale=0, reordered=0, incomplete=0, fragments=0)
+
+    def _expire(self, now):
+        for st in self.streams.values():
+            old = [s for s, p in st.partial.items() if now - p[3] > self.reassembly_timeout]
+            for s in old:
+                del st.partial[s]
+            self.stats['incomplete'] += len(old)
+
+    def recv(self, timeout=None):
+        """Return (addr, seq, t_send, payload) of the next deliverable frame, or None on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            now = time.monotonic()
+            pending = any(st.partial for st in self.streams.values())
+            if pending: self._expire(now)
+            if deadline is not None:
+                if now >= deadline: return None
+                self.sock.settimeout(min(deadline - now, self.reassembly_timeout) if pending else deadline - now)
+            else:
+                self.sock.settimeout(self.reassembly_timeout if pending else None)
+            try:
+                data, addr = self.sock.recvfrom(65535)
+            except socket.timeout:
+                continue
+            now = time.monotonic()     # arrival time; the socket may have been idle for long
+            if len(data) < _HDR.size: continue
+            seq, idx, n, t_send = _HDR.unpack_from(data)
+            self.stats['fragments'] += 1
+            st = self.streams.get(addr)
+            if st is None:
+                st = self.streams[addr] = _Stream()
+            p = st.partial.get(seq)
+            if p is None:
+                if seq < st.max_seen: self.stats['reordered'] += 1
+                p = st.partial[seq] = [n, 0, [None] * n, now]
+            st.max_seen = max(st.max_seen, seq)
+            if idx >= p[0] or p[2][idx] is not None: continue   # malformed or duplicate
+            p[2][idx] = data[_HDR.size:]
+            p[1] += 1
+            if p[1] < p[0]: continue
+            del st.partial[seq]
+            if seq + RESTART_GAP < st.last_seq:
+                st.last_seq = st.max_seen = seq - 1     # sender restarted its sequence
+            if seq <= st.last_seq:
+                self.stats['stale'] += 1
+                continue
+            if st.frames:
+                self.stats['lost'] += seq - st.last_seq - 1
+            st.frames += 1
+            self.stats['frames'] += 1
+            st.last_seq = seq
+            # anything older than a delivered frame can never be delivered
+            for s in [s for s in st.partial if s < seq]:
+                del st.partial[s]
+                self.stats['incomplete'] += 1
+            return addr, seq, t_send, b''.join(p[2])
+
+    def close(self):
+        self.sock.close()